@@ -2,9 +2,13 @@
 Provide a standard protocol for asking graph oriented questions of Translator data sources.
 """
 import argparse
+import gzip
+import hashlib
+import itertools
 import json
 import logging
 import os
+import threading
 import traceback
 from pathlib import Path
 
@@ -22,8 +26,7 @@ from tranql.main import TranQL, TranQLIncompleteParser
 from tranql.tranql_ast import SelectStatement
 from tranql.tranql_schema import GraphTranslator, RedisAdapter
 from tranql.exception import TranQLException
-from tranql.config import Config as TranqlConfig
-from tranql.util import title_case
+from tranql.config import Config as TranqlConfig, config
 
 logger = logging.getLogger(__name__)
 
@@ -384,7 +387,14 @@ class MergeMessages(StandardAPIResource):
 
         """
         messages = request.json
-        return self.response(SelectStatement.merge_results(messages))
+        chunks = SelectStatement.stream_merged_results(messages, config=config)
+        # Messages are merged making the first chunk, so merge errors are reported before the response starts.
+        # Later errors can't change the status any more; stream_merged_messages ends the message with them.
+        try:
+            first = next(chunks)
+        except Exception as e:
+            return self.response(self.handle_exception(e))
+        return Response(itertools.chain([first], chunks), mimetype='application/json')
 
 
 class TranQLQuery(StandardAPIResource):
@@ -521,6 +531,37 @@ class AnnotateGraph(StandardAPIResource):
 
 class SchemaGraph(StandardAPIResource):
     """ Graph of schema to display to the client """
+    # The serialized response of the last schema served, made once per schema version.
+    _serialized = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def serialize(cls, schema, compress):
+        """
+        The response body of a schema, with its ETag and, if compress is set, its gzipped body.
+        Schemas are only replaced, never modified, so the body is reused for as long as the schema is current.
+        """
+        with cls._lock:
+            if cls._serialized is None or cls._serialized["schema"] is not schema:
+                obj = {
+                    "schema": GraphTranslator(schema.schema_graph).graph_to_message(),
+                }
+                if len(schema.loadErrors) > 0:
+                    errors = cls.handle_exception(schema.loadErrors, warning=True)
+                    for key in errors:
+                        obj[key] = errors[key]
+                body = json.dumps(obj).encode("utf-8")
+                cls._serialized = {
+                    "schema": schema,
+                    "body": body,
+                    "etag": hashlib.sha256(body).hexdigest(),
+                    "gzip": None
+                }
+            serialized = cls._serialized
+            if compress and serialized["gzip"] is None:
+                serialized["gzip"] = gzip.compress(serialized["body"])
+            return serialized
+
     def get(self):
         """
         TranQL Schema
@@ -534,6 +575,8 @@ class SchemaGraph(StandardAPIResource):
                     application/json:
                         schema:
                           $ref: '#/definitions/Message'
+            '304':
+                description: The schema hasn't changed since the ETag given in If-None-Match
             '500':
                 description: An error was encountered
                 content:
@@ -541,6 +584,12 @@ class SchemaGraph(StandardAPIResource):
                         schema:
                           $ref: '#/definitions/Error'
         parameters:
+            - in: header
+              name: If-None-Match
+              schema:
+                type: string
+              required: false
+              description: ETag of a schema the client already has
             - in: query
               name: force_update
               schema:
@@ -552,21 +601,101 @@ class SchemaGraph(StandardAPIResource):
         force_update = request.args.get("force_update")
         tranql = TranQL (options={"registry": app.config.get('registry', False)})
         schemafactory = tranql.schema_factory
-        schema = schemafactory.get_instance(force_update=force_update)
-        schemaGraph = GraphTranslator(schema.schema_graph)
+        schema = schemafactory.get_instance(force_update=force_update, shared=True)
+
+        compress = str(tranql.config.get('SCHEMA_RESPONSE_GZIP', True)).lower() != 'false' and \
+            request.accept_encodings['gzip'] > 0
+        serialized = self.serialize(schema, compress)
+        # Compressed and uncompressed bodies are different representations, so they get different tags.
+        etag = f"{serialized['etag']}-gzip" if compress else serialized['etag']
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        elif compress:
+            response = Response(serialized["gzip"], mimetype="application/json")
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            response = Response(serialized["body"], mimetype="application/json")
+        response.set_etag(etag)
+        # Clients revalidate every time, which costs a 304 while the schema is unchanged.
+        response.headers["Cache-Control"] = "no-cache"
+        response.vary.add("Accept-Encoding")
+        return response
 
-        # logger.info(schema.schema_graph.net.nodes)
-        # logger.info(schemaGraph.graph_to_message())
 
-        # return {"nodes":[],"links":[]}
-        obj = {
-            "schema": schemaGraph.graph_to_message(),
-        }
-        if len(schema.loadErrors) > 0:
-            errors = self.handle_exception(schema.loadErrors, warning=True)
-            for key in errors:
-                obj[key] = errors[key]
-        return self.response(obj)
+class SchemaPaths(StandardAPIResource):
+    """ Routes between concept types in the schema """
+    def get(self):
+        """
+        TranQL Schema Paths
+        ---
+        tags: [schema]
+        description: Find the routes from one concept type to another in TranQL's schema, up to a number of hops.
+            Without a target, lists the concept types reachable from the source and the fewest hops to each.
+        responses:
+            '200':
+                description: Routes through the schema
+                content:
+                    application/json:
+                        schema:
+                          type: object
+                        example:
+                          paths:
+                            - concepts: [chemical_substance, gene, disease]
+                              predicates: [[directly_interacts_with], [gene_associated_with_condition]]
+                          next: [gene]
+            '400':
+                description: The source or max_hops is missing or invalid
+        parameters:
+            - in: query
+              name: source
+              schema:
+                type: string
+              required: true
+              description: Concept type the routes start from
+            - in: query
+              name: target
+              schema:
+                type: string
+              required: false
+              description: Concept type the routes end at
+            - in: query
+              name: max_hops
+              schema:
+                type: integer
+              required: false
+              default: 2
+              description: The most edges in a route
+            - in: query
+              name: limit
+              schema:
+                type: integer
+              required: false
+              default: 100
+              description: The most routes returned, shortest first
+        """
+        source = request.args.get("source")
+        target = request.args.get("target")
+        tranql = TranQL (options={"registry": app.config.get('registry', False)})
+        try:
+            max_hops = int(request.args.get("max_hops", 2))
+            limit = int(request.args.get("limit", 100))
+        except ValueError as e:
+            abort(Response(str(e), 400))
+        if not source or max_hops < 1:
+            abort(Response("A source and a max_hops of at least 1 are required.", 400))
+        max_hops = min(max_hops, int(tranql.config.get('SCHEMA_MAX_HOPS', 4)))
+
+        schema = tranql.schema_factory.get_instance(shared=True)
+        if not target:
+            return self.response({
+                "reachable": schema.schema_graph.reachable(schema.type_name(source), max_hops)
+            })
+        return self.response({
+            "paths": schema.find_paths(source, target, max_hops, limit),
+            # Concepts that can follow source in a query ending at target.
+            "next": schema.schema_graph.next_types(schema.type_name(source), schema.type_name(target), max_hops)
+        })
 
 
 class ModelConceptsQuery(StandardAPIResource):
@@ -721,14 +850,13 @@ class AutocompleteTerm(StandardAPIResource):
 
     tranql = TranQL (options={"registry": app.config.get('registry', False)})
     schema_factory = tranql.schema_factory
-    schema = schema_factory.get_instance(force_update=False)
+    schema = schema_factory.get_instance(force_update=False, shared=True)
 
     redis_adapter = RedisAdapter()
     redis_schema_name = [schema_name for schema_name, metadata in schema.config['schema'].copy().items() if metadata.get('redis', False)][0]
 
     if indexes is None or len(indexes) == 0:
-      concept_types = schema.schema[redis_schema_name]["schema"].keys()
-      indexes = ["biolink." + title_case(concept_type) for concept_type in concept_types]
+      indexes = schema.redis_labels(schema.schema[redis_schema_name])
 
 
     return redis_adapter.search(
@@ -741,6 +869,7 @@ class AutocompleteTerm(StandardAPIResource):
         # Ensure results are linked to studies
         "postprocessing_cypher": "MATCH (:`biolink.StudyVariable`)-[]-(node)" if study_linked else "",
         # "postprocessing_cypher": "MATCH ()-[:`biolink.Association`|`biolink.association`|`biolink.Mentions`|`biolink.mentions`]->(node)" if study_linked else "",
+        "study_linked": study_linked,
         "levenshtein_distance": levenshtein_distance,
         "query_limit": query_limit
       }
@@ -844,6 +973,7 @@ class ParseIncomplete(StandardAPIResource):
 
 api.add_resource(TranQLQuery, f'{WEB_PREFIX}/tranql/query')
 api.add_resource(SchemaGraph, f'{WEB_PREFIX}/tranql/schema')
+api.add_resource(SchemaPaths, f'{WEB_PREFIX}/tranql/schema/paths')
 api.add_resource(AnnotateGraph, f'{WEB_PREFIX}/tranql/annotate')
 api.add_resource(MergeMessages, f'{WEB_PREFIX}/tranql/merge_messages')
 api.add_resource(DecorateKG, f'{WEB_PREFIX}/tranql/decorate_kg')
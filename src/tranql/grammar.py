@@ -10,9 +10,9 @@ Statements can be 'set' or 'select' statements.
 
 """
 statement = Forward()
-SELECT, FROM, WHERE, SET, AS, CREATE, GRAPH, AT = map(
+SELECT, FROM, WHERE, LIMIT, ORDER, BY, SCORE, SET, AS, CREATE, GRAPH, AT = map(
     CaselessKeyword,
-    "select from where set as create graph at".split())
+    "select from where limit order by score set as create graph at".split())
 
 concept_name    = Word( alphas, alphanums + ":_")
 ident          = Word( "$" + alphas, alphanums + "_$" ).setName("identifier")
@@ -38,7 +38,11 @@ question_graph_element = (
 Group (
     concept_name + COLON + concept_name + ZeroOrMore ( LineEnd () )
 )
-question_graph_expression = question_graph_element + ZeroOrMore(arrow + question_graph_element)
+question_graph_path = question_graph_element + ZeroOrMore(arrow + question_graph_element)
+# Comma separated paths form a branching graph; concepts with the same name are the same node.
+# e.g. select gene->disease, gene->chemical_substance
+# The separator repetition must not consume the whitespace that follows the select clause.
+question_graph_expression = question_graph_path + ZeroOrMore(COMMA + question_graph_path).setWhitespaceChars("")
 
 whereExpression = Forward()
 and_, or_, in_ = map(CaselessKeyword, "and or in".split())
@@ -47,6 +51,10 @@ binop = oneOf("= != =~ !=~ < > >= <= eq ne lt le gt ge", caseless=True)
 realNum = ppc.real()
 intNum = ppc.signed_integer()
 
+# Keep at most n answers, optionally the n best scored ones.
+# e.g. limit 10 order by score
+limitExpression = LIMIT + ppc.integer() + Optional(ORDER + BY + SCORE)
+
 function_body = Forward()
 # Valid data types: nested function, TranQL variable, real, integer, string
 # For a normal arg, this is the entire argument. For a named arg, this is the actual value.
@@ -98,6 +106,7 @@ statement <<= (
         Group(SELECT + question_graph_expression)("concepts") + optWhite +
         Group(FROM + tableNameList) + optWhite +
         Group(Optional(WHERE + whereExpression("where"), "")) + optWhite +
+        Optional(Group(limitExpression)) + optWhite +
         Group(Optional(SET + setExpression("set"), ""))("select")
     )
     |
@@ -135,7 +144,10 @@ incomplete_arrow = \
         Literal ("-")
 
 
-incomplete_question_graph_expression = ZeroOrMore(question_graph_element + incomplete_arrow) + Optional(question_graph_element)
+incomplete_question_graph_path = ZeroOrMore(question_graph_element + incomplete_arrow) + Optional(question_graph_element)
+# Branches are comma separated, the last one possibly incomplete or not begun, e.g. "select gene->disease, gene->"
+incomplete_question_graph_expression = \
+        incomplete_question_graph_path + ZeroOrMore(COMMA + incomplete_question_graph_path).setWhitespaceChars("")
 
 # Match something like "from '/complete_this_" where there is a non completed string literal.
 # In a group just so that it is consistent with an actual table which is stored in a list.
@@ -158,6 +170,7 @@ statement <<= (
         Group(SELECT + incomplete_question_graph_expression)("concepts") + Suppress(optWhite) +
         Optional(Group(FROM + (openTable | Empty()))) + Suppress(optWhite) +
         Optional(Group(WHERE + (incomplete_where_expression("where") | Empty()))) + Suppress(optWhite) +
+        Optional(Group(LIMIT + Optional(ppc.integer() + Optional(ORDER + Optional(BY + Optional(SCORE)))))) + Suppress(optWhite) +
         Optional(Group(SET + setExpression("set")))("select")
     )
     |
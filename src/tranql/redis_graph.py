@@ -1,8 +1,10 @@
-import copy
 import logging
 import redis
+import time
 from redisgraph import Node, Edge, Graph
 from redis.exceptions import ResponseError
+from tranql.utils.provenance import PROVENANCE_KEY
+from tranql.util import snake_case, title_case
 
 logger = logging.getLogger (__name__)
 logger.setLevel (logging.DEBUG)
@@ -10,10 +12,19 @@ logger.setLevel (logging.DEBUG)
 class RedisGraph:
     """ Graph abstraction over RedisGraph. A thin wrapper but provides us some options. """
     
-    def __init__(self, host='localhost', port=6379, graph='default'):
-        """ Construct a connection to Redis Graph. """
-        self.r = redis.Redis(host=host, port=port)
+    def __init__(self, host='localhost', port=6379, graph='default', version_key='{graph}:version', batch_size=10000, password=None):
+        """ Construct a connection to Redis Graph.
+        :param version_key: Key of the graph's version marker, incremented whenever the graph changes
+            so cached answers of the graph are no longer used. Matches REDIS_GRAPH_VERSION_KEY.
+        :param batch_size: Nodes or edges sent per query by load_knowledge_graph.
+        """
+        self.r = redis.Redis(host=host, port=port, password=password)
         self.redis_graph = Graph(graph, self.r)
+        self.version_key = version_key.format(graph=graph)
+        self.batch_size = batch_size
+        # Nodes by identifier, and edges by (start, end) identifiers, added since this wrapper was made.
+        self.nodes = {}
+        self.edges = {}
 
     def add_node (self, identifier=None, label=None, properties=None):
         """ Add a node with the given label and properties. """
@@ -22,38 +33,139 @@ class RedisGraph:
             properties['id'] = identifier
         node = Node(node_id=identifier, alias=identifier, label=label, properties=properties)
         self.redis_graph.add_node(node)
+        if identifier is not None:
+            self.nodes[identifier] = node
         return node
 
     def get_edge (self, start, end, predicate=None):
         """ Get an edge from the graph with the specified start and end identifiers. """
-        result = None
-        for edge in self.redis_graph.edges:
-            if edge.src_node.id == start and edge.dest_node.id == end:
-                result = edge
-                break
-        return result
+        for edge in self.edges.get ((start, end), []):
+            if predicate is None or edge.relation == predicate:
+                return edge
+        return None
     
     def add_edge (self, start, predicate, end, properties={}):
         """ Add an edge with the given predicate and properties between start and end nodes. """
         logger.debug (f"--adding edge start:{start} pred:{predicate} end:{end} prop:{properties}")
         if isinstance(start, str) and isinstance(end, str):
-            start = Node(node_id = start, label='thing')
-            end = Node(node_id = end, label='thing')
-            self.redis_graph.add_node (start)
-            self.redis_graph.add_node (end)
+            start = self.nodes.get (start) or self.add_node (identifier=start, label='thing')
+            end = self.nodes.get (end) or self.add_node (identifier=end, label='thing')
         edge = Edge(start, predicate, end, properties)
         self.redis_graph.add_edge (edge)
+        self.edges.setdefault ((start.id, end.id), []).append (edge)
         return edge
 
     def has_node (self, identifier):
-        return identifier in self.redis_graph.nodes
+        return identifier in self.nodes
 
     def get_node (self, identifier, properties=None):
-        return self.redis_graph.nodes[identifier]
+        return self.nodes[identifier]
     
     def commit (self):
         """ Commit modifications to the graph. """
         self.redis_graph.commit()
+        self.r.incr(self.version_key)
+
+    @staticmethod
+    def graph_properties (element, skip=()):
+        """
+        The properties of a TRAPI node or edge that can be stored in redis: primitives, and lists of primitives.
+        Attributes are stored under their names. Reasoner provenance is only stored once it's expanded to attributes.
+        """
+        primitive = (str, int, float, bool)
+        properties = {}
+        values = [ (key, value) for key, value in element.items ()
+                   if key not in skip and key not in ('attributes', PROVENANCE_KEY) ]
+        values += [ (attribute.get ('original_attribute_name') or attribute.get ('name') or attribute.get ('attribute_type_id'),
+                     attribute.get ('value'))
+                    for attribute in element.get ('attributes') or [] ]
+        for key, value in values:
+            if not key:
+                continue
+            if isinstance (value, primitive) or \
+                    isinstance (value, list) and value and all (isinstance (item, primitive) for item in value):
+                properties[key] = value
+        return properties
+
+    @staticmethod
+    def label (node):
+        """ The label a TRAPI node is stored with: its first category, as redis backends name it, e.g. biolink.Gene. """
+        categories = node.get ('categories') or node.get ('category') or ['biolink:NamedThing']
+        category = categories[0] if isinstance (categories, list) else categories
+        return "biolink." + title_case (snake_case (category.split (':')[-1]))
+
+    @staticmethod
+    def relationship_type (edge):
+        """ The relationship type a TRAPI edge is stored with: its predicate, as redis backends name it, e.g. biolink.treats. """
+        predicate = edge.get ('predicate') or 'biolink:related_to'
+        return "biolink." + snake_case (predicate.split (':')[-1])
+
+    def load_knowledge_graph (self, knowledge_graph, batch_size=None):
+        """
+        Bulk load a TRAPI knowledge graph. Nodes and edges are merged on their ids, batch_size at a time,
+        with one parameterized UNWIND query per batch, so loading a graph again updates it. Labels and
+        relationship types can't be parameters, so each batch has a single node label, or a single subject
+        label, predicate and object label. Edge endpoints that aren't in the knowledge graph, like nodes
+        of an earlier load, are matched by id alone. Edges whose endpoints aren't in the graph are skipped.
+        :return: The number of nodes loaded and of edges loaded.
+        """
+        batch_size = batch_size or self.batch_size
+        nodes = knowledge_graph.get ('nodes', {})
+        labels = {}
+        nodes_by_label = {}
+        for identifier, node in nodes.items ():
+            label = labels[identifier] = self.label (node)
+            nodes_by_label.setdefault (label, []).append ({
+                'id': identifier,
+                'properties': { **self.graph_properties (node, skip=('categories', 'category')), 'id': identifier }
+            })
+        for label, label_nodes in nodes_by_label.items ():
+            # Edges and later loads find nodes by id.
+            self.index (label, 'id')
+            self.query_batches (
+                f"UNWIND $batch AS node MERGE (n:`{label}` {{id: node.id}}) SET n += node.properties",
+                label_nodes, batch_size)
+
+        edges_by_type = {}
+        for identifier, edge in knowledge_graph.get ('edges', {}).items ():
+            subject_id, object_id = edge['subject'], edge['object']
+            key = (labels.get (subject_id), self.relationship_type (edge), labels.get (object_id))
+            edges_by_type.setdefault (key, []).append ({
+                'id': identifier,
+                'subject': subject_id,
+                'object': object_id,
+                'properties': { **self.graph_properties (edge, skip=('subject', 'object', 'predicate')), 'id': identifier }
+            })
+        def pattern (alias, label, identifier):
+            return f"({alias}:`{label}` {{id: {identifier}}})" if label else f"({alias} {{id: {identifier}}})"
+        edge_count = 0
+        for (subject_label, predicate, object_label), type_edges in edges_by_type.items ():
+            results = self.query_batches (
+                f"UNWIND $batch AS edge "
+                f"MATCH {pattern ('a', subject_label, 'edge.subject')}, {pattern ('b', object_label, 'edge.object')} "
+                f"MERGE (a)-[r:`{predicate}` {{id: edge.id}}]->(b) SET r += edge.properties "
+                f"RETURN count(r)",
+                type_edges, batch_size)
+            loaded = sum (result.result_set[0][0] for result in results)
+            if loaded < len(type_edges):
+                logger.warning (f"Skipped {len(type_edges) - loaded} of {len(type_edges)} {predicate} edges "
+                                f"whose subject or object isn't in the graph.")
+            edge_count += loaded
+        self.r.incr(self.version_key)
+        return len(nodes), edge_count
+
+    def index (self, label, property):
+        """ Index a property of the nodes with a label, if it isn't already. """
+        try:
+            self.redis_graph.query (f"CREATE INDEX ON :`{label}`({property})")
+        except ResponseError as e:
+            if 'already indexed' not in str(e).lower():
+                raise
+
+    def query_batches (self, query, rows, batch_size):
+        """ Run a query with each batch of rows as its $batch parameter, returning the result of each. """
+        return [ self.redis_graph.query (query, { 'batch': rows[start:start + batch_size] })
+                 for start in range(0, len(rows), batch_size) ]
 
     def query (self, query):
         """ Query and return result set. """
@@ -65,25 +177,28 @@ class RedisGraph:
     def delete (self):
         """ Delete the named graph. """
         self.redis_graph.delete()
+        self.nodes = {}
+        self.edges = {}
+        self.r.incr(self.version_key)
         
-def test ():
-    rg = RedisGraph ()
-    p = { 'a' : 4,
-          'b' : 'c',
-          'x' : 0 }
-    last = None
-    for x in range(0, 10000):
-        p['x'] = x + 1
-        node = rg.add_node (
-            label='yeah',
-            properties=copy.deepcopy (p))
-        if last is not None:
-            rg.add_edge (node, 'link', last)
-        last = node
-    rg.commit ()    
-    rg.query ("""MATCH (obj:yeah)-[:link]->(j:yeah) RETURN obj.a, obj.b, obj.x""")    
-    rg.query ("""MATCH (a) RETURN a""")
-    rg.delete ()
+def test (sizes=(10000, 100000, 1000000), host='localhost', port=6379, batch_size=10000):
+    """
+    Benchmark bulk loading against a local redis: load chains of each number of nodes and report nodes per second.
+    Loads into, then deletes, a graph named tranql_benchmark.
+    """
+    for size in sizes:
+        rg = RedisGraph (host=host, port=port, graph='tranql_benchmark', batch_size=batch_size)
+        knowledge_graph = {
+            'nodes': { f'TEST:{x}': { 'name': f'node {x}', 'categories': [ 'biolink:NamedThing' ],
+                                      'attributes': [ { 'name': 'x', 'value': x } ] } for x in range(size) },
+            'edges': { f'e{x}': { 'subject': f'TEST:{x + 1}', 'object': f'TEST:{x}', 'predicate': 'biolink:related_to' }
+                       for x in range(size - 1) }
+        }
+        start = time.time ()
+        node_count, edge_count = rg.load_knowledge_graph (knowledge_graph)
+        elapsed = time.time () - start
+        print (f"{node_count} nodes and {edge_count} edges in {elapsed:.2f}s: {node_count / elapsed:.0f} nodes/sec")
+        rg.delete ()
 
-#    rg.query ("""MATCH (a { id : 'chemical_substance' }) RETURN a""")
-#test ()
+if __name__ == "__main__":
+    test ()
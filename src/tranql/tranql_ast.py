@@ -1,4 +1,3 @@
-import asyncio
 import copy
 import json
 import logging
@@ -9,6 +8,8 @@ import time # Basic time profiling for async
 import yaml
 import importlib.machinery
 import os.path
+from collections import ChainMap, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from tranql.concept import ConceptModel
 from tranql.concept import BiolinkModelWalker
 from tranql.util import Concept
@@ -19,8 +20,9 @@ from tranql.exception import ServiceInvocationError
 from tranql.exception import UndefinedVariableError
 from tranql.exception import IllegalConceptIdentifierError
 from tranql.exception import UnknownServiceError
-from tranql.utils.merge_utils import merge_messages
-from PLATER.services.util.graph_adapter import GraphInterface
+from tranql.utils import provenance
+from tranql.utils.merge_utils import merge_messages, stream_merged_messages, merged_kgraph, join_results, top_results, calc_score_based_on_publications
+from tranql.tranql_schema import RedisBackendManager, RedisAnswerCache
 from redis.exceptions import ResponseError as RedisResponseError
 
 
@@ -224,7 +226,12 @@ class SetStatement(Statement):
         return result
 
 class CreateGraphStatement(Statement):
-    """ Create a graph, sending it to a sink. """
+    """
+    Create a graph, sending it to a sink. The sink is a service the graph is posted to, a redis graph,
+    `redis:<graph name>`, or a JSON file, `file:<path>`.
+    Redis and file sinks are off unless configured: CREATE_GRAPH_REDIS_PREFIX is the prefix graph names
+    must start with, and CREATE_GRAPH_FILE_DIRECTORY the directory paths are relative to.
+    """
     def __init__(self, graph, service, name):
         """ Construct a graph creation statement. """
         self.graph = graph
@@ -232,11 +239,77 @@ class CreateGraphStatement(Statement):
         self.name = name
     def __repr__(self):
         return f"CREATE GRAPH {self.graph} AT {self.service} AS {self.name}"
-    def execute (self, interpreter):
+    @staticmethod
+    def knowledge_graph (graph):
+        """ The knowledge graph of a response, message or knowledge graph. """
+        graph = graph.get ('message', graph)
+        return graph.get ('knowledge_graph', graph)
+    @staticmethod
+    def with_knowledge_graph (graph, knowledge_graph):
+        """ A copy of a response, message or knowledge graph with its knowledge graph replaced. """
+        if 'message' in graph:
+            return { **graph, 'message': CreateGraphStatement.with_knowledge_graph (graph['message'], knowledge_graph) }
+        if 'knowledge_graph' in graph:
+            return { **graph, 'knowledge_graph': knowledge_graph }
+        return knowledge_graph
+    def write_redis (self, interpreter, graph_name, knowledge_graph):
+        """ Bulk load the knowledge graph into a graph of the redis backend configured in the schema. """
+        # Only needed for this sink.
+        from tranql.redis_graph import RedisGraph
+        prefix = interpreter.config.get ('CREATE_GRAPH_REDIS_PREFIX', '')
+        if not prefix:
+            raise ServiceInvocationError ("Creating redis graphs is disabled. Set CREATE_GRAPH_REDIS_PREFIX to enable it.")
+        if not graph_name.startswith (prefix) or graph_name == prefix:
+            raise ServiceInvocationError (f"Redis graph {graph_name} can't be created: graph names must start with {prefix}.")
+        all_schemas = interpreter.schema.config['schema']
+        redis_keys = [ key for key in all_schemas if all_schemas[key].get ('redis', False) ]
+        if not redis_keys:
+            raise UnknownServiceError (f"No redis backend is configured to create graph {graph_name} in.")
+        connection_params = all_schemas[redis_keys[0]]['redis_connection_params']
+        redis_graph = RedisGraph (
+            host=connection_params.get ('host', 'localhost'),
+            port=connection_params.get ('port', 6379),
+            password=interpreter.config.get (redis_keys[0].upper () + '_PASSWORD', '') or None,
+            graph=graph_name,
+            version_key=interpreter.config.get ('REDIS_GRAPH_VERSION_KEY', '{graph}:version'),
+            batch_size=int(interpreter.config.get ('REDIS_LOAD_BATCH_SIZE', 10000)))
+        return redis_graph.load_knowledge_graph (knowledge_graph)
+    @staticmethod
+    def file_path (interpreter, target):
+        """ The path a file sink writes to, which has to be inside CREATE_GRAPH_FILE_DIRECTORY. """
+        directory = interpreter.config.get ('CREATE_GRAPH_FILE_DIRECTORY', '')
+        if not directory:
+            raise ServiceInvocationError ("Creating graphs in files is disabled. Set CREATE_GRAPH_FILE_DIRECTORY to enable it.")
+        directory = os.path.realpath (directory)
+        # Symbolic links are resolved too, so none can lead out of the directory.
+        path = os.path.realpath (os.path.join (directory, target))
+        if '..' in target.replace ('\\', '/').split ('/') or path == directory or \
+                os.path.commonpath ([ directory, path ]) != directory:
+            raise ServiceInvocationError (f"Graph file {target} can't be created: files must be inside {directory}.")
+        return path
+    def write_file (self, interpreter, target, knowledge_graph):
+        """ Write the knowledge graph to a JSON file. It's encoded as it's written, and replaces the file once complete. """
+        path = self.file_path (interpreter, target)
+        temp_path = f"{path}.{os.getpid ()}.tmp"
+        with open (temp_path, 'w') as stream:
+            json.dump (knowledge_graph, stream)
+        os.replace (temp_path, path)
+        return len (knowledge_graph.get ('nodes', {})), len (knowledge_graph.get ('edges', {}))
+    def execute (self, interpreter, context={}):
         """ Execute the statement. """
+        graph = interpreter.context.resolve_arg (self.graph)
+        # The graph leaves TranQL here, so reasoner provenance is written as attributes. Statements
+        # after this one may use the graph too, so a copy is expanded.
+        knowledge_graph = provenance.expanded_knowledge_graph (self.knowledge_graph (graph))
+        graph = self.with_knowledge_graph (graph, knowledge_graph)
+        for scheme, write in (('redis:', self.write_redis), ('file:', self.write_file)):
+            if self.service.startswith (scheme):
+                node_count, edge_count = write (interpreter, self.service[len(scheme):], knowledge_graph)
+                response = { 'graph': self.service, 'nodes': node_count, 'edges': edge_count }
+                interpreter.context.set (self.name, response)
+                return response
         self.service = self.resolve_backplane_url(self.service,
                                                   interpreter)
-        graph = interpreter.context.resolve_arg (self.graph)
         logger.debug (f"------- {type(graph).__name__}")
         logger.debug (f"--- create graph {self.service} graph-> {json.dumps(graph, indent=2)}")
         response = None
@@ -252,18 +325,24 @@ class SelectStatement(Statement):
     Model a select statement.
     This entails all capabilities from specifying a knowledge path, service to invoke, constraints, and handoff.
     """
+    # Answers of redis graphs, shared by every select statement. See redis_answer_cache.
+    _redis_answers = None
+
     def __init__(self, ast, service=None):
         """ Initialize a new select statement. """
         self.ast = ast
         self.query = Query ()
         self.service = service
         self.where = []
+        # LIMIT clause: keep at most `limit` answers, ordered by `order_by` if given.
+        self.limit = None
+        self.order_by = None
         self.set_statements = []
         self.jsonkit = JSONKit ()
         self.planner = QueryPlanStrategy (ast.schema)
 
     def __repr__(self):
-        return f"SELECT {self.query} from:{self.service} where:{self.where} set:{self.set_statements}"
+        return f"SELECT {self.query} from:{self.service} where:{self.where} limit:{self.limit} set:{self.set_statements}"
 
     def edge(self, source, target, type_name=None):
         """ Generate a question edge. """
@@ -369,51 +448,73 @@ class SelectStatement(Statement):
                 return bound
         return False
 
+    @staticmethod
+    def plan_concepts(steps):
+        """ Concepts touched by the steps of a plan segment, in path order. """
+        concepts = []
+        for subj, pred, obj in steps:
+            if not concepts:
+                concepts.append(subj)
+            concepts.append(obj)
+        return concepts
+
+    @staticmethod
+    def plan_key(steps):
+        """ Segments answering the same path (from different schemas) share a key. """
+        return tuple((subj.name, pred.direction, pred.predicate, obj.name) for subj, pred, obj in steps)
+
     def sort_plan(self, plan):
-        # sort the plan such that statements with bound curies are executed first
-        sorted_plan = []
-        is_bound = False
-        start = None
-        # find a bound plan
-        for p in plan:
-            start = p[2]
-            # is bound if the start  or the end of the plan is bound
-            is_bound = len(start[0][0].curies) or len(start[-1][2].curies)
-            if is_bound:
-                break
-        if is_bound:
-            # find plans bound to the same concept that add them as starting queries
-            for other_plan in plan:
-                bound_concept = start[0][0] if len(start[0][0].curies) else start[-1][2]
-                if bound_concept.name == other_plan[2][0][0].name or bound_concept.name == other_plan[2][-1][2].name:
-                    sorted_plan.append(other_plan)
-            # add other bound / unbound plans in a sequence that preserves
-            # connectivity
-            while len(sorted_plan) != len(plan):
-                for p in [x for x in plan if x not in sorted_plan]:
-                    is_connected = False
-                    for processed_plan in sorted_plan:
-                        # find any statement already added that ensures connectivity
-                        all_node_names = []
-                        for x in processed_plan[2]:
-                            for item in x:
-                                if isinstance(item, Concept):
-                                    all_node_names.append(item.name)
-                        is_connected = p[2][-1][2].name in all_node_names or \
-                                       p[2][0][0].name in all_node_names
-                        if is_connected:
-                            break
-                    if is_connected:
-                        connected_plan = p
-                        # add other plans that match this pattern as next
-                        for other_plans in plan:
-                            if other_plans[2] == connected_plan[2]:
-                                sorted_plan.append(other_plans)
-                        # break for loop since we changed list and while loop will resume
-                        break
-        else:
+        """
+        Order plan segments so that those touching bound concepts run first and every
+        following segment shares a concept with one that ran before it.
+
+        Segments are grouped by the path they answer and a concept -> segment index is
+        built once. Groups are then visited breadth first starting from the bound
+        concepts, so ordering is linear in the size of the plan. Disconnected components
+        are appended in their original order, each starting from its first segment.
+        """
+        groups = {}
+        for phase in plan:
+            groups.setdefault(self.plan_key(phase[2]), []).append(phase)
+        group_keys = list(groups.keys())
+
+        concept_groups = {}
+        bound_concepts = []
+        for key in group_keys:
+            for concept in self.plan_concepts(groups[key][0][2]):
+                concept_groups.setdefault(concept.name, []).append(key)
+                if len(concept.curies) and concept.name not in bound_concepts:
+                    bound_concepts.append(concept.name)
+
+        if not bound_concepts:
             # we don't have any bound nodes so continue executing as previous
-            sorted_plan = plan
+            return plan
+
+        sorted_plan = []
+        visited_groups = set()
+        visited_concepts = set(bound_concepts)
+        queue = deque(bound_concepts)
+
+        def visit(key):
+            visited_groups.add(key)
+            sorted_plan.extend(groups[key])
+            for concept in self.plan_concepts(groups[key][0][2]):
+                if concept.name not in visited_concepts:
+                    visited_concepts.add(concept.name)
+                    queue.append(concept.name)
+
+        def walk():
+            while queue:
+                for key in concept_groups[queue.popleft()]:
+                    if key not in visited_groups:
+                        visit(key)
+
+        walk()
+        for key in group_keys:
+            if key not in visited_groups:
+                # start of a component without bound concepts
+                visit(key)
+                walk()
         return sorted_plan
 
     def plan (self, plan):
@@ -437,6 +538,9 @@ class SelectStatement(Statement):
                     """ If this is the last concept, add the object as well. """
                     statement.query.add (obj)
                 statement.where = self.where
+        if len(statements) == 1 and self.order_by is None:
+            """ A single segment answers the whole query, so any n of its answers will do. """
+            statements[0].limit = self.limit
         self.query.disable = True # = Query ()
         return statements
 
@@ -466,8 +570,23 @@ class SelectStatement(Statement):
                 So interpret it as an option to the underlying service.
                 """
                 options[name] = constraint[1:]
+        if self.limit is not None and self.order_by is None and 'limit' not in options:
+            """ Services can't rank answers by our score, so only an unordered limit is pushed down. """
+            options['limit'] = ['=', self.limit]
         return options
 
+    @staticmethod
+    def edge_id (index, source, edge_spec, target):
+        """
+        The query graph id, subject and object of the edge an arrow of the query draws to its
+        `index`th concept.
+        """
+        if edge_spec.direction == Query.forward_arrow:
+            subject, object = source, target
+        else:
+            subject, object = target, source
+        return f'e{index}_{subject}_{object}', subject, object
+
     def generate_questions(self, interpreter):
         """
         Given an archetype question graph and values, generate question
@@ -481,7 +600,8 @@ class SelectStatement(Statement):
         for index, concept_query_id in enumerate(self.query.order):
             """ Expand and filter nodes. """
             concept = self.query[concept_query_id]
-            if len(concept.curies) > 0:
+            # concepts shared by several paths are only expanded once.
+            if len(concept.curies) > 0 and concept.name not in nodes:
                 self.expand_nodes (interpreter, concept)
                 logger.debug(f"concept--nodes: {concept.curies}")
                 filters = interpreter.context.resolve_arg ('$id_filters')
@@ -503,13 +623,10 @@ class SelectStatement(Statement):
             # add edges
             last_node_name = self.query.order[index -1]
             edge_spec = self.query.arrows[index - 1]
-            if edge_spec.direction == self.query.forward_arrow:
-                subject = last_node_name
-                object = concept_query_id
-            else:
-                subject = concept_query_id
-                object = last_node_name
-            edge_id = f'e{index}_{subject}_{object}'
+            if edge_spec is None:
+                # first concept of another path in a branching query.
+                continue
+            edge_id, subject, object = self.edge_id (index, last_node_name, edge_spec, concept_query_id)
             predicate = edge_spec.predicate
             query_graph_edge = self.edge(
                 source=subject,
@@ -535,15 +652,23 @@ class SelectStatement(Statement):
     """
     @staticmethod
     def decorate_result(response, options={}):
+        # The reasoners may be named by an API client, so they are added without registering them.
+        SelectStatement.mark_result(response)
+        provenance.expand_message(response, SelectStatement.reasoner_names(options))
+
+    @staticmethod
+    def mark_result(response, options={}):
+        """ Like decorate_result, but record the reasoners as a mask over the schema registry, expanded once the answer leaves the statement. """
         if 'knowledge_graph' in response:
+            mask = SelectStatement.provenance_mask(options)
             nodes = response['knowledge_graph'].get('nodes', {})
             edges = response['knowledge_graph'].get('edges', {})
             for node_id in nodes:
                 nodes[node_id]['id'] = node_id
-                SelectStatement.decorate(nodes[node_id], True, options)
+                provenance.mark(nodes[node_id], mask)
             for edge_id in edges:
                 edges[edge_id]['id'] = edge_id
-                SelectStatement.decorate(edges[edge_id], False, options)
+                provenance.mark(edges[edge_id], mask)
     """
     Decorates a list of result messages
 
@@ -560,6 +685,7 @@ class SelectStatement(Statement):
     """
     Decorates a KGraph element
 
+
     Args:
         element (dict) - KGS 0.1.0 KNode|KEdge object.
         is_node (bool) - Specifies if the element is a KNode. If False, `element` is treated as a KEdge.
@@ -573,32 +699,23 @@ class SelectStatement(Statement):
     """
     @staticmethod
     def decorate(element, is_node, options):
-        attributes = element.get('attributes', {})
-        has_reasoner_attribute = False
-        schema = []
-        if "schema" in options:
-            # Convert schema to list
-            if isinstance(options["schema"], str): options["schema"] = [options["schema"]]
-            schema = options["schema"]
-
-        for attribute in attributes:
-            if attribute.get('name') == 'reasoner':
-                has_reasoner_attribute = True
-                attribute['value'] = attribute.get('value', [])
-                attribute['value'] = attribute['value'] if isinstance(attribute['value'], list) else [attribute['value']]
-                attribute['value'] += schema
-                attribute['value'] = list(set(attribute['value']))
-                attribute['type'] = 'EDAM:data_0006'
-        if not has_reasoner_attribute:
-            element['attributes'] = element.get('attributes', [])
-            element['attributes'].append({
-                'name': 'reasoner',
-                'value': schema,
-                'type': 'EDAM:data_0006'
-            })
+        provenance.mark(element, 0)
+        provenance.expand(element, SelectStatement.reasoner_names(options))
         # Add Source database
         # @TODO properly add edge source if not provided
 
+    @staticmethod
+    def reasoner_names(options):
+        """ The reasoners named by the `schema` decoration option. """
+        schema = options.get("schema", [])
+        if isinstance(schema, str): schema = [schema]
+        return schema
+
+    @staticmethod
+    def provenance_mask(options):
+        """ The provenance mask of the reasoners named by the `schema` decoration option. """
+        return provenance.registry.mask(SelectStatement.reasoner_names(options))
+
     def get_schema_name(self,interpreter):
         schema = None
         for s in self.planner.schema.config["schema"]:
@@ -611,7 +728,17 @@ class SelectStatement(Statement):
                 break
         return schema
 
-    def query_redis (self, redis_connection_params, question, timeout=None):
+    def query_redis (self, redis_connection_params, question, timeout=None, page_size=0, max_parallel_pages=1, errors=None,
+                     cache=None):
+        """
+        Answer a question with a redis graph.
+        :param page_size: If set, an answer that may hold more results than this is fetched in windows of page_size
+            results using skip and limit, max_parallel_pages at a time. Each page has the whole timeout.
+        :param errors: Pages that time out are recorded here, and the answer is made of the other pages.
+            Without it, a page that times out fails the query.
+        :param cache: A RedisAnswerCache. Questions already answered by the version of the graph that is loaded
+            are answered from it without querying the graph.
+        """
 
         if timeout:
             try:
@@ -621,9 +748,7 @@ class SelectStatement(Statement):
         else:
             timeout = 0
 
-        graph_interface: GraphInterface = GraphInterface(
-                **redis_connection_params
-            )
+        graph_interface = RedisBackendManager.get_interface(redis_connection_params)
         options = question.get('options', {})
         limit = options.get('limit', [])
         skip = options.get('skip', [])
@@ -635,19 +760,122 @@ class SelectStatement(Statement):
             cypher_query_options['skip'] = skip[-1]
         if max_connections:
             cypher_query_options['max_connectivity'] = max_connections[-1]
-        answer = asyncio.run(
-            graph_interface.answer_trapi_question(question['message']['query_graph'],
-                                                  options=cypher_query_options,
-                                                  timeout=timeout))
+
+        cache_key = None
+        if cache is not None:
+            version = RedisBackendManager.graph_version(redis_connection_params, cache.version_key)
+            if version is not None:
+                cache_key = cache.key(redis_connection_params, version, question['message']['query_graph'], cypher_query_options)
+                answer = cache.get(cache_key)
+                if answer is not None:
+                    return {'message': answer}
+
+        error_count = len(errors) if errors is not None else 0
+        if page_size and not (limit and int(limit[-1]) <= page_size):
+            answer = self.query_redis_pages(graph_interface, question['message']['query_graph'], cypher_query_options,
+                                            timeout, page_size, max_parallel_pages, errors)
+        else:
+            answer = RedisBackendManager.run(
+                graph_interface.answer_trapi_question(question['message']['query_graph'],
+                                                      options=cypher_query_options,
+                                                      timeout=timeout))
+        # Answers missing pages that timed out aren't kept.
+        if cache_key is not None and (errors is None or len(errors) == error_count):
+            cache.put(cache_key, answer)
         response = {'message': answer}
         return response
 
+    @staticmethod
+    def redis_answer_cache (config):
+        """
+        The answer cache shared by redis queries, None if REDIS_CACHE_SIZE is 0, which it is by default.
+        Only graphs whose loader keeps a version marker are cached.
+        """
+        size = int(config.get('REDIS_CACHE_SIZE', 0))
+        if not size:
+            return None
+        if SelectStatement._redis_answers is None:
+            SelectStatement._redis_answers = RedisAnswerCache(size=size,
+                                                              ttl=float(config.get('REDIS_CACHE_TTL', 60*60)),
+                                                              version_key=config.get('REDIS_GRAPH_VERSION_KEY', '{graph}:version'))
+        return SelectStatement._redis_answers
+
+    @staticmethod
+    def query_redis_pages (graph_interface, query_graph, cypher_query_options, timeout, page_size, max_parallel_pages, errors=None):
+        """
+        Fetch an answer in pages of page_size results. The first page is fetched alone, so that answers that fit
+        in one page cost one query; after a full first page, windows of max_parallel_pages queries run at once.
+        Pages are merged into the answer in order as they arrive. Paging stops at the first page with fewer
+        results than were asked for, or once the question's own limit is reached.
+        """
+        start = int(cypher_query_options.get('skip', 0))
+        end = start + int(cypher_query_options['limit']) if 'limit' in cypher_query_options else None
+        answer = None
+        timed_out = None
+        next_skip = start
+        done = False
+        while not done and (end is None or next_skip < end):
+            window = []
+            window_size = 1 if next_skip == start else max(max_parallel_pages, 1)
+            while len(window) < window_size and (end is None or next_skip < end):
+                page_limit = page_size if end is None else min(page_size, end - next_skip)
+                page_options = { **cypher_query_options, 'skip': next_skip, 'limit': page_limit }
+                window.append ((next_skip, page_limit, RedisBackendManager.submit(
+                    graph_interface.answer_trapi_question(query_graph, options=page_options, timeout=timeout))))
+                next_skip += page_limit
+            answered = False
+            for page_skip, page_limit, future in window:
+                try:
+                    page = future.result ()
+                except RedisResponseError as e:
+                    if errors is None or str(e).lower() != 'query timed out':
+                        raise
+                    timed_out = e
+                    errors.append (f"Redis page of {page_limit} results from {page_skip} timed out after {timeout} milliseconds "
+                                   f"and was left out of the answer.")
+                    continue
+                answered = True
+                if answer is None:
+                    answer = page
+                else:
+                    knowledge_graph = page.get('knowledge_graph', {})
+                    answer['knowledge_graph']['nodes'].update (knowledge_graph.get('nodes', {}))
+                    answer['knowledge_graph']['edges'].update (knowledge_graph.get('edges', {}))
+                    answer['results'].extend (page.get('results', []))
+                if len(page.get('results', [])) < page_limit:
+                    done = True
+            if not answered:
+                # Nothing in this window could be read, so there's no telling where the answer ends.
+                break
+        if answer is None:
+            if timed_out:
+                # No page was answered at all; fail like an unpaged query would.
+                raise timed_out
+            answer = { 'query_graph': query_graph, 'knowledge_graph': { 'nodes': {}, 'edges': {} }, 'results': [] }
+        return answer
+
     def execute (self, interpreter, context={}):
         """
         Execute all statements in the abstract syntax tree.
         - Generate questions by permuting bound values.
         - Resolve the service name.
         - Execute the questions.
+        The answer leaves the statement here, so its reasoner provenance is expanded to attributes
+        before it is stored in the context or handed to set statements.
+        """
+        response = self.answer (interpreter)
+        provenance.expand_response (response)
+        interpreter.context.set('result', response)
+        """ Execute set statements associated with this statement. """
+        for set_statement in self.set_statements:
+            logger.debug (f"{set_statement}")
+            set_statement.execute (interpreter, context = { "result" : response })
+        return response
+
+    def answer (self, interpreter):
+        """
+        Answer the statement's question, keeping the reasoner provenance of knowledge graph elements
+        as masks, so answers to plan segments and paths merge cheaply.
         """
         all_schemas = interpreter.schema.config['schema']
         redis_key = [
@@ -656,21 +884,23 @@ class SelectStatement(Statement):
         ]
         if len(redis_key):
             redis_key = redis_key[0]
-            redis_connection_details = all_schemas[redis_key]['redis_connection_params']
             service_name, graph_name = self.service.split(':')
-            redis_connection_details.update(
-                {
-                    'auth': ('', interpreter.config.get(service_name.upper() +'_PASSWORD','')),
-                    'db_name': graph_name,
-                    'db_type': 'redis',
-                }
+            redis_connection_details = RedisBackendManager.connection_params(
+                all_schemas[redis_key]['redis_connection_params'],
+                password=interpreter.config.get(service_name.upper() +'_PASSWORD',''),
+                graph_name=graph_name
             )
             question = self.generate_questions(interpreter)
             timeout = interpreter.config.get('REDIS_QUERY_TIMEOUT')
+            page_errors = []
             try:
                 response = self.query_redis(redis_connection_params=redis_connection_details,
                                             question=question,
-                                            timeout=timeout)
+                                            timeout=timeout,
+                                            page_size=int(interpreter.config.get('REDIS_PAGE_SIZE', 0)),
+                                            max_parallel_pages=int(interpreter.config.get('REDIS_MAX_PARALLEL_PAGES', 4)),
+                                            errors=page_errors,
+                                            cache=self.redis_answer_cache(interpreter.config))
             except RedisResponseError as e:
                 if str(e).lower() == 'query timed out':
                     error = f"Running Query on redis timed out after {timeout} milliseconds. " \
@@ -679,10 +909,13 @@ class SelectStatement(Statement):
                 else:
                     error = f"Redis Error: `{e}`"
                 raise Exception(error)
+            if page_errors:
+                interpreter.context.mem.setdefault('requestErrors', []).extend(page_errors)
             # Adds source db as reasoner attr in nodes and edges.
-            self.decorate_result(response['message'], {
+            self.mark_result(response['message'], {
                 "schema": self.service
             })
+            self.limit_results (response)
         elif self.service == "/schema":
             response = self.execute_plan (interpreter)
         else:
@@ -748,67 +981,93 @@ class SelectStatement(Statement):
                     f"No valid results from {self.service} with query {self.query}"
                 ))
             else:
-                self.decorate_result(response['message'], {
+                self.mark_result(response['message'], {
                     "schema" : self.get_schema_name(interpreter)
                 })
+                self.limit_results (response)
             # result = self.merge_results (responses, interpreter, root_question_graph, self.query.order)
-        interpreter.context.set('result', response)
-        """ Execute set statements associated with this statement. """
-        for set_statement in self.set_statements:
-            logger.debug (f"{set_statement}")
-            set_statement.execute (interpreter, context = { "result" : response })
         return response
 
+    def limit_results (self, response):
+        """ Keep the best scored answers of a response if a limit was given. """
+        if self.limit is not None:
+            response['message'] = top_results (calc_score_based_on_publications (response['message']),
+                                               self.limit)
+        return response
+
+    @staticmethod
+    def handoff_curies (messages, concept):
+        """
+        Distinct ids bound to a concept in the results of messages, in the order they were
+        first seen and filtered by the concept's include and exclude patterns.
+        :param messages: TRAPI messages answering a previous plan segment.
+        :param concept: The concept being handed off to the next segment.
+        :return: list of curies
+        """
+        seen = set ()
+        curies = []
+        for message in messages:
+            for result in message.get('results') or []:
+                node_bindings = result.get('node_bindings') or {}
+                for binding in node_bindings.get(concept.name, []):
+                    curie = binding['id']
+                    if curie not in seen:
+                        seen.add (curie)
+                        curies.append (curie)
+        return concept.filter_curies (curies)
+
     def execute_plan (self, interpreter):
         """ Execute a query using a schema based query planning strategy. """
+        if len(self.query.paths ()) > 1:
+            return self.execute_branches (interpreter)
         self.service = ''
         plan = self.planner.plan (self.query)
         statements = self.plan (plan)
         responses = []
-        duplicate_statements = []
-        first_concept = None
+        # The responses of the segments executed so far that bind each concept.
+        binding_responses = defaultdict(list)
 
         # Generate the root statement's question graph
         root_question_graph = self.generate_questions(interpreter)['message']['query_graph']
 
         for index, statement in enumerate(statements):
+            if index > 0:
+                # Implement handoff. Segments are sorted breadth first, so the segment binding a
+                # concept of this one may be any earlier segment, not just the previous one. Values
+                # for the first concept this segment shares with any earlier one are looked up in the
+                # answer bindings of every response binding it. TODO: incorporate user specified names.
+                previous = statements[index - 1]
+                if previous.query.order == statement.query.order:
+                    # The same segment sent to another reasoner asks the same question.
+                    name = statement.query.order[0]
+                    statement.query.concepts[name].set_curies (previous.query.concepts[name].curies)
+                else:
+                    shared = [ name for name in statement.query.order if name in binding_responses ]
+                    if shared:
+                        name = shared[0]
+                        concept = statement.query.concepts[name]
+                        handoff = binding_responses[name]
+                        values = self.handoff_curies ([ r.get('message', {}) for r in handoff ], concept)
+                        if len(values) == 0:
+                            tried_kps = [ r['service'] for r in handoff ]
+                            message = f"No valid results from service { ','.join(tried_kps) } binding " + \
+                                      f"{name} for query {statement.query}. Unable to continue query. Exiting."
+                            raise ServiceInvocationError (
+                                message = message,
+                                details = Text.short (obj=f"{json.dumps(handoff[-1], indent=2)}", limit=1000))
+                        # values are already flat and filtered.
+                        concept.curies = values
+                    # else the segment starts a disconnected component; nothing to hand off.
             logger.debug (f" -- {statement.query}")
-            response = statement.execute (interpreter)
+            response = statement.answer (interpreter)
             response['question_order'] = statement.query.order
             response['service'] = statement.get_schema_name(interpreter)
             responses.append (response)
-            duplicate_statements.append (response)
-            if index < len(statements) - 1:
-                """ Implement handoff. Finds the type name of the first element of the
-                next plan segment, looks up values for that type from the answer bindings of the
-                last response, and transfers values to the new question. TODO: incorporate
-                user specified names. """
-                next_statement = statements[index+1]
-                if statements[index].query.order == next_statement.query.order:
-                    name = next_statement.query.order[0]
-                    first_concept = next_statement.query.concepts[name]
-                    first_concept.set_curies (statements[index].query.concepts[name].curies)
-                else:
-                    name = [name for name in statements[index].query.order if name in next_statement.query.order][0]
-                    first_concept = next_statement.query.concepts[name]
-                    values = self.jsonkit.select(f"$.knowledge_map.[*].[*].node_bindings.{name}",
-                                                  self.merge_results(duplicate_statements,
-                                                                     interpreter,
-                                                                     root_question_graph,
-                                                                     statements[index].query.order)
-                                                  )
-                    tried_kps = list(map(lambda x: x['service'], duplicate_statements))
-                    if len(values) == 0:
-                        message = f"No valid results from service { ','.join(tried_kps) } executing " + \
-                                  f"query {statement.query}. Unable to continue query. Exiting."
-                        raise ServiceInvocationError (
-                            message = message,
-                            details = Text.short (obj=f"{json.dumps(response, indent=2)}", limit=1000))
-                    duplicate_statements = []
-                    first_concept.set_curies(values)
+            for name in statement.query.order:
+                binding_responses[name].append (response)
 
         # merge the responses from backend calls.
-        merged = self.merge_results (responses)
+        merged = self.merge_results (responses, self.limit, interpreter.config)
 
         # Although Merge above would merge question graphs , in cases where no results are returned
         # we'd still want The root question here as the initial question
@@ -816,8 +1075,139 @@ class SelectStatement(Statement):
         return merged
 
     @staticmethod
-    def merge_results (responses):
-        return {"message": merge_messages([response["message"] for response in responses])}
+    def branch_interpreter (interpreter):
+        """
+        A view of the interpreter for one of concurrently executed paths. Its context reads through to the
+        interpreter's, but the request errors and values it sets are its own, so paths neither reset nor
+        mix up each other's errors.
+        """
+        branch = copy.copy (interpreter)
+        branch.context = copy.copy (interpreter.context)
+        branch.context.mem = ChainMap ({ 'requestErrors': [] }, interpreter.context.mem)
+        return branch
+
+    def execute_branches (self, interpreter):
+        """
+        Execute a branching query. Each comma separated path is planned and executed as its own
+        select statement. Paths sharing a bound concept are sent concurrently; the others wait until
+        a concept they share has been bound by an earlier path. Answers are hash joined on the
+        shared concepts.
+        """
+        self.service = ''
+        root_question_graph = self.generate_questions(interpreter)['message']['query_graph']
+        pending = []
+        # the root query graph's ids for the edges of each path, keyed by their id within the path.
+        edge_ids = {}
+        offset = 0
+        for path in self.query.paths ():
+            statement = SelectStatement (ast=self.ast, service="/schema")
+            statement.query = path
+            # each path formats its own copy of the constraints.
+            statement.where = list(self.where)
+            pending.append (statement)
+            edge_ids[statement] = {
+                self.edge_id (index, source, edge_spec, target)[0]: \
+                    self.edge_id (offset + index, source, edge_spec, target)[0]
+                for index, source, edge_spec, target in path.edges ()
+            }
+            offset += len(path.order)
+
+        # Cap concurrent paths so that we don't flood the services.
+        maximumParallelBranches = int(interpreter.config.get('MAX_PARALLEL_BRANCHES', 4))
+        bound = { name for name, concept in self.query.concepts.items () if len(concept.curies) }
+        joined_names = set ()
+        results = []
+        messages = []
+        while pending:
+            ready = [ statement for statement in pending if bound & set(statement.query.order) ]
+            if not ready:
+                # Nothing to hand off from, run the next path unconstrained.
+                ready = pending[:1]
+            pending = [ statement for statement in pending if statement not in ready ]
+            for statement in ready:
+                for name in statement.query.order:
+                    concept = statement.query[name]
+                    if name in joined_names and not concept.curies:
+                        concept.curies = self.handoff_curies ([{ "results": results }], concept)
+            logger.debug (f"executing paths {[ statement.query.order for statement in ready ]}")
+            branches = [ self.branch_interpreter (interpreter) for statement in ready ]
+            with ThreadPoolExecutor (max_workers=min(len(ready), maximumParallelBranches)) as executor:
+                responses = list(executor.map(lambda statement, branch: statement.answer (branch), ready, branches))
+            request_errors = interpreter.context.mem.setdefault ('requestErrors', [])
+            for branch in branches:
+                request_errors.extend (branch.context.mem['requestErrors'])
+            for statement, response in zip(ready, responses):
+                message = response['message']
+                messages.append (message)
+                shared = [ name for name in statement.query.order if name in joined_names ]
+                path_results = self.root_edge_bindings (message.get('results') or [], edge_ids[statement])
+                results = join_results (results, path_results, shared)
+                joined_names.update (statement.query.order)
+                bound.update (statement.query.order)
+            if pending and not results:
+                raise ServiceInvocationError (
+                    message=f"No valid results executing paths {[ statement.query.order for statement in ready ]}. " + \
+                            f"Unable to continue query. Exiting.")
+
+        knowledge_graph, kgraph = merged_kgraph ([ m['knowledge_graph'] for m in messages if m.get('knowledge_graph') ],
+                                                 **self.merge_options (interpreter.config))
+        merged = {
+            "query_graph": root_question_graph,
+            "knowledge_graph": knowledge_graph,
+            "results": results
+        }
+        merged = calc_score_based_on_publications (merged, kgraph)
+        if self.limit is not None:
+            # the joined answers are limited, not those of each path.
+            merged = top_results (merged, self.limit)
+        return { "message": merged }
+
+    @staticmethod
+    def root_edge_bindings (results, edge_ids):
+        """
+        Copies of a path's results with their edge bindings keyed by the root query graph's edge ids,
+        so the bindings of several paths neither clash when joined nor miss the merged query graph.
+        :param results: results answering the path.
+        :param edge_ids: root query graph edge ids keyed by the path's own edge ids.
+        :return: list of results
+        """
+        return [
+            { **result,
+              'edge_bindings': { edge_ids.get (key, key): bindings
+                                 for key, bindings in (result.get('edge_bindings') or {}).items () } }
+            for result in results
+        ]
+
+    @staticmethod
+    def merge_options (config):
+        """
+        How to merge knowledge graphs: on disk in MERGE_SPILL_DIRECTORY once they hold MERGE_SPILL_THRESHOLD_BYTES
+        of JSON, else in MERGE_PROCESSES processes, one per CPU if 0, once they hold MERGE_PARALLEL_THRESHOLD_BYTES.
+        """
+        return {
+            "spill_threshold": int(config.get('MERGE_SPILL_THRESHOLD_BYTES', 268435456)),
+            "spill_directory": config.get('MERGE_SPILL_DIRECTORY') or None,
+            "processes": int(config.get('MERGE_PROCESSES', 0)) or os.cpu_count () or 1,
+            "parallel_threshold": int(config.get('MERGE_PARALLEL_THRESHOLD_BYTES', 33554432))
+        }
+
+    @staticmethod
+    def merge_results (responses, limit=None, config={}):
+        """ Merge responses, as merge_options says. """
+        return {"message": merge_messages([response["message"] for response in responses], limit,
+                                          **SelectStatement.merge_options (config))}
+
+    @staticmethod
+    def stream_merged_results (responses, limit=None, config={}):
+        """
+        Merge responses like merge_results, as chunks of the response's JSON. A knowledge graph merged on disk
+        isn't read back into memory. Responses are merged by the time the first chunk is made.
+        """
+        chunks = stream_merged_messages([response["message"] for response in responses], limit,
+                                        **SelectStatement.merge_options (config))
+        yield '{"message": ' + next(chunks)
+        yield from chunks
+        yield '}'
 
 
 class TranQL_AST:
@@ -900,6 +1290,11 @@ class TranQL_AST:
 
                             else:
                                 select.where.append ([ var, op, val ])
+                elif command == 'limit':
+                    select.limit = e[1]
+                    if len(e) > 2:
+                        """ limit n order by score """
+                        select.order_by = e[-1]
                 elif command == 'set':
                     element = e[1]
                     if len(element) == 3:
@@ -928,15 +1323,19 @@ class Edge:
 
 class Query:
     """ Model a query.
+    A query is one or more comma separated paths. Concepts repeated by name across
+    paths are the same node, which allows branching and star shaped graphs. In `arrows`
+    a None entry marks the start of a new path.
     TODO:
        - Model queries with arrows in both diretions.
        - Model predicates
-       - Model arbitrary shaped graphs.
     """
 
     """ Arrows in the query. """
     back_arrow = "<-"
     forward_arrow = "->"
+    """ Separates paths of a branching query. """
+    path_separator = ","
 
     """ The biolink model. Will use for query validation. """
     concept_model = ConceptModel ("biolink-model")
@@ -953,6 +1352,9 @@ class Query:
         if key == self.forward_arrow or key == self.back_arrow:
             """ It's a forward arrow, no predicate. """
             self.arrows.append (Edge(direction=key))
+        elif key == self.path_separator:
+            """ The next concept starts another path. """
+            self.arrows.append (None)
         elif isinstance (key, Concept):
             self.order.append (key.name)
             self.concepts[key.name] = key
@@ -975,6 +1377,9 @@ class Query:
                     raise IllegalConceptIdentifierError (f"Illegal concept id: {key}")
                 name, type_name = key.split (':')
             self.order.append (name)
+            if name in self.concepts:
+                """ A concept shared by several paths. """
+                return
             """ Verify the type name is in the model we have. """
             # @TODO there is a canned version of this for possible swapping
             # Add bmt here(?) needs access to bmt git repo (i.e internet connection)
@@ -984,6 +1389,27 @@ class Query:
             # For now just do manual string manipulation for type name
             type_name = f'biolink:' + type_name.replace('_', ' ').title().replace(' ', '')
             self.concepts[name] = Concept (name=name, type_name=type_name)
+
+    def edges(self):
+        """ Yield (index, source name, edge, target name) for each arrow in the query.
+        `index` is the position of the target in `order`. """
+        for index, edge in enumerate(self.arrows, start=1):
+            if edge is not None:
+                yield index, self.order[index - 1], edge, self.order[index]
+
+    def paths(self):
+        """ Split the query into linear queries, one for each comma separated path.
+        Concepts are copied so that each path can be bound independently. """
+        paths = []
+        for index, name in enumerate(self.order):
+            if index == 0 or self.arrows[index - 1] is None:
+                path = Query ()
+                paths.append (path)
+            else:
+                path.add (self.arrows[index - 1])
+            path.add (copy.copy (self.concepts[name]))
+        return paths
+
     def __getitem__(self, key):
         return self.concepts [key]
     def __setitem__(self, key, value):
@@ -1008,15 +1434,12 @@ class QueryPlanStrategy:
         """
         logger.debug (f"--planning query: {query}")
         plan = []
-        for index, element_name in enumerate(query.order):
-            if index == len(query.order) - 1:
-                """ There's another concept to transition to. """
-                continue
+        for index, source_name, predicate, target_name in query.edges ():
             self.plan_edge (
                 plan=plan,
-                source=query.concepts[element_name],
-                target=query.concepts[query.order[index+1]],
-                predicate=query.arrows[index])
+                source=query.concepts[source_name],
+                target=query.concepts[target_name],
+                predicate=predicate)
         logger.debug (f"--created plan {plan}")
         return plan
 
@@ -1045,7 +1468,9 @@ class QueryPlanStrategy:
                     top_schema = None
                     if len(plan) > 0:
                         top = plan[-1]
-                        top_schema = top[0]
+                        # a segment only continues along a path, not across branches.
+                        if top[2][-1][2].name == source.name:
+                            top_schema = top[0]
                     if top_schema == schema_name:
                         # this is the next edge in an ongoing segment.
                         top[2].append ([ source, predicate, target ])
@@ -1,15 +1,28 @@
+import argparse
+import asyncio
 import networkx as nx
 import json
+import hashlib
 import yaml
 import copy
 import requests
 import os
+import redis
 import time
 import threading
 import logging
+try:
+    import fcntl
+except ImportError:
+    # No file locks, every process publishes its own schema.
+    fcntl = None
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from tranql.concept import BiolinkModelWalker
 from tranql.exception import TranQLException, InvalidTransitionException
+from tranql.utils.autocomplete import AutocompleteIndex, SearchCache, prefix_match
 from tranql.util import snake_case, title_case
+from tranql.utils import provenance
 from PLATER.services.util.graph_adapter import GraphInterface
 # from Levenshtein import distance as LD
 
@@ -47,11 +60,188 @@ class NetworkxGraph:
         return self.net.nodes(**kwargs)
     def get_edges (self,**kwargs):
         return self.net.edges(keys=True,**kwargs)
+    def add_reasoner (self, identifier, reasoner):
+        """ Add a node if needed and record that reasoner supports it. """
+        if not self.has_node (identifier):
+            self.add_node (identifier, properties={'reasoner': [reasoner]})
+        reasoners = self.get_node (identifier)[1]['attr_dict']['reasoner']
+        if reasoner not in reasoners:
+            reasoners.append (reasoner)
     def delete (self):
         self.net.clear ()
     def commit (self):
         pass
 
+class SchemaAdjacency:
+    """
+    A compact graph of the transitions between biolink types.
+    Types are interned to integer ids and edges are kept in adjacency dicts, source id -> target id ->
+    predicate. The reasoners supporting a node or an edge are a bitmask over the reasoners seen so far,
+    so adding a layer is a bitwise or. Lookups are constant time. Implements the NetworkxGraph interface,
+    producing the same nodes and edges for GraphTranslator.
+    """
+    def __init__(self):
+        self.delete ()
+    def intern (self, identifier):
+        """ The integer id of a type, added as a node if it's new. """
+        node_id = self.ids.get (identifier)
+        if node_id is None:
+            node_id = len(self.names)
+            self.ids[identifier] = node_id
+            self.names.append (identifier)
+            self.node_masks.append (0)
+            # None until properties are given, like nodes networkx creates for an edge.
+            self.node_properties.append (None)
+            self.adjacency.append ({})
+        return node_id
+    def reasoner_mask (self, reasoners):
+        mask = 0
+        for reasoner in reasoners:
+            bit = self.reasoner_bits.get (reasoner)
+            if bit is None:
+                bit = self.reasoner_bits[reasoner] = 1 << len(self.reasoners)
+                self.reasoners.append (reasoner)
+            mask |= bit
+        return mask
+    def reasoner_names (self, mask):
+        return [ reasoner for index, reasoner in enumerate (self.reasoners) if mask >> index & 1 ]
+    def add_edge (self, start, predicate, end, properties={}):
+        edges = self.adjacency[self.intern (start)].setdefault (self.intern (end), {})
+        edge = edges.get (predicate)
+        if edge is None:
+            edge = edges[predicate] = [ 0, {} ]
+            self.reachability = None
+        for key, value in properties.items ():
+            if key == 'reasoner':
+                edge[0] |= self.reasoner_mask (value)
+            else:
+                edge[1][key] = value
+    def add_node (self, identifier, label=None, properties={}):
+        node_id = self.intern (identifier)
+        properties = dict (properties)
+        self.node_masks[node_id] |= self.reasoner_mask (properties.pop ('reasoner', []))
+        self.node_properties[node_id] = { **(self.node_properties[node_id] or {}), **properties }
+    def add_reasoner (self, identifier, reasoner):
+        """ Add a node if needed and record that reasoner supports it. """
+        self.add_node (identifier, properties={'reasoner': [reasoner]})
+    def has_node (self, identifier):
+        return identifier in self.ids
+    def node_data (self, node_id):
+        if self.node_properties[node_id] is None:
+            return {}
+        return { 'attr_dict': { 'reasoner': self.reasoner_names (self.node_masks[node_id]), **self.node_properties[node_id] } }
+    def edge_data (self, edge):
+        mask, properties = edge
+        return { 'reasoner': self.reasoner_names (mask), **properties }
+    def get_node (self, identifier, properties=None):
+        node_id = self.ids.get (identifier)
+        return None if node_id is None else (identifier, self.node_data (node_id))
+    """ Returns an edge from the graph or None. Unlike NetworkxGraph, the attr dict returned is a copy;
+    use add_edge to update properties.
+    :param predicate: If None, will return the first edge found between start->end if one exists.
+    :return: (start, predicate, end, attr_data) | None
+    """
+    def get_edge (self, start, end, predicate=None, properties=None):
+        source, target = self.ids.get (start), self.ids.get (end)
+        if source is None or target is None:
+            return None
+        edges = self.adjacency[source].get (target)
+        if not edges:
+            return None
+        if predicate is None:
+            predicate = next (iter (edges))
+        edge = edges.get (predicate)
+        return None if edge is None else (start, predicate, end, self.edge_data (edge))
+    def predicates (self, start, end):
+        """ The predicates of the edges from start to end. """
+        source, target = self.ids.get (start), self.ids.get (end)
+        if source is None or target is None:
+            return []
+        return list (self.adjacency[source].get (target, {}))
+    def get_nodes (self, data=False, **kwargs):
+        if not data:
+            return list (self.names)
+        return [ (identifier, self.node_data (node_id)) for node_id, identifier in enumerate (self.names) ]
+    def get_edges (self, data=False, **kwargs):
+        edges = []
+        for source, targets in enumerate (self.adjacency):
+            for target, predicates in targets.items ():
+                for predicate, edge in predicates.items ():
+                    if data:
+                        edges.append ((self.names[source], self.names[target], predicate, self.edge_data (edge)))
+                    else:
+                        edges.append ((self.names[source], self.names[target], predicate))
+        return edges
+    def delete (self):
+        self.ids = {}
+        self.names = []
+        self.node_masks = []
+        self.node_properties = []
+        self.adjacency = []
+        self.reasoner_bits = {}
+        self.reasoners = []
+        # (max_hops, distances) once built, see distances.
+        self.reachability = None
+    def commit (self):
+        pass
+    def distances (self, max_hops):
+        """
+        The reachability index: for each type id, a dict of the fewest hops to every type id reachable in at
+        most max_hops edges. Built once by a breadth first search from each type, and again only if an edge is
+        added or a deeper index is asked for. A deeper index answers shallower questions too.
+        """
+        reachability = self.reachability
+        if reachability is None or reachability[0] < max_hops:
+            index = []
+            for source in range(len(self.names)):
+                distance = {}
+                frontier = [ source ]
+                for hops in range(1, max_hops + 1):
+                    next_frontier = []
+                    for node in frontier:
+                        for target in self.adjacency[node]:
+                            if target not in distance:
+                                distance[target] = hops
+                                next_frontier.append (target)
+                    frontier = next_frontier
+                index.append (distance)
+            reachability = self.reachability = (max_hops, index)
+        return reachability[1]
+    def reachable (self, source, max_hops):
+        """ The types reachable from source in at most max_hops edges, with the fewest hops to each. """
+        source_id = self.ids.get (source)
+        if source_id is None:
+            return {}
+        return { self.names[target]: hops for target, hops in self.distances (max_hops)[source_id].items () if hops <= max_hops }
+    def find_paths (self, source, target, max_hops, limit=None):
+        """
+        Type level paths from source to target of at most max_hops edges, shortest first.
+        The index prunes the search to types that still reach the target in the hops left.
+        :return: A list of paths, each a list of type names starting with source and ending with target.
+        """
+        source_id, target_id = self.ids.get (source), self.ids.get (target)
+        if source_id is None or target_id is None:
+            return []
+        distances = self.distances (max_hops)
+        paths = []
+        def extend (path, remaining):
+            for node in self.adjacency[path[-1]]:
+                if node == target_id:
+                    paths.append (path + [ node ])
+                elif remaining > 1 and node not in path and distances[node].get (target_id, remaining) < remaining:
+                    extend (path + [ node ], remaining - 1)
+        extend ([ source_id ], max_hops)
+        paths.sort (key=len)
+        return [ [ self.names[node] for node in path ] for path in paths[:limit] ]
+    def next_types (self, source, target, max_hops):
+        """ The types one edge away from source that are on a path to target of at most max_hops edges. """
+        source_id, target_id = self.ids.get (source), self.ids.get (target)
+        if source_id is None or target_id is None:
+            return []
+        distances = self.distances (max_hops)
+        return [ self.names[node] for node in self.adjacency[source_id]
+                 if node == target_id or distances[node].get (target_id, max_hops) < max_hops ]
+
 class GraphTranslator:
     """
     An interface to a knowledge graph.
@@ -101,18 +291,22 @@ class RegistryAdapter:
             'automat': lambda url: RegistryAdapter.__AutomatAdapter(url)  # Use this to refer things in the schema
         }
 
-    def get_schemas(self, registry_name, registry_url, exclusion_list = []):
+    def get_schemas(self, registry_name, registry_url, exclusion_list = [], timeout=None, max_workers=1, load_errors=None):
         """
         Adds new schemas by invoking appropriate registry
         :param registry_name:
         :param schema:
+        :param timeout: Seconds to wait for each registry entry's schema.
+        :param max_workers: Number of registry entries fetched concurrently.
+        :param load_errors: If given, entries that fail to load are reported here and skipped.
         :return:
         """
         registry_constructor = self.__registry_adapters.get(registry_name)
         if not registry_constructor:
             raise TranQLException(f'No constructor found for {registry_name} -- Error constructing schema.')
         registry = registry_constructor(registry_url)
-        return registry.get_graph_schemas(exclusion_list)
+        return registry.get_graph_schemas(exclusion_list, timeout=timeout, max_workers=max_workers,
+                                          load_errors=load_errors)
 
 
 
@@ -120,26 +314,42 @@ class RegistryAdapter:
         def __init__(self, url):
             self.base_url = url.rstrip('/')
 
-        def __get_registry(self):
-            response = requests.get(self.base_url + '/registry')
+        def __get_registry(self, timeout=None):
+            response = requests.get(self.base_url + '/registry', timeout=timeout)
             if response.status_code == 200:
                 return response.json()
             else:
                 raise Exception(f'Failed to contact automat registry request to server returned'
                                 f'{response.status_code} -- {response.text}')
 
-        def get_graph_schemas(self, exclusion_list=[]):
+        def get_graph_schemas(self, exclusion_list=[], timeout=None, max_workers=1, load_errors=None):
             """
-            Looping through the registry we will grab the /graph/schema of each KP,
-            along with it's access url.
+            Grab the /graph/schema of each KP in the registry, along with it's access url.
+            Up to max_workers KPs are fetched at a time.
             :return:
             """
-            registry = self.__get_registry()
+            registry = self.__get_registry(timeout)
             main_schema = {}
-            filtered_registry = filter(lambda x: x not in exclusion_list, registry)
-            for path in filtered_registry:
+            filtered_registry = [path for path in registry if path not in exclusion_list]
+
+            def get_graph_schema(path):
                 graph_schema_path = f'{self.base_url}/{path}/predicates'
-                graph_schema = requests.get(graph_schema_path).json()
+                try:
+                    return requests.get(graph_schema_path, timeout=timeout).json()
+                except Exception as e:
+                    if load_errors is None:
+                        raise
+                    load_errors.append(Schema.fetch_error(graph_schema_path, e))
+                    return None
+
+            if filtered_registry:
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    graph_schemas = list(executor.map(get_graph_schema, filtered_registry))
+            else:
+                graph_schemas = []
+            for path, graph_schema in zip(filtered_registry, graph_schemas):
+                if graph_schema is None:
+                    continue
                 # since we have a backplane proxy that is able to query
                 # automat kps in /graph/automat/<path> we will use that pattern as url
                 kp_url = f'/graph/automat/{path}'
@@ -151,25 +361,151 @@ class RegistryAdapter:
             return main_schema
 
 
+class RedisBackendManager:
+    """
+    Keeps one graph interface per redis host and graph, shared by every query and search against it, and one
+    event loop on a worker thread to run their queries. The interface's connection pool is reused and the loop
+    outlives the query instead of being made for it, so a query costs one round trip.
+    """
+    _interfaces = {}
+    _clients = {}
+    _loop = None
+    _pid = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def connection_params(redis_conf, password, graph_name):
+        """ Connection parameters for a graph. A new dict; the schema's redis_connection_params are left as they are. """
+        return {
+            **redis_conf,
+            'auth': ('', password),
+            'db_name': graph_name,
+            'db_type': 'redis',
+        }
+
+    @classmethod
+    def _check_process(cls):
+        """ Connections and the loop's thread don't survive a fork, so a forked worker makes its own. """
+        if cls._pid != os.getpid():
+            cls._interfaces = {}
+            cls._clients = {}
+            cls._loop = None
+            cls._pid = os.getpid()
+
+    @classmethod
+    def get_interface(cls, connection_params):
+        """ The graph interface for a set of connection parameters, connecting the first time they are seen. """
+        key = tuple(sorted((name, repr(value)) for name, value in connection_params.items()))
+        with cls._lock:
+            cls._check_process()
+            interface = cls._interfaces.get(key)
+            if interface is None:
+                # GraphInterface is a process-wide singleton over the first graph it connects to,
+                # so each graph gets its own instance of the interface it wraps.
+                interface = cls._interfaces[key] = GraphInterface._GraphInterface(**connection_params)
+        return interface
+
+    @classmethod
+    def graph_version(cls, connection_params, version_key):
+        """
+        The version marker of a graph: the value of version_key, formatted with the graph name, which loaders
+        increment after loading the graph.
+        :return: The marker, or None if it couldn't be read or the graph's loader never set it, in which case
+            there is no telling when the graph changes and its answers mustn't be cached.
+        """
+        key = (connection_params.get('host'), connection_params.get('port'), connection_params.get('auth'))
+        with cls._lock:
+            cls._check_process()
+            client = cls._clients.get(key)
+            if client is None:
+                auth = connection_params.get('auth') or ('', '')
+                client = cls._clients[key] = redis.Redis(host=connection_params.get('host', 'localhost'),
+                                                         port=connection_params.get('port', 6379),
+                                                         password=auth[1] or None,
+                                                         socket_timeout=5)
+        try:
+            version = client.get(version_key.format(graph=connection_params.get('db_name', '')))
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Couldn't read the version of redis graph {connection_params.get('db_name')}: {e}")
+            return None
+        return version.decode() if version is not None else None
+
+    @classmethod
+    def submit(cls, coroutine):
+        """ Schedule a graph interface coroutine on the shared event loop. :return: A concurrent.futures.Future. """
+        with cls._lock:
+            cls._check_process()
+            if cls._loop is None:
+                cls._loop = asyncio.new_event_loop()
+                threading.Thread(target=cls._loop.run_forever, daemon=True).start()
+            loop = cls._loop
+        return asyncio.run_coroutine_threadsafe(coroutine, loop)
+
+    @classmethod
+    def run(cls, coroutine):
+        """ Run a graph interface coroutine on the shared event loop and wait for its result. """
+        return cls.submit(coroutine).result()
+
+
+class RedisAnswerCache:
+    """
+    Answers of redis graphs, by graph, graph version, query graph and query options. The graph version changes
+    when a new graph is loaded, so answers of an older load are never found again; they age out of the cache,
+    which keeps the size most recently used answers, each for at most ttl seconds.
+    """
+    def __init__(self, size=256, ttl=60*60, version_key="{graph}:version"):
+        self.size = size
+        self.ttl = ttl
+        self.version_key = version_key
+        self.answers = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(connection_params, version, query_graph, options):
+        return json.dumps([
+            connection_params.get('host'), connection_params.get('port'), connection_params.get('db_name'),
+            version, query_graph, options
+        ], sort_keys=True, default=str)
+
+    def get(self, key):
+        """ A copy of the answer cached under key, or None. """
+        with self.lock:
+            entry = self.answers.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[0] > self.ttl:
+                del self.answers[key]
+                return None
+            self.answers.move_to_end(key)
+        # Answers are decorated once they're returned, so the cached one is never handed out.
+        return copy.deepcopy(entry[1])
+
+    def put(self, key, answer):
+        answer = copy.deepcopy(answer)
+        with self.lock:
+            self.answers[key] = (time.time(), answer)
+            self.answers.move_to_end(key)
+            while len(self.answers) > self.size:
+                self.answers.popitem(last=False)
+
+
 class RedisAdapter:
     registry_adapters = {}
+    # In-process search indexes of the redis backends' node names and synonyms, by backend name.
+    autocomplete_indexes = {}
+    # Recent redis search results, for searches that aren't answered by an index.
+    search_cache = SearchCache()
 
     def __init__(self):
         pass
 
     @staticmethod
     def _create_graph_interface(service_name, redis_conf, tranql_config):
-        redis_connection_details = redis_conf
-        redis_connection_details.update(
-            {
-                'auth': ('', tranql_config.get(service_name.upper() + '_PASSWORD', '')),
-                'db_name': 'test',
-                'db_type': 'redis',
-            }
-        )
-        return GraphInterface(
-            **redis_connection_details
-        )
+        return RedisBackendManager.get_interface(RedisBackendManager.connection_params(
+            redis_conf,
+            password=tranql_config.get(service_name.upper() + '_PASSWORD', ''),
+            graph_name='test'
+        ))
 
     def _get_adapter(self, name):
         if name not in RedisAdapter.registry_adapters:
@@ -177,6 +513,9 @@ class RedisAdapter:
         return RedisAdapter.registry_adapters.get(name)
 
     def set_adapter(self, name, redis_config, tranql_config):
+        search_cache = RedisAdapter.search_cache
+        search_cache.size = int(tranql_config.get('AUTOCOMPLETE_CACHE_SIZE', search_cache.size))
+        search_cache.ttl = float(tranql_config.get('AUTOCOMPLETE_CACHE_TTL', search_cache.ttl))
         RedisAdapter.registry_adapters[name] = RedisAdapter._create_graph_interface(
             service_name=name,
             redis_conf=redis_config,
@@ -188,31 +527,99 @@ class RedisAdapter:
         schema = gi.get_schema(force_update=True)
         return schema
 
+    @staticmethod
+    def cypher_rows(result):
+        """ The rows of a cypher result, which graph interfaces return in the format of the Neo4j HTTP API. """
+        return [row['row'] for statement in result.get('results', []) for row in statement.get('data', [])]
+
+    def build_autocomplete_index(self, name, labels):
+        """
+        Index the names and synonyms of the nodes with the given labels, and which of them are linked to studies,
+        for search as you type without querying redis.
+        """
+        gi: GraphInterface = self._get_adapter(name)
+        nodes = {}
+        for label in labels:
+            result = RedisBackendManager.run(gi.run_cypher(
+                f"MATCH (n:`{label}`) RETURN n.id, n.name, n.synonyms, n.category"))
+            for node_id, node_name, synonyms, category in self.cypher_rows(result):
+                if node_id not in nodes:
+                    nodes[node_id] = ({
+                        "id": node_id,
+                        "name": node_name,
+                        "synonyms": synonyms if isinstance(synonyms, list) else [],
+                        "category": category
+                    }, set())
+                nodes[node_id][1].add(label)
+        result = RedisBackendManager.run(gi.run_cypher("MATCH (:`biolink.StudyVariable`)-[]-(n) RETURN DISTINCT n.id"))
+        study_linked = {row[0] for row in self.cypher_rows(result)}
+        index = AutocompleteIndex((node, node_labels, node_id in study_linked) for node_id, (node, node_labels) in nodes.items())
+        RedisAdapter.autocomplete_indexes[name] = index
+        logger.info(f"Indexed {len(index)} {name} nodes for autocomplete.")
+        return index
+
+    def refresh_autocomplete_index(self, name, labels):
+        """ Rebuild a backend's autocomplete index in the background. Searches use the previous index, or redis, meanwhile. """
+        def build():
+            try:
+                self.build_autocomplete_index(name, labels)
+            except Exception as e:
+                logger.warning(f"Couldn't index {name} for autocomplete: {e}")
+        thread = threading.Thread(target=build, daemon=True)
+        thread.start()
+        return thread
+
     def search(self, name, query, indexes, fields=None, options={
         "prefix_search": False,
         "postprocessing_cypher": "",
         "levenshtein_distance": 0,
         "query_limit": 50,
     }):
+        """
+        Search the names and synonyms of a redis backend's nodes. Searches over the default fields are answered
+        by the backend's autocomplete index once it's built, and by a redis full text search until then.
+        :param options: Search options. `study_linked` only keeps nodes linked to a study variable; redis does this
+            with the `postprocessing_cypher` option.
+        """
         valid_fields = ["name", "synoynms"]
         prefix_length = 3
         # valid_fields = ["name"]
         prefix_search = options.get("prefix_search", False)
         levenshtein_distance = options.get("levenshtein_distance", 0)
+
+        index = RedisAdapter.autocomplete_indexes.get(name)
+        if index is not None and not fields:
+            return index.search(query, indexes,
+                                prefix_search=prefix_search,
+                                levenshtein_distance=levenshtein_distance,
+                                study_linked=options.get("study_linked", False),
+                                limit=options.get("query_limit", 50))
+
+        options = {key: value for key, value in options.items() if key != "study_linked"}
         if levenshtein_distance > 0:
             options["prefix_search"] = False
 
+        query_limit = options.get("query_limit", 50)
+        search = json.dumps([name, indexes, fields, options], sort_keys=True, default=str)
+        cached = RedisAdapter.search_cache.lookup(search, query, prefixes=prefix_search and levenshtein_distance == 0)
+        if cached is not None:
+            cached_query, hits = cached
+            if cached_query != query:
+                hits = [hit for hit in hits
+                        if prefix_match(query, [hit["node"].get("name")] + (hit["node"].get("synonyms") or []))]
+                RedisAdapter.search_cache.put(search, query, hits, complete=True)
+            return hits[:query_limit]
+
         gi: GraphInterface = self._get_adapter(name)
         results = gi.search(query, indexes, fields, options)
         if prefix_search and levenshtein_distance > 0:
             search_terms = results["search_terms"]
             search_fields = valid_fields if fields is None else fields
             filtered_hits = []
-            print("Searching with terms", search_terms, "and fields", search_fields)
+            logger.debug(f"Searching with terms {search_terms} and fields {search_fields}")
             for hit in results["hits"]:
                 b_field_terms = [hit["node"][field].split(" ") for field in search_fields if field in hit["node"]]
                 matched = False
-                print(search_terms, b_field_terms)
                 for field_terms in b_field_terms:
                     # Every search term needs to be prefixed
                     if all([
@@ -229,17 +636,50 @@ class RedisAdapter:
                         matched = True
                         break
                 if matched: filtered_hits.append(hit)
-            print("Removed",[hit for hit in results["hits"] if hit not in filtered_hits])
             results["hits"] = filtered_hits
+        # The query limit is split between the indexes searched, so no index was cut short if there are fewer
+        # hits than one index's share.
+        complete = len(results["hits"]) < query_limit // max(len(indexes or []), 1)
+        RedisAdapter.search_cache.put(search, query, results["hits"], complete)
         return results["hits"]
 
 
+class SchemaPublisher:
+    """
+    Elects one process per snapshot file to resolve schemas and publish them.
+    The publisher holds an exclusive lock on `<snapshot>.lock` for as long as it runs, so when it
+    exits another process takes over.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock_file = None
+
+    def acquire(self):
+        """ Try to become the publisher. :return: True if this process is the publisher. """
+        if self.lock_file or fcntl is None:
+            return True
+        lock_file = open(f"{self.path}.lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    def release(self):
+        if self.lock_file:
+            self.lock_file.close()
+            self.lock_file = None
+
+
 class SchemaFactory:
     """
     Keeps a single SchemaInstance object till next update.
     """
     _cached = None
     _update_thread = None
+    _publisher = None
 
     def __init__(self, backplane, use_registry, update_interval, tranql_config, create_new=False, skip_redis=False ):
         """
@@ -256,7 +696,18 @@ class SchemaFactory:
         self.skip_redis = skip_redis
 
         if not SchemaFactory._cached or create_new:
-            SchemaFactory._cached = Schema(backplane, use_registry, tranql_config, skip_redis=skip_redis)
+            schema = None
+            publish = True
+            if not create_new:
+                # Serve a recent snapshot right away, the update thread refreshes it.
+                schema = SchemaFactory.load_snapshot(backplane, use_registry, tranql_config, skip_redis)
+                publisher = SchemaFactory.get_publisher(tranql_config)
+                if not schema and publisher and not publisher.acquire():
+                    # Another process is resolving the schema, wait for it to publish.
+                    schema = SchemaFactory.wait_for_snapshot(backplane, use_registry, tranql_config, skip_redis)
+                    publish = False
+            SchemaFactory._cached = schema or SchemaFactory.build_schema(backplane, use_registry, tranql_config, skip_redis,
+                                                                         publish=publish)
 
         if not SchemaFactory._update_thread:
             # avoid creating multiple threads.
@@ -266,30 +717,149 @@ class SchemaFactory:
                 daemon=True)
             SchemaFactory._update_thread.start()
 
-    def get_instance(self, force_update=False):
+    def get_instance(self, force_update=False, shared=False):
+        """
+        :param force_update: Resolve the schema again instead of using the cached one.
+        :param shared: Return the cached schema itself rather than a copy. It must not be modified,
+            but stays the same object until a new schema replaces it.
+        """
         if force_update:
-            SchemaFactory._cached = Schema(self.backplane, self.use_registry, self.tranql_config, self.skip_redis)
+            publisher = SchemaFactory.get_publisher(self.tranql_config)
+            SchemaFactory._cached = SchemaFactory.build_schema(self.backplane, self.use_registry, self.tranql_config, self.skip_redis,
+                                                               publish=not publisher or publisher.acquire())
+        if shared:
+            return SchemaFactory._cached
         return copy.deepcopy(SchemaFactory._cached)
 
+    @staticmethod
+    def snapshot_settings(backplane, use_registry, tranql_config, skip_redis):
+        """
+        Where the schema snapshot lives, and the settings a snapshot must have been made with to be used.
+        :return: (path, identity). The path is empty if snapshots are disabled.
+        """
+        path = tranql_config.get('SCHEMA_SNAPSHOT_PATH', '')
+        identity = {
+            "backplane": backplane,
+            "use_registry": bool(use_registry),
+            "skip_redis": bool(skip_redis),
+            "schema_config": os.environ.get("SCHEMA_CONFIG_PATH", "")
+        }
+        return path, identity
+
+    @staticmethod
+    def load_snapshot(backplane, use_registry, tranql_config, skip_redis):
+        """ Load the snapshot if it's recent enough to serve from while a fresh schema is resolved. """
+        path, identity = SchemaFactory.snapshot_settings(backplane, use_registry, tranql_config, skip_redis)
+        if not path:
+            return None
+        max_age = float(tranql_config.get('SCHEMA_SNAPSHOT_MAX_AGE', 24*60*60))
+        schema = Schema.load_snapshot(path, identity, max_age)
+        if schema and not skip_redis:
+            # redis backends are still searched directly.
+            for schema_name, metadata in schema.config['schema'].items ():
+                if metadata.get('redis', False):
+                    redis_adapter = RedisAdapter()
+                    redis_adapter.set_adapter(schema_name, metadata.get('redis_connection_params'), tranql_config)
+                    if str(tranql_config.get('AUTOCOMPLETE_INDEX', True)).lower() != 'false':
+                        redis_adapter.refresh_autocomplete_index(schema_name, Schema.redis_labels(metadata))
+        return schema
+
+    @staticmethod
+    def build_schema(backplane, use_registry, tranql_config, skip_redis, previous=None, publish=True):
+        """
+        Resolve a new schema and snapshot it. Sources that can't be reached are taken from
+        the previous snapshot, however old it is.
+        :param previous: A schema to refresh, only refetching the sources that are due and changed.
+        :param publish: Write the snapshot. Only the publisher process does.
+        """
+        path, identity = SchemaFactory.snapshot_settings(backplane, use_registry, tranql_config, skip_redis)
+        if not path:
+            return Schema(backplane, use_registry, tranql_config, skip_redis, previous=previous)
+        schema = Schema(backplane, use_registry, tranql_config, skip_redis,
+                        fallback=Schema.load_snapshot(path, identity), previous=previous)
+        if not publish:
+            return schema
+        try:
+            schema.revision = schema.save_snapshot(path, identity)
+        except OSError as e:
+            logger.warning(f"Unable to write schema snapshot {path}: {e}")
+        return schema
+
+    @staticmethod
+    def get_publisher(tranql_config):
+        """ The publisher of this process, None if schemas aren't shared through a snapshot. """
+        path = tranql_config.get('SCHEMA_SNAPSHOT_PATH', '')
+        if not path:
+            return None
+        if not SchemaFactory._publisher or SchemaFactory._publisher.path != path:
+            SchemaFactory._publisher = SchemaPublisher(path)
+        return SchemaFactory._publisher
+
+    @staticmethod
+    def wait_for_snapshot(backplane, use_registry, tranql_config, skip_redis):
+        """ Wait up to SCHEMA_SNAPSHOT_WAIT seconds for another process to publish a snapshot. """
+        path, identity = SchemaFactory.snapshot_settings(backplane, use_registry, tranql_config, skip_redis)
+        deadline = time.time () + float(tranql_config.get('SCHEMA_SNAPSHOT_WAIT', 60))
+        poll_interval = float(tranql_config.get('SCHEMA_SNAPSHOT_POLL_INTERVAL', 10))
+        revision = Schema.snapshot_revision(path)
+        while time.time () < deadline:
+            time.sleep(min(poll_interval, max(deadline - time.time (), 0)))
+            if Schema.snapshot_revision(path) != revision:
+                return SchemaFactory.load_snapshot(backplane, use_registry, tranql_config, skip_redis)
+        return None
+
+    @staticmethod
+    def update_cache(backplane, use_registry, tranql_config, skip_redis, update_interval=20*60):
+        """
+        Refresh the cached schema once.
+        Schemas shared through a snapshot are only resolved by the publisher process; the others load the
+        snapshot when its revision changes.
+        :return: Seconds to wait before the next refresh.
+        """
+        publisher = SchemaFactory.get_publisher(tranql_config)
+        if publisher and not publisher.acquire():
+            path, identity = SchemaFactory.snapshot_settings(backplane, use_registry, tranql_config, skip_redis)
+            if Schema.snapshot_revision(path) != getattr(SchemaFactory._cached, 'revision', 0):
+                schema = SchemaFactory.load_snapshot(backplane, use_registry, tranql_config, skip_redis)
+                if schema:
+                    SchemaFactory._cached = schema
+            return float(tranql_config.get('SCHEMA_SNAPSHOT_POLL_INTERVAL', 10))
+        SchemaFactory._cached = SchemaFactory.build_schema(backplane, use_registry, tranql_config, skip_redis,
+                                                           previous=SchemaFactory._cached)
+        # wake up for the source that has to be refreshed most often.
+        intervals = [ state['refresh_interval'] for state in SchemaFactory._cached.sources.values ()
+                      if state.get('refresh_interval') ]
+        return min([ update_interval ] + intervals)
+
     @staticmethod
     def update_cache_loop(backplane, use_registry, tranql_config, skip_redis, update_interval=20*60):
         while True:
-            SchemaFactory._cached = Schema(backplane, use_registry, tranql_config, skip_redis)
+            sleep = SchemaFactory.update_cache(backplane, use_registry, tranql_config, skip_redis, update_interval)
             print('sleeping..... ')
-            time.sleep(update_interval)
+            time.sleep(sleep)
 
 
 class Schema:
     """ A schema for a distributed knowledge network. """
 
-    def __init__(self, backplane, use_registry, tranql_config, skip_redis=False):
+    # Bump when the snapshot layout changes so that older snapshots are ignored.
+    SNAPSHOT_VERSION = 1
+
+    def __init__(self, backplane, use_registry, tranql_config, skip_redis=False, fallback=None, previous=None):
         """
         Create a metadata map of the knowledge network.
+        :param fallback: A previously resolved schema whose sources stand in for those that fail to load.
+        :param previous: The schema being refreshed. Its sources are reused unless their refresh_interval
+            has passed and they changed upstream.
         """
 
         # String[] of errors encountered during loading.
         self.loadErrors = []
         self.registry_adapter = RegistryAdapter()
+        # The snapshot revision this schema was published as, 0 if it wasn't.
+        self.revision = 0
+        # When each source was fetched and how to tell whether it changed since, by schema name.
+        self.sources = {}
 
         """ Load the schema, a map of reasoner systems to maps of their schemas. """
         self.config = None
@@ -298,55 +868,129 @@ class Schema:
                                     )
         with open(config_file) as stream:
             self.config = yaml.safe_load(stream)
+        # Configured schemas are reasoners even while their source can't be reached.
+        provenance.registry.allow (self.config['schema'].keys ())
 
-        """ Resolve remote schemas. """
+        """ Resolve remote schemas. Sources are fetched concurrently; a source that fails or times out
+        is recorded in loadErrors and left out of the schema. """
+        timeout = float(tranql_config.get('SCHEMA_REQUEST_TIMEOUT', 30))
+        max_workers = int(tranql_config.get('SCHEMA_MAX_PARALLEL_REQUESTS', 8))
+        previous_schemas = previous.config['schema'] if previous else {}
+        previous_sources = previous.sources if previous else {}
+        now = time.time ()
+
+        def is_due(schema_name, metadata):
+            """ Sources are refetched once their refresh interval has passed. """
+            state = previous_sources.get(schema_name)
+            return not state or now - state['fetched'] >= float(metadata.get('refresh_interval', 0))
+
+        remote_schemas = {}
+        registries = []
         for schema_name, metadata in self.config['schema'].copy ().items ():
             if metadata.get('redis', False) and not skip_redis:
                 redis_adapter = RedisAdapter()
                 redis_adapter.set_adapter(schema_name, metadata.get('redis_connection_params'), tranql_config)
-                metadata['schema'] = self.snake_case_schema(redis_adapter.get_schema(schema_name))
+                if is_due(schema_name, metadata) or schema_name not in previous_schemas:
+                    redis_schema = redis_adapter.get_schema(schema_name)
+                    content_hash = self.schema_hash(redis_schema)
+                    state = previous_sources.get(schema_name) or {}
+                    changed = schema_name not in previous_schemas or content_hash != state.get('hash')
+                    if changed:
+                        metadata['schema'] = self.snake_case_schema(redis_schema)
+                    else:
+                        # The graph summary is the same as last time, so keep what was built from it.
+                        metadata['schema'] = previous_schemas[schema_name]['schema']
+                    self.sources[schema_name] = self.source_state(metadata, hash=content_hash, changed=changed)
+                    if changed and str(tranql_config.get('AUTOCOMPLETE_INDEX', True)).lower() != 'false':
+                        redis_adapter.refresh_autocomplete_index(schema_name, self.redis_labels(metadata))
+                else:
+                    metadata['schema'] = previous_schemas[schema_name]['schema']
+                    self.sources[schema_name] = previous_sources[schema_name]
             if 'registry' in metadata:
                 if use_registry:
-                    registry_name = metadata['registry']
-                    registry_url = metadata['registry_url']
-                    exclusion_list = metadata.get('exclude', [])
-                    new_schemas = self.registry_adapter.get_schemas(registry_name,
-                                                                    backplane + registry_url,
-                                                                    exclusion_list)
-                    self.config['schema'].update(new_schemas)
-                    # remove registry entry
+                    state = previous_sources.get(schema_name)
+                    if is_due(schema_name, metadata) or any(name not in previous_schemas for name in state['entries']):
+                        registries.append ((schema_name,
+                                            metadata,
+                                            metadata['registry'],
+                                            backplane + metadata['registry_url'],
+                                            metadata.get('exclude', []),
+                                            float(metadata.get('timeout', timeout))))
+                    else:
+                        registries.append ((schema_name, metadata, None, None, None, None))
+                        self.sources[schema_name] = state
+                # remove registry entry
                 del self.config['schema'][schema_name]
                 continue
             schema_data = metadata['schema']
             if isinstance (schema_data, str) and schema_data.startswith ("/"):
                 schema_data = f"{backplane}{schema_data}"
             if isinstance(schema_data, str) and schema_data.startswith('http'):
-                # If schema_data is a URL
-                try:
-                    old_s_d = schema_data
-                    response = requests.get(schema_data)
-                    schema_data = self.snake_case_schema(response.json())
-                    if 'message' in schema_data:
-                        raise Exception(schema_data['message'])
-                except Exception as e:
-                    # If the request errors for any number of reasons (likely a timeout), append an error message
-                    if isinstance(e,requests.exceptions.Timeout):
-                        error = 'Request timed out while fetching schema at "'+old_s_d+'"'
-                    elif isinstance(e,requests.exceptions.ConnectionError):
-                        error = 'Request could not connect while fetching schema at "'+old_s_d+'"'
-                    else:
-                        error = TranQLException('Request failed while fetching schema at "'+old_s_d+'"',details=json.dumps(next(iter(e.args)),indent=2))
-                    self.loadErrors.append(error)
-                    # Delete the key here because it has no data.
-                    del self.config['schema'][schema_name]
+                if schema_name in previous_schemas and not is_due(schema_name, metadata):
+                    metadata['schema'] = previous_schemas[schema_name]['schema']
+                    self.sources[schema_name] = previous_sources[schema_name]
                     continue
+                # If schema_data is a URL, fetch it below along with the other sources.
+                remote_schemas[schema_name] = (schema_data, float(metadata.get('timeout', timeout)))
+                continue
             # Else, it must already be loaded
             metadata['schema'] = schema_data
             self.config['schema'][schema_name] = metadata
+
+        with ThreadPoolExecutor (max_workers=max_workers) as executor:
+            fetches = {
+                schema_name : executor.submit (self.fetch_schema, url, source_timeout,
+                                               previous_sources.get(schema_name),
+                                               previous_schemas.get(schema_name, {}).get('schema'))
+                for schema_name, (url, source_timeout) in remote_schemas.items ()
+            }
+            registry_fetches = [
+                executor.submit (self.registry_adapter.get_schemas, registry_name, registry_url,
+                                 exclusion_list, source_timeout, max_workers, self.loadErrors)
+                if registry_name else None
+                for _, _, registry_name, registry_url, exclusion_list, source_timeout in registries
+            ]
+            fallback_schemas = fallback.config['schema'] if fallback else {}
+            for schema_name, fetch in fetches.items ():
+                schema_data, error, state = fetch.result ()
+                if error:
+                    self.loadErrors.append(error)
+                    if schema_name in fallback_schemas:
+                        logger.warning (f"Using the snapshot of schema {schema_name}")
+                        schema_data = fallback_schemas[schema_name]['schema']
+                    else:
+                        # Delete the key here because it has no data.
+                        del self.config['schema'][schema_name]
+                        continue
+                else:
+                    self.sources[schema_name] = self.source_state(self.config['schema'][schema_name], **state)
+                self.config['schema'][schema_name]['schema'] = schema_data
+            for (schema_name, metadata, registry_name, registry_url, *_), fetch in zip(registries, registry_fetches):
+                if fetch is None:
+                    """ Keep the entries the registry had. """
+                    self.config['schema'].update({
+                        name : previous_schemas[name] for name in self.sources[schema_name]['entries']
+                    })
+                    continue
+                try:
+                    entries = fetch.result ()
+                    self.config['schema'].update(entries)
+                    self.sources[schema_name] = self.source_state(metadata, entries=list(entries.keys ()))
+                except Exception as e:
+                    self.loadErrors.append(self.fetch_error(registry_url, e))
+                    # registry entries are named after their registry.
+                    self.config['schema'].update({
+                        name : entry for name, entry in fallback_schemas.items ()
+                        if name.startswith (f"{registry_name}_")
+                    })
         self.schema = self.config['schema']
+        provenance.registry.allow (self.schema.keys ())
 
-        """ Build a graph of the schema. """
-        self.schema_graph = NetworkxGraph()
+        """ Build a graph of the schema, unless no layer changed since the previous schema. """
+        if previous and self.layers () == previous.layers ():
+            self.schema_graph = previous.schema_graph
+            return
+        self.schema_graph = SchemaAdjacency()
         try:
             self.schema_graph.delete ()
         except:
@@ -357,6 +1001,166 @@ class Schema:
 
         self.schema_graph.commit ()
 
+    def layers(self):
+        """ The schema of each source, in the order they are added to the graph. """
+        return [ (schema_name, metadata['schema']) for schema_name, metadata in self.config['schema'].items () ]
+
+    @staticmethod
+    def redis_labels(metadata):
+        """ The node labels of a redis backend, one for each concept type in its schema, e.g. biolink.Disease. """
+        return ["biolink." + title_case(concept_type) for concept_type in metadata['schema'].keys()]
+
+    @staticmethod
+    def schema_hash(schema):
+        """ A digest of a schema fetched from a backend, to tell whether it changed since it was last fetched. """
+        return hashlib.sha256(json.dumps(schema, sort_keys=True, default=str).encode()).hexdigest()
+
+    @staticmethod
+    def source_state(metadata, **state):
+        """ Record that a source was fetched now, along with what identifies its content. """
+        return {
+            **state,
+            "fetched": time.time (),
+            "refresh_interval": float(metadata.get('refresh_interval', 0))
+        }
+
+    def save_snapshot(self, path, identity):
+        """
+        Write the resolved schema and its graph to a local snapshot file.
+        The file is replaced atomically so readers never see a partial snapshot.
+        A new revision is only published when the content of the snapshot changed.
+        :param identity: Settings the schema was resolved with; snapshots made with other settings aren't loaded.
+        """
+        snapshot = {
+            "version": Schema.SNAPSHOT_VERSION,
+            "identity": identity,
+            "config": self.snapshot_config(),
+            "nodes": [ [ node, data ] for node, data in self.schema_graph.get_nodes (data=True) ],
+            "edges": [ [ start, predicate, end, data ] for start, end, predicate, data in self.schema_graph.get_edges (data=True) ]
+        }
+        content_hash = hashlib.sha256(json.dumps(snapshot, sort_keys=True, default=str).encode()).hexdigest()
+        revision, published_hash = Schema.published_snapshot (path)
+        if content_hash != published_hash:
+            revision += 1
+        snapshot.update({
+            "created": time.time (),
+            "sources": self.sources,
+            "revision": revision,
+            "hash": content_hash
+        })
+        # Rewrite the snapshot even when it's unchanged, so that it doesn't go stale.
+        self.write_atomically (path, json.dumps (snapshot))
+        if content_hash != published_hash:
+            # Publish the revision once the snapshot is in place; readers poll this small file.
+            self.write_atomically (f"{path}.version", f"{revision}\n{content_hash}")
+        return revision
+
+    @staticmethod
+    def write_atomically(path, text):
+        temp_path = f"{path}.{os.getpid ()}.tmp"
+        with open(temp_path, "w") as stream:
+            stream.write (text)
+        os.replace (temp_path, path)
+
+    @staticmethod
+    def published_snapshot(path):
+        """ The revision and content hash of the last snapshot published at path, (0, None) if there is none. """
+        try:
+            with open(f"{path}.version") as stream:
+                revision, _, content_hash = stream.read ().partition ("\n")
+                return int(revision), content_hash or None
+        except (OSError, ValueError):
+            return 0, None
+
+    @staticmethod
+    def snapshot_revision(path):
+        """ The revision of the last snapshot published at path, 0 if there is none. """
+        return Schema.published_snapshot (path)[0]
+
+    def snapshot_config(self):
+        """ The resolved config without the credentials added to redis connection parameters. """
+        config = copy.deepcopy(self.config)
+        for metadata in config['schema'].values ():
+            if isinstance(metadata.get('redis_connection_params'), dict):
+                metadata['redis_connection_params'].pop('auth', None)
+        return config
+
+    @staticmethod
+    def load_snapshot(path, identity, max_age=None):
+        """
+        Load a schema from a snapshot file without contacting any source.
+        :param max_age: Seconds after which a snapshot is considered stale. None accepts any age.
+        :return: The schema, or None if there is no usable snapshot.
+        """
+        try:
+            with open(path) as stream:
+                snapshot = json.load (stream)
+        except (OSError, ValueError):
+            return None
+        if snapshot.get ("version") != Schema.SNAPSHOT_VERSION or snapshot.get ("identity") != identity:
+            return None
+        if max_age is not None and time.time () - snapshot["created"] > max_age:
+            return None
+        schema = Schema.__new__ (Schema)
+        schema.loadErrors = []
+        schema.registry_adapter = RegistryAdapter()
+        schema.sources = snapshot.get("sources", {})
+        schema.revision = snapshot.get("revision", 0)
+        schema.config = snapshot["config"]
+        schema.schema = schema.config['schema']
+        provenance.registry.allow (schema.schema.keys ())
+        schema.schema_graph = SchemaAdjacency()
+        for node, data in snapshot["nodes"]:
+            schema.schema_graph.add_node (node, properties=data.get('attr_dict', {}))
+        for start, predicate, end, data in snapshot["edges"]:
+            schema.schema_graph.add_edge (start, predicate, end, data)
+        return schema
+
+    def fetch_schema(self, url, timeout=None, state=None, cached=None):
+        """
+        Fetch a remote schema.
+        If the source says it has not been modified, or its content hashes the same as when
+        `cached` was fetched, `cached` is returned without being processed again.
+        :param state: What the source was fetched with last time, see Schema::source_state.
+        :param cached: The schema fetched last time.
+        :return: (schema, None, state) or (None, error, None) if the request failed, so that other sources can still load.
+        """
+        state = state if cached is not None and state else {}
+        headers = {}
+        if state.get('etag'):
+            headers['If-None-Match'] = state['etag']
+        if state.get('last_modified'):
+            headers['If-Modified-Since'] = state['last_modified']
+        try:
+            response = requests.get(url, timeout=timeout, headers=headers)
+            if response.status_code == 304:
+                return cached, None, {**state, 'changed': False}
+            content_hash = hashlib.sha256(response.content).hexdigest()
+            new_state = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'hash': content_hash
+            }
+            if content_hash == state.get('hash'):
+                return cached, None, {**new_state, 'changed': False}
+            schema_data = self.snake_case_schema(response.json())
+            if 'message' in schema_data:
+                raise Exception(schema_data['message'])
+            return schema_data, None, {**new_state, 'changed': True}
+        except Exception as e:
+            return None, self.fetch_error(url, e), None
+
+    @staticmethod
+    def fetch_error(url, e):
+        """ Describe why fetching the schema at url failed. """
+        # If the request errors for any number of reasons (likely a timeout), append an error message
+        if isinstance(e,requests.exceptions.Timeout):
+            return 'Request timed out while fetching schema at "'+url+'"'
+        elif isinstance(e,requests.exceptions.ConnectionError):
+            return 'Request could not connect while fetching schema at "'+url+'"'
+        else:
+            return TranQLException('Request failed while fetching schema at "'+url+'"',details=json.dumps(next(iter(e.args), str(e)),indent=2))
+
     def snake_case_schema(self, schema):
         new_schema = {}
         for node in schema:
@@ -379,13 +1183,9 @@ class Schema:
         :param layer: Knowledge schema metadata layers.
         """
         for source_name, targets_list in layer.items ():
-            source_node = self.get_node (node_id=source_name, attrs={'reasoner': [name]})
-            if name not in source_node[1]['attr_dict']['reasoner']:
-                source_node[1]['attr_dict']['reasoner'].append(name)
+            self.schema_graph.add_reasoner (source_name, name)
             for target_type, links in targets_list.items ():
-                target_node = self.get_node (node_id=target_type, attrs={'reasoner': [name]})
-                if name not in target_node[1]['attr_dict']['reasoner']:
-                    target_node[1]['attr_dict']['reasoner'].append(name)
+                self.schema_graph.add_reasoner (target_type, name)
                 #self.schema_graph.commit ()
                 if isinstance(links, str):
                     links = [links]
@@ -424,9 +1224,8 @@ class Schema:
                 for link in links:
                     biolink_link = link
                     if not biolink_link in edge_summary: continue
-                    (_, _, _, edge_data) = self.schema_graph.get_edge (source_name, target_type, link)
                     individual_count = edge_summary[biolink_link]
-                    edge_data["score"] = individual_count / total_count
+                    self.schema_graph.add_edge (source_name, link, target_type, {"score": individual_count / total_count})
                 
 
     def get_edge (self, plan, source_name, source_type, target_name, target_type,
@@ -535,7 +1334,37 @@ class Schema:
         target_type = snake_case(target_type.replace('biolink.', ''))
         edge = self.schema_graph.get_edge (start=source_type, end=target_type)
         if not edge:
-            raise InvalidTransitionException (source_type, target_type, explanation=f'No valid transitions exist between {source_type} and {target_type} in this schema.')
+            explanation = f'No valid transitions exist between {source_type} and {target_type} in this schema.'
+            routes = self.find_paths (source_type, target_type, max_hops=3, limit=1)
+            if routes:
+                explanation += f' They are connected through {"->".join (routes[0]["concepts"])}.'
+            raise InvalidTransitionException (source_type, target_type, explanation=explanation)
+
+    def type_name (self, concept_type):
+        """
+        The name of a concept type in the schema graph. Types loaded from biolink curies are named like
+        biolink_Chemical_entity, so a plain name like chemical_entity is looked up in that form too.
+        """
+        name = snake_case(concept_type.replace('biolink.', ''))
+        if not self.schema_graph.has_node (name) and ':' not in concept_type:
+            curie_name = snake_case(f"biolink:{title_case(name)}")
+            if self.schema_graph.has_node (curie_name):
+                return curie_name
+        return name
+
+    def find_paths (self, source_type, target_type, max_hops=2, limit=None):
+        """
+        Routes through the schema from one concept type to another, looked up in the schema graph's reachability index.
+        :param max_hops: The most edges in a route.
+        :param limit: The most routes returned, shortest first.
+        :return: A list of routes: the concept types of the route and, for each hop, the predicates of its edges.
+        """
+        source_type, target_type = self.type_name (source_type), self.type_name (target_type)
+        graph = self.schema_graph
+        return [ {
+            "concepts": concepts,
+            "predicates": [ graph.predicates (start, end) for start, end in zip (concepts, concepts[1:]) ]
+        } for concepts in graph.find_paths (source_type, target_type, max_hops, limit) ]
 
     def validate_question (self, message):
         """
@@ -559,6 +1388,34 @@ def get_test_kg (file_name):
     return requests.get (url).json ()
 
 
+def benchmark_schema_graph (types=300, reasoners=20, targets=30, predicates=3):
+    """
+    Time building a schema graph from synthetic layers with NetworkxGraph and SchemaAdjacency.
+    Each reasoner's layer links every type to `targets` others with `predicates` predicates each.
+    :return: Seconds taken by each graph class, by class name.
+    """
+    type_names = [ f"type_{index}" for index in range(types) ]
+    layers = {
+        f"reasoner_{r}": {
+            source: {
+                type_names[(index * 7 + r + offset) % types]: [ f"predicate_{p}" for p in range(predicates) ]
+                for offset in range(targets)
+            }
+            for index, source in enumerate(type_names)
+        }
+        for r in range(reasoners)
+    }
+    timings = {}
+    for graph_class in (NetworkxGraph, SchemaAdjacency):
+        schema = Schema.__new__ (Schema)
+        schema.schema_graph = graph_class ()
+        start = time.time ()
+        for name, layer in layers.items ():
+            schema.add_layer (layer=layer, name=name)
+        timings[graph_class.__name__] = time.time () - start
+    return timings
+
+
 def main ():
     """ Process arguments. """
     arg_parser = argparse.ArgumentParser(
@@ -567,6 +1424,14 @@ def main ():
             prog,
             max_help_position=180))
     arg_parser.add_argument('-s', '--create-schema', help="Create the schema.", action="store_true")
+    arg_parser.add_argument('-b', '--benchmark', help="Compare building schema graphs with networkx and SchemaAdjacency.", action="store_true")
     args = arg_parser.parse_args ()
     if args.create_schema:
         print ('yeah')
+    if args.benchmark:
+        for graph_class, seconds in benchmark_schema_graph ().items ():
+            print (f"{graph_class}: {seconds:.3f}s")
+
+
+if __name__ == "__main__":
+    main ()
@@ -0,0 +1,217 @@
+import bisect
+import heapq
+import re
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from Levenshtein import distance as levenshtein
+except ImportError:
+    def levenshtein(a, b):
+        """ The edit distance between two strings. """
+        previous = list(range(len(b) + 1))
+        for i, a_char in enumerate(a, 1):
+            current = [i]
+            for j, b_char in enumerate(b, 1):
+                current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a_char != b_char)))
+            previous = current
+        return previous[-1]
+
+WORD = re.compile(r"\w+")
+
+
+def words(text):
+    """ The lower case words of a name or synonym. """
+    return WORD.findall(text.lower()) if isinstance(text, str) else []
+
+
+def prefix_match(query, texts):
+    """ Whether every word of the query starts a word of one of the texts, as in a prefix search. """
+    text_words = [word for text in texts for word in words(text)]
+    return all(any(word.startswith(term) for word in text_words) for term in words(query))
+
+
+class BKTree:
+    """
+    A Burkhard-Keller tree of words. Children are keyed by their edit distance to their parent, so the triangle
+    inequality rules out most of the tree when looking for the words close to a word.
+    """
+    def __init__(self, words=()):
+        self.root = None
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        if self.root is None:
+            self.root = (word, {})
+            return
+        node = self.root
+        while True:
+            distance = levenshtein(word, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (word, {})
+                return
+            node = child
+
+    def search(self, word, max_distance):
+        """ :return: (word, distance) for each word within max_distance of word. """
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            candidate, children = stack.pop()
+            distance = levenshtein(word, candidate)
+            if distance <= max_distance:
+                found.append((candidate, distance))
+            for child_distance in range(max(distance - max_distance, 1), distance + max_distance + 1):
+                child = children.get(child_distance)
+                if child is not None:
+                    stack.append(child)
+        return found
+
+
+class AutocompleteIndex:
+    """
+    Search as you type over the names and synonyms of graph nodes, answering like a redis full text search.
+    The distinct words are a sorted array, so the words starting with a prefix are a range found by bisection,
+    and each word has the nodes it appears in with a weight, higher in names than in synonyms.
+    Fuzzy searches use a BK-tree of the words, built the first time one is made.
+    """
+    # Fuzzy prefix matches share this many leading characters with the search term, see RedisAdapter.search.
+    PREFIX_LENGTH = 3
+    NAME_WEIGHT = 2
+    SYNONYM_WEIGHT = 1
+
+    def __init__(self, nodes):
+        """
+        :param nodes: (node, labels, study_linked) for each node. The node is a dict with its id, name, synonyms and
+            category, returned as is in hits. Labels are the node's labels in the graph, e.g. biolink.Disease.
+        """
+        self.nodes = []
+        self.labels = []
+        self.study_linked = []
+        postings = {}
+        for node, labels, study_linked in nodes:
+            node_index = len(self.nodes)
+            self.nodes.append(node)
+            self.labels.append(frozenset(labels))
+            self.study_linked.append(study_linked)
+            for synonym in node.get('synonyms') or []:
+                for word in words(synonym):
+                    postings.setdefault(word, {})[node_index] = self.SYNONYM_WEIGHT
+            for word in words(node.get('name')):
+                postings.setdefault(word, {})[node_index] = self.NAME_WEIGHT
+        self.words = sorted(postings)
+        self.postings = [postings[word] for word in self.words]
+        self.bk_tree = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def word_range(self, prefix):
+        """ The indices of the words starting with prefix. """
+        return range(bisect.bisect_left(self.words, prefix), bisect.bisect_left(self.words, prefix + "\uffff"))
+
+    def fuzzy_words(self, term, max_distance):
+        with self.lock:
+            if self.bk_tree is None:
+                self.bk_tree = BKTree(self.words)
+        return [(bisect.bisect_left(self.words, word), distance) for word, distance in self.bk_tree.search(term, max_distance)]
+
+    def matches(self, term, prefix_search, levenshtein_distance):
+        """ The nodes matching a search term, with their scores. """
+        if levenshtein_distance > 0 and prefix_search:
+            word_distances = [
+                (word_index, levenshtein(term, self.words[word_index][:len(term)]))
+                for word_index in self.word_range(term[:self.PREFIX_LENGTH])
+            ]
+            word_distances = [(word_index, distance) for word_index, distance in word_distances if distance <= levenshtein_distance]
+        elif levenshtein_distance > 0:
+            word_distances = self.fuzzy_words(term, levenshtein_distance)
+        elif prefix_search:
+            word_distances = [(word_index, 0) for word_index in self.word_range(term)]
+        else:
+            word_index = bisect.bisect_left(self.words, term)
+            found = word_index < len(self.words) and self.words[word_index] == term
+            word_distances = [(word_index, 0)] if found else []
+        scores = {}
+        for word_index, distance in word_distances:
+            for node_index, weight in self.postings[word_index].items():
+                score = weight / (1 + distance)
+                if score > scores.get(node_index, 0):
+                    scores[node_index] = score
+        return scores
+
+    def search(self, query, indexes=None, prefix_search=True, levenshtein_distance=0, study_linked=False, limit=50):
+        """
+        Find the nodes whose name or synonyms match every word of the query.
+        :param indexes: Only nodes with one of these labels. All nodes if empty.
+        :param study_linked: Only nodes linked to a study variable.
+        :return: Hits like those of a redis search, {"node": node, "score": score}, best first.
+        """
+        scores = None
+        for term in words(query):
+            matches = self.matches(term, prefix_search, levenshtein_distance)
+            if scores is not None:
+                matches = {node_index: score + scores[node_index] for node_index, score in matches.items() if node_index in scores}
+            scores = matches
+            if not scores:
+                return []
+        if scores is None:
+            return []
+        indexes = frozenset(indexes or [])
+        hits = [
+            (score, node_index) for node_index, score in scores.items()
+            if (not indexes or self.labels[node_index] & indexes) and (not study_linked or self.study_linked[node_index])
+        ]
+        hits = heapq.nsmallest(limit, hits, key=lambda hit: (-hit[0], len(self.nodes[hit[1]].get('name') or '')))
+        return [{"node": self.nodes[node_index], "score": score} for score, node_index in hits]
+
+
+class SearchCache:
+    """
+    Recent search results, by search and query. As the user types, the results of a prefix search for the
+    longer query are among those of the shorter one, so they're found by filtering those, unless those were
+    cut short by the query limit. Entries are dropped least recently used first, and after ttl seconds.
+    """
+    def __init__(self, size=1024, ttl=5*60):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, search, query, prefixes=False):
+        """
+        :param search: Identifies the search the query was made with, e.g. its options.
+        :param prefixes: Also look for the complete results of queries query starts with, longest first.
+        :return: (cached query, hits) or None.
+        """
+        now = time.time()
+        shortest = 1 if prefixes else len(query)
+        with self.lock:
+            for length in range(len(query), shortest - 1, -1):
+                key = (search, query[:length])
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                created, hits, complete = entry
+                if now - created > self.ttl:
+                    del self.entries[key]
+                    continue
+                if length < len(query) and not complete:
+                    continue
+                self.entries.move_to_end(key)
+                return query[:length], hits
+        return None
+
+    def put(self, search, query, hits, complete):
+        """ :param complete: The hits are every match of the query, not just the first. """
+        with self.lock:
+            self.entries[(search, query)] = (time.time(), list(hits), complete)
+            self.entries.move_to_end((search, query))
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
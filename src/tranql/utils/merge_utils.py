@@ -1,11 +1,30 @@
 ###
 # This merge strategy was adapted from strider (https://github.com/ranking-agent/strider)
 ####
-from collections import defaultdict
+from array import array
+from collections import defaultdict, OrderedDict
 import json, hashlib
+import heapq
+import itertools
 from bmt import Toolkit
 from functools import reduce
 import copy
+import gc
+import logging
+import marshal
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from tranql.utils.provenance import PROVENANCE_KEY, expand, expand_message
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 QUESTION_GRAPH_KEY = 'query_graph'
@@ -13,7 +32,9 @@ KNOWLEDGE_GRAPH_KEY = 'knowledge_graph'
 KNOWLEDGE_MAP_KEY = 'results'
 
 BL_VERSION = "1.6.1"
-toolkit = Toolkit(schema=f"https://raw.githubusercontent.com/biolink/biolink-model/{BL_VERSION}/biolink-model.yaml")
+BIOLINK_MODEL_URL = f"https://raw.githubusercontent.com/biolink/biolink-model/{BL_VERSION}/biolink-model.yaml"
+
+logger = logging.getLogger(__name__)
 
 
 
@@ -47,22 +68,19 @@ def connect_knowledge_maps(responses):
     score_table = {}
 
     for bindings in all_knowledge_maps:
-        score_key = set()
         nodes = bindings.get('node_bindings', {})
         edges = bindings.get('edge_bindings', {})
         score = bindings.get('score', 0)
         # Do this if binding has a score else it should be 0
+        score_key = frozenset()
         if score != 0:
-            # convert nodes to list
-            for concept in nodes:
-                curie = reduce(lambda a, b: a + [b['id']], nodes[concept], [])
-                for c in curie:
-                    score_key.add(c)
-            for edge_id in edges:
-                edges_kg_ids = reduce(lambda a, b: a + [b['id']], edges[edge_id], [])
-                for i in edges_kg_ids:
-                    score_key.add(i)
-        score_key = frozenset(score_key)
+            # every node and edge id the binding holds, hashable so it keys the score table
+            score_key = frozenset(
+                bound['id']
+                for bindings_map in (nodes, edges)
+                for bound_list in bindings_map.values()
+                for bound in bound_list
+            )
         score_table[score_key] = score
 
     # Step 2
@@ -144,24 +162,38 @@ def connect_knowledge_maps(responses):
     return merged_answers
 
 
+def binding_ids(answer):
+    """ The knowledge graph ids an answer binds, the first of each of its node and edge bindings. """
+    return frozenset(
+        bindings[0]['id']
+        for bindings_map in (answer['node_bindings'], answer['edge_bindings'])
+        for bindings in bindings_map.values()
+        if bindings
+    )
+
+
 def overlay_score(merged_answers, score_table):
-    for score_key in score_table:
-        if score_table[score_key] == 0:
+    """
+    Give each merged answer the score of the score table entries whose ids it all binds, the last such entry
+    winning. Answers are indexed by id, so the answers binding every id of a score key are the intersection of
+    the answers binding each of them, smallest first, rather than a scan of every answer for every key.
+    """
+    answer_ids = [binding_ids(answer) for answer in merged_answers]
+    answers_by_id = defaultdict(set)
+    for index, ids in enumerate(answer_ids):
+        for kg_id in ids:
+            answers_by_id[kg_id].add(index)
+    all_answers = set(range(len(merged_answers)))
+    for score_key, score in score_table.items():
+        if score == 0:
             continue
-        for answer in merged_answers:
-            node_bindings = list(map(lambda x: answer['node_bindings'][x][0], answer['node_bindings']))
-            edge_bindings = list(map(lambda x: answer['edge_bindings'][x][0], answer['edge_bindings']))
-            # make sure score key contains all nodes
-            nb_kg_ids = [x['id'] for x in  node_bindings]
-            eb_kg_ids = [x['id'] for x in edge_bindings]
-            filterd = list(filter(lambda x: x not in nb_kg_ids, score_key))
-            # make sure edges are also contained
-            filterd = list(filter(lambda x: x not in eb_kg_ids, filterd))
-            # if 'filterd' is empty means this answer contains all the edges and nodes so will give it that score
-            # @TODO maybe have score be a asscoiated with sets of nodes, so it perseves origninal meaning that the
-            # @TODO kp intented
-            if len(filterd) == 0:
-                answer['score'] = score_table[score_key]
+        if not score_key:
+            matches = all_answers
+        else:
+            postings = sorted((answers_by_id.get(kg_id, set()) for kg_id in score_key), key=len)
+            matches = postings[0].intersection(*postings[1:])
+        for index in matches:
+            merged_answers[index]['score'] = score
 
 
 def find_all_paths(graph, start, edge, visited = set(),stack= [], paths=[]):
@@ -181,44 +213,63 @@ def find_all_paths(graph, start, edge, visited = set(),stack= [], paths=[]):
         visited.remove(node)
 
 
-def find_biolink_leaves(biolink_concepts: list):
+class CategoryOrder:
     """
-    Given a list of biolink concepts, returns the leaves removing any parent concepts.
-    :param biolink_concepts: list of biolink concepts
-    :return: leave concepts.
+    Orders the categories of merged nodes leaves first, the leaves and the other categories each sorted.
+    The same few combinations of categories come up for thousands of nodes, so the biolink ancestors of each
+    category are looked up once into a table, and each combination is ordered once. Combinations are dropped
+    least recently used first once there are `size` of them.
     """
-    ancestry_set = set()
-    all_concepts = set(biolink_concepts)
-    for x in all_concepts:
-        ancestors = set(toolkit.get_ancestors(x, reflexive=False, formatted=True))
-        ancestry_set = ancestry_set.union(ancestors)
-    leaf_set = all_concepts - ancestry_set
-    return list(leaf_set)
-
-def deduplicate_by(elements, fcn):
-    """De-duplicate list via a function of each element."""
-    return list(dict((fcn(element), element) for element in elements).values())
-
-
-def get_from_all(
-    dictionaries,
-    key,
-    default=None
-):
-    """
-    Get list of values from dictionaries.
-    If it is not present in any dictionary, return the default value.
-    """
-    values = [d[key] for d in dictionaries if key in d]
-    if len(values) > 0:
-        return values
-    else:
-        return default
-
-
-def filter_none(values):
-    """ Filter out None values from list """
-    return [v for v in values if v is not None]
+    def __init__(self, toolkit=None, size=4096):
+        """ :param toolkit: The biolink model toolkit. If None, one is loaded the first time it's needed. """
+        self._toolkit = toolkit
+        self.size = size
+        self.ancestor_table = {}
+        self.orders = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def toolkit(self):
+        # Loaded lazily, so merge worker processes, which leave categories unordered, never load the model.
+        if self._toolkit is None:
+            with self.lock:
+                if self._toolkit is None:
+                    self._toolkit = Toolkit(schema=BIOLINK_MODEL_URL)
+        return self._toolkit
+
+    def ancestors(self, category):
+        ancestors = self.ancestor_table.get(category)
+        if ancestors is None:
+            ancestors = frozenset(self.toolkit.get_ancestors(category, reflexive=False, formatted=True))
+            self.ancestor_table[category] = ancestors
+        return ancestors
+
+    def order(self, categories):
+        """ :return: (the distinct categories leaves first, the number of leaves) """
+        key = frozenset(categories)
+        with self.lock:
+            order = self.orders.get(key)
+            if order is not None:
+                self.orders.move_to_end(key)
+                return order
+        ancestry = frozenset().union(*(self.ancestors(category) for category in key))
+        leaves = sorted(key - ancestry)
+        order = (tuple(leaves + sorted(key & ancestry)), len(leaves))
+        with self.lock:
+            self.orders[key] = order
+            while len(self.orders) > self.size:
+                self.orders.popitem(last=False)
+        return order
+
+    def leaves_first(self, categories):
+        return list(self.order(categories)[0])
+
+    def leaves(self, categories):
+        ordered, leaf_count = self.order(categories)
+        return list(ordered[:leaf_count])
+
+
+category_order = CategoryOrder()
 
 
 def merge_listify(values):
@@ -235,11 +286,6 @@ def merge_listify(values):
     return output
 
 
-def all_equal(values: list):
-    """ Check that all values in given list are equal """
-    return all(values[0] == v for v in values)
-
-
 def result_hash(result):
     """
     Given a results object, generate a hashable value that
@@ -256,43 +302,6 @@ def result_hash(result):
     return (node_bindings_information, edge_bindings_information)
 
 
-def merge_edges(kedges):
-    """ Smart merge function for KEdges """
-    output_kedge = {}
-
-    attributes_values = get_from_all(kedges, "attributes")
-    if attributes_values:
-        output_kedge["attributes"] = \
-            deduplicate_by(
-                filter_none(merge_listify(attributes_values)),
-                lambda d: json.dumps(d, sort_keys=True))
-
-    predicate_values = get_from_all(kedges, "predicate")
-    if not all_equal(predicate_values):
-        raise ValueError("Unable to merge edges with non matching predicates")
-    output_kedge["predicate"] = predicate_values[0]
-
-    subject_values = get_from_all(kedges, "subject")
-    if not all_equal(subject_values):
-        raise ValueError("Unable to merge edges with non matching subjects")
-    output_kedge["subject"] = subject_values[0]
-
-    object_values = get_from_all(kedges, "object")
-    if not all_equal(object_values):
-        raise ValueError("Unable to merge edges with non matching objects")
-    output_kedge["object"] = object_values[0]
-
-    return output_kedge
-
-def deduplicate(values: list):
-    """ Simple deduplicate that uses python sets """
-    new_list = []
-    for v in values:
-        if v not in new_list:
-            new_list.append(v)
-    return new_list
-
-
 def build_unique_kg_edge_ids(message):
     """
     Replace KG edge IDs with a string that represents
@@ -322,91 +331,788 @@ def build_unique_kg_edge_ids(message):
                         eb["id"] = new_edge_id
 
 
-def merge_nodes(knodes):
-    """ Smart merge function for KNodes """
-    output_knode = {}
+def merge_kgraphs(kgraphs):
+    """ Merge knowledge graphs. """
+    return KnowledgeGraph.merge(kgraphs).to_trapi()
+
 
-    # We don't really know how to merge names
-    # so we just pick the first we are given
-    name_values = get_from_all(knodes, "name")
-    if name_values:
-        output_knode["name"] = name_values[0]
+def kgraphs_bytes(kgraphs, sample=64):
+    """ Estimate the size of knowledge graphs encoded as JSON, from the size of a sample of their nodes and edges. """
+    size = 0
+    for kgraph in kgraphs:
+        for field in ("nodes", "edges"):
+            elements = kgraph.get(field) or {}
+            if elements:
+                sampled = dict(itertools.islice(elements.items(), sample))
+                size += len(json.dumps(sampled, default=str)) * len(elements) // len(sampled)
+    return size
 
-    category_values = get_from_all(knodes, "category") or get_from_all(knodes, "categories")
-    if category_values:
-        output_knode["category"] = \
-            deduplicate(merge_listify(category_values))
-        # make leaves come first
-        leaves = set(find_biolink_leaves(output_knode["category"]))
-        other_category = set(output_knode["category"]) - leaves
-        output_knode["category"] = list(leaves) + list(other_category)
 
-    attributes_values = get_from_all(knodes, "attributes")
-    if attributes_values:
-        output_knode["attributes"] = \
-            deduplicate_by(
-                filter_none(merge_listify(attributes_values)),
-                lambda d: json.dumps(d, sort_keys=True))
+class SpilledKnowledgeGraph:
+    """
+    Merges knowledge graphs like KnowledgeGraph, in a sqlite database on disk rather than in memory. Nodes and
+    edges are rows keyed by id holding their merged fields as JSON, merged with the incoming elements a batch at
+    a time. The database is a temporary file, removed on close.
+    Only a batch of elements is held in memory while merging, and iter_json reads the merged graph back an
+    element at a time; to_trapi builds the whole merged graph in memory.
+    """
+    # Stay below the default limit on the number of parameters of a sqlite statement.
+    MAX_PARAMETERS = 900
+
+    def __init__(self, directory=None, batch_size=10000):
+        """ :param directory: Where to put the database, the system's temporary directory if None. """
+        descriptor, self.path = tempfile.mkstemp(prefix='tranql-merge-', suffix='.sqlite', dir=directory or None)
+        os.close(descriptor)
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        # The database is scratch space, it needn't survive a crash.
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        for table in ("nodes", "edges"):
+            self.connection.execute(f"CREATE TABLE {table} (id TEXT PRIMARY KEY, record TEXT NOT NULL)")
+
+    @classmethod
+    def merge(cls, kgraphs, directory=None, batch_size=10000):
+        graph = cls(directory, batch_size)
+        try:
+            for kgraph in kgraphs:
+                graph.add(kgraph)
+        except Exception:
+            graph.close()
+            raise
+        return graph
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def add(self, kgraph):
+        """ Merge a TRAPI knowledge graph into this one, as KnowledgeGraph.add does. """
+        for table, merge_record in (("nodes", self.merge_node), ("edges", self.merge_edge)):
+            elements = iter((kgraph.get(table) or {}).items())
+            batch = list(itertools.islice(elements, self.batch_size))
+            while batch:
+                self.merge_batch(table, batch, merge_record)
+                batch = list(itertools.islice(elements, self.batch_size))
+
+    def merge_batch(self, table, elements, merge_record):
+        records = {}
+        keys = [key for key, element in elements]
+        for start in range(0, len(keys), self.MAX_PARAMETERS):
+            chunk = keys[start:start + self.MAX_PARAMETERS]
+            records.update(
+                (key, json.loads(record)) for key, record in self.connection.execute(
+                    f"SELECT id, record FROM {table} WHERE id IN ({','.join('?' * len(chunk))})", chunk))
+        inserts = []
+        updates = []
+        for key, element in elements:
+            record = records.get(key)
+            if record is None:
+                inserts.append((key, json.dumps(merge_record({}, element, new=True))))
+            else:
+                updates.append((json.dumps(merge_record(record, element, new=False)), key))
+        with self.connection:
+            self.connection.executemany(f"INSERT INTO {table} (id, record) VALUES (?, ?)", inserts)
+            self.connection.executemany(f"UPDATE {table} SET record = ? WHERE id = ?", updates)
+
+    @staticmethod
+    def merge_attributes(attributes, new_attributes):
+        attributes = attributes or []
+        seen = {canonical(attribute) for attribute in attributes}
+        for attribute in merge_listify([new_attributes]):
+            if attribute is None:
+                continue
+            attribute = normalized_attribute(attribute)
+            key = canonical(attribute)
+            if key not in seen:
+                seen.add(key)
+                attributes.append(attribute)
+        return attributes
+
+    def merge_node(self, record, knode, new):
+        if record.get('name') is None and 'name' in knode:
+            record['name'] = knode['name']
+        for field in ('category', 'categories'):
+            if field in knode:
+                categories = record.get(field) or []
+                for category in merge_listify([knode[field]]):
+                    if category not in categories:
+                        categories.append(category)
+                record[field] = categories
+        if 'attributes' in knode:
+            record['attributes'] = self.merge_attributes(record.get('attributes'), knode['attributes'])
+        if PROVENANCE_KEY in knode:
+            record['provenance'] = (record.get('provenance') or 0) | knode[PROVENANCE_KEY]
+        return record
+
+    def merge_edge(self, record, kedge, new):
+        if new:
+            record.update(subject=kedge.get('subject'), predicate=kedge.get('predicate'), object=kedge.get('object'))
+        elif record['predicate'] != kedge.get('predicate'):
+            raise ValueError("Unable to merge edges with non matching predicates")
+        elif record['subject'] != kedge.get('subject'):
+            raise ValueError("Unable to merge edges with non matching subjects")
+        elif record['object'] != kedge.get('object'):
+            raise ValueError("Unable to merge edges with non matching objects")
+        if 'attributes' in kedge:
+            record['attributes'] = self.merge_attributes(record.get('attributes'), kedge['attributes'])
+        if PROVENANCE_KEY in kedge:
+            record['provenance'] = (record.get('provenance') or 0) | kedge[PROVENANCE_KEY]
+        return record
+
+    def rows(self, table):
+        # rowids follow insertion, so elements come out in the order they were first seen, as from KnowledgeGraph.
+        for key, record in self.connection.execute(f"SELECT id, record FROM {table} ORDER BY rowid"):
+            yield key, json.loads(record)
+
+    def nodes(self):
+        """ Stream the merged TRAPI nodes, (id, node). """
+        for key, record in self.rows("nodes"):
+            knode = {}
+            if record.get('name') is not None:
+                knode['name'] = record['name']
+            categories = record.get('category') or record.get('categories')
+            if categories:
+                # make leaves come first
+                knode['category'] = category_order.leaves_first(categories)
+            if 'attributes' in record:
+                knode['attributes'] = record['attributes']
+            if 'provenance' in record:
+                knode[PROVENANCE_KEY] = record['provenance']
+            yield key, knode
+
+    def edges(self):
+        """ Stream the merged TRAPI edges, (id, edge). """
+        for key, record in self.rows("edges"):
+            kedge = {}
+            if 'attributes' in record:
+                kedge['attributes'] = record['attributes']
+            kedge['predicate'] = record['predicate']
+            kedge['subject'] = record['subject']
+            kedge['object'] = record['object']
+            if 'provenance' in record:
+                kedge[PROVENANCE_KEY] = record['provenance']
+            yield key, kedge
+
+    def to_trapi(self):
+        """ The merged TRAPI knowledge graph. """
+        return {"nodes": dict(self.nodes()), "edges": dict(self.edges())}
+
+    def records(self, table, keys):
+        """ The records of the elements of a table with the given ids, (id, record). """
+        keys = list(keys)
+        for start in range(0, len(keys), self.MAX_PARAMETERS):
+            chunk = keys[start:start + self.MAX_PARAMETERS]
+            for key, record in self.connection.execute(
+                    f"SELECT id, record FROM {table} WHERE id IN ({','.join('?' * len(chunk))})", chunk):
+                yield key, json.loads(record)
+
+    def publication_counts(self, edge_ids):
+        """
+        The number of publications of the edges with the given ids, as KnowledgeGraph.publication_counts.
+        :return: (the index of each edge id in the counts, the counts)
+        """
+        edge_index = {}
+        publications = array('l')
+        for key, record in self.records("edges", set(edge_ids)):
+            edge_index[key] = len(publications)
+            publications.append(sum(
+                len(attribute['value']) for attribute in record.get('attributes') or []
+                if is_publications(attribute) and attribute.get('value')))
+        return edge_index, publications
+
+    def iter_json(self, keep=None):
+        """
+        The merged TRAPI knowledge graph as chunks of JSON, read back an element at a time, with reasoner
+        provenance expanded.
+        :param keep: Ids of the only nodes and edges to include, (node ids, edge ids). The nodes of the kept
+            edges are kept too.
+        If reading the graph back fails, the JSON yielded so far is closed off as a (partial) knowledge graph
+        before the error is raised, so the caller can still finish a well-formed document.
+        """
+        closing = '{}'
+        try:
+            edges = self.edges()
+            nodes = self.nodes()
+            if keep is not None:
+                node_ids, edge_ids = set(keep[0]), set(keep[1])
+                for key, record in self.records("edges", edge_ids):
+                    node_ids.update((record['subject'], record['object']))
+                nodes = ((key, knode) for key, knode in nodes if key in node_ids)
+                edges = ((key, kedge) for key, kedge in edges if key in edge_ids)
+            for opening, elements in (('{"nodes": {', nodes), ('}, "edges": {', edges)):
+                yield opening
+                closing = '}}' if opening.startswith('}') else '}, "edges": {}}'
+                separator = ''
+                for key, element in elements:
+                    yield f'{separator}{json.dumps(key)}: {json.dumps(expand(element))}'
+                    separator = ', '
+        except Exception:
+            yield closing
+            raise
+        yield '}}'
+
+
+def merged_kgraph(kgraphs, spill_threshold=None, spill_directory=None, processes=1, parallel_threshold=None):
+    """
+    Merge knowledge graphs to score results against.
+    :param spill_threshold: Merge on disk once the knowledge graphs are this many bytes of JSON, see SpilledKnowledgeGraph.
+    :param processes: Below spill_threshold, merge in this many processes once the knowledge graphs are
+        parallel_threshold bytes of JSON, see ShardedKnowledgeGraph.
+    :return: (the merged TRAPI knowledge graph, its KnowledgeGraph or ShardedKnowledgeGraph if merged in memory, else None)
+    """
+    size = kgraphs_bytes(kgraphs) if spill_threshold is not None or parallel_threshold is not None else 0
+    if spill_threshold is not None and size >= spill_threshold:
+        with SpilledKnowledgeGraph.merge(kgraphs, spill_directory) as kgraph:
+            return kgraph.to_trapi(), None
+    if processes > 1 and parallel_threshold is not None and size >= parallel_threshold:
+        kgraph = ShardedKnowledgeGraph.merge(kgraphs, processes)
+    else:
+        kgraph = KnowledgeGraph.merge(kgraphs)
+    return kgraph.to_trapi(), kgraph
 
-    return output_knode
 
+PUBLICATIONS_ATTRIBUTE = 'publications'
 
-def merge_kgraphs(kgraphs):
-    """ Merge knowledge graphs. """
 
-    knodes = [kgraph["nodes"] for kgraph in kgraphs]
-    kedges = [kgraph["edges"] for kgraph in kgraphs]
+def is_publications(attribute):
+    return PUBLICATIONS_ATTRIBUTE in (attribute.get('original_attribute_name'), attribute.get('name'))
 
-    # Merge Nodes
-    output = {"nodes": {}, "edges": {}}
 
-    all_node_keys = set()
-    for kgraph in kgraphs:
-        all_node_keys.update(kgraph["nodes"].keys())
-    for node_key in all_node_keys:
-        node_values = get_from_all(knodes, node_key)
-        merged_node = merge_nodes(node_values)
-        output["nodes"][node_key] = merged_node
-
-    # Merge Edges
-    all_edge_keys = set()
-    for kgraph in kgraphs:
-        all_edge_keys.update(kgraph["edges"].keys())
-    for edge_key in all_edge_keys:
-        edge_values = get_from_all(kedges, edge_key)
-        merged_edge = merge_edges(edge_values)
-        output["edges"][edge_key] = merged_edge
+def canonical(value):
+    """
+    A hashable form of a JSON value, equal for equal values whatever their key order, like
+    json.dumps(value, sort_keys=True) without building the string. Scalars keep their type, so 1, 1.0 and True differ.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((key, canonical(item)) for key, item in value.items()))
+    if isinstance(value, list):
+        return (list, tuple(canonical(item) for item in value))
+    if isinstance(value, str):
+        return value
+    return (type(value), value)
 
-    return output
 
-def calc_score_based_on_publications(merged_kg):
-    edges = merged_kg.get('knowledge_graph', {}).get('edges', {})
+def normalized_attribute(attribute):
+    """ The attribute, with publications given as a single string made a list. """
+    if is_publications(attribute) and isinstance(attribute.get('value'), str):
+        return {**attribute, 'value': [attribute['value']]}
+    return attribute
+
+
+class StringTable:
+    """ Interns strings as small integers, so repeated curies and predicates are stored and compared once. """
+    __slots__ = ('strings', 'ids')
+
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def intern(self, string):
+        string_id = self.ids.get(string)
+        if string_id is None:
+            string_id = self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return string_id
+
+    def __getitem__(self, string_id):
+        return self.strings[string_id]
+
+
+class AttributeStore:
+    """
+    Every distinct attribute of a knowledge graph, stored once however many nodes and edges carry it.
+    Attributes are told apart by their canonical form. Publications given as a single string are stored as
+    a list, the way calc_score_based_on_publications counts them.
+    """
+    __slots__ = ('attributes', 'ids')
+
+    def __init__(self):
+        self.attributes = []
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.attributes)
+
+    def intern(self, attribute):
+        attribute = normalized_attribute(attribute)
+        key = canonical(attribute)
+        attribute_id = self.ids.get(key)
+        if attribute_id is None:
+            attribute_id = self.ids[key] = len(self.attributes)
+            self.attributes.append(attribute)
+        return attribute_id
+
+    def __getitem__(self, attribute_id):
+        return self.attributes[attribute_id]
+
+
+class KNode:
+    """
+    A merged knowledge graph node. Fields that none of the merged nodes had are None, so they are left out
+    of the TRAPI node.
+    """
+    __slots__ = ('name', 'category', 'categories', 'attributes', 'provenance')
+
+    def __init__(self):
+        self.name = None
+        self.category = None
+        self.categories = None
+        self.attributes = None
+        self.provenance = None
+
+
+class KnowledgeGraph:
+    """
+    A knowledge graph for merging, built from TRAPI knowledge graphs and turned back into one once merged.
+    Curies and predicates are interned, edges are columns of (subject, predicate, object) string ids and
+    attributes are ids into a store of distinct attributes, so merging large responses neither copies nor
+    compares the same strings and attributes over and over.
+    """
+    def __init__(self):
+        self.curies = StringTable()
+        self.predicates = StringTable()
+        self.attribute_store = AttributeStore()
+        self.nodes = {}
+        self.edge_ids = StringTable()
+        self.subjects = array('l')
+        self.edge_predicates = array('l')
+        self.objects = array('l')
+        self.edge_attributes = []
+        self.edge_provenance = []
+
+    @classmethod
+    def merge(cls, kgraphs):
+        graph = cls()
+        for kgraph in kgraphs:
+            graph.add(kgraph)
+        return graph
+
+    def __len__(self):
+        return len(self.edge_ids)
+
+    def add(self, kgraph):
+        """ Merge a TRAPI knowledge graph into this one, nodes by curie and edges by id. """
+        for curie, knode in kgraph.get('nodes', {}).items():
+            self.add_node(curie, knode)
+        for edge_id, kedge in kgraph.get('edges', {}).items():
+            self.add_edge(edge_id, kedge)
+
+    def merge_attributes(self, attribute_ids, attributes):
+        """ The attribute ids of an element that had attribute_ids with attributes merged in. """
+        attribute_ids = attribute_ids or []
+        seen = set(attribute_ids)
+        for attribute in merge_listify([attributes]):
+            if attribute is None:
+                continue
+            attribute_id = self.attribute_store.intern(attribute)
+            if attribute_id not in seen:
+                seen.add(attribute_id)
+                attribute_ids.append(attribute_id)
+        return attribute_ids
+
+    def add_node(self, curie, knode):
+        node_id = self.curies.intern(curie)
+        node = self.nodes.get(node_id)
+        if node is None:
+            node = self.nodes[node_id] = KNode()
+        if node.name is None and 'name' in knode:
+            node.name = knode['name']
+        for field in ('category', 'categories'):
+            if field in knode:
+                categories = getattr(node, field) or []
+                for category in merge_listify([knode[field]]):
+                    if category not in categories:
+                        categories.append(category)
+                setattr(node, field, categories)
+        if 'attributes' in knode:
+            node.attributes = self.merge_attributes(node.attributes, knode['attributes'])
+        if PROVENANCE_KEY in knode:
+            node.provenance = (node.provenance or 0) | knode[PROVENANCE_KEY]
+
+    def add_edge(self, edge_id, kedge):
+        subject_id = self.curies.intern(kedge.get('subject'))
+        predicate_id = self.predicates.intern(kedge.get('predicate'))
+        object_id = self.curies.intern(kedge.get('object'))
+        row = self.edge_ids.ids.get(edge_id)
+        if row is None:
+            row = self.edge_ids.intern(edge_id)
+            self.subjects.append(subject_id)
+            self.edge_predicates.append(predicate_id)
+            self.objects.append(object_id)
+            self.edge_attributes.append(None)
+            self.edge_provenance.append(None)
+        elif self.edge_predicates[row] != predicate_id:
+            raise ValueError("Unable to merge edges with non matching predicates")
+        elif self.subjects[row] != subject_id:
+            raise ValueError("Unable to merge edges with non matching subjects")
+        elif self.objects[row] != object_id:
+            raise ValueError("Unable to merge edges with non matching objects")
+        if 'attributes' in kedge:
+            self.edge_attributes[row] = self.merge_attributes(self.edge_attributes[row], kedge['attributes'])
+        if PROVENANCE_KEY in kedge:
+            self.edge_provenance[row] = (self.edge_provenance[row] or 0) | kedge[PROVENANCE_KEY]
+
+    def trapi_attributes(self, attribute_ids):
+        # Copies, as attributes are shared between elements and get edited per element once serialized.
+        return [dict(self.attribute_store[attribute_id]) for attribute_id in attribute_ids]
+
+    def trapi_node(self, node, order_categories=True):
+        knode = {}
+        if node.name is not None:
+            knode['name'] = node.name
+        categories = node.category or node.categories
+        if categories:
+            # make leaves come first
+            knode['category'] = category_order.leaves_first(categories) if order_categories else list(categories)
+        if node.attributes is not None:
+            knode['attributes'] = self.trapi_attributes(node.attributes)
+        if node.provenance is not None:
+            knode[PROVENANCE_KEY] = node.provenance
+        return knode
+
+    def trapi_edge(self, row):
+        kedge = {}
+        if self.edge_attributes[row] is not None:
+            kedge['attributes'] = self.trapi_attributes(self.edge_attributes[row])
+        kedge['predicate'] = self.predicates[self.edge_predicates[row]]
+        kedge['subject'] = self.curies[self.subjects[row]]
+        kedge['object'] = self.curies[self.objects[row]]
+        if self.edge_provenance[row] is not None:
+            kedge[PROVENANCE_KEY] = self.edge_provenance[row]
+        return kedge
+
+    def to_trapi(self, order_categories=True):
+        """
+        The merged TRAPI knowledge graph.
+        :param order_categories: Put the leaf categories of nodes first. Otherwise they are in the order first seen.
+        """
+        return {
+            "nodes": {
+                self.curies[node_id]: self.trapi_node(node, order_categories) for node_id, node in self.nodes.items()
+            },
+            "edges": {self.edge_ids[row]: self.trapi_edge(row) for row in range(len(self.edge_ids))}
+        }
+
+    def publication_counts(self):
+        """ The number of publications of each edge, indexed by edge id. """
+        publications = array('l', (
+            len(attribute['value']) if is_publications(attribute) and attribute.get('value') else 0
+            for attribute in self.attribute_store.attributes
+        ))
+        indptr, indices = csr(attribute_ids or [] for attribute_ids in self.edge_attributes)
+        return segment_sum(publications, indptr, indices)
+
+
+class MergePool:
+    """
+    The process pool ShardedKnowledgeGraph merges in. It's started the first time it's needed and reused by
+    later merges, from a forkserver context where there is one, else a spawn context, so that workers aren't
+    forked from a request thread along with the locks other threads hold.
+    """
+    _executor = None
+    _processes = None
+    _pid = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def executor(cls, processes):
+        """ The pool, with `processes` workers. """
+        with cls._lock:
+            if cls._pid != os.getpid():
+                # A forked server worker starts its own pool.
+                cls._executor = None
+                cls._pid = os.getpid()
+            if cls._executor is not None and cls._processes != processes:
+                cls._executor.shutdown(wait=False)
+                cls._executor = None
+            if cls._executor is None:
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                cls._executor = ProcessPoolExecutor(max_workers=processes, mp_context=context)
+                cls._processes = processes
+        return cls._executor
+
+    @classmethod
+    def reset(cls, executor):
+        """ Drop a broken pool, so that the next merge starts another one. """
+        with cls._lock:
+            if cls._executor is executor:
+                cls._executor = None
+        executor.shutdown(wait=False)
+
+
+def merge_shard(shard):
+    """
+    Merge a shard of knowledge graphs in a worker process, like KnowledgeGraph. Categories are left unordered,
+    for the parent to order with its warm CategoryOrder.
+    :param shard: Marshalled (node ids, nodes, edge ids, edges) columns of each knowledge graph, in order.
+    :return: Marshalled (node ids, nodes, edge ids, edges, publication counts) columns of the merged shard.
+    """
+    # Merging makes millions of acyclic objects, and collecting cycles as they're made costs about as much as
+    # merging them.
+    gc.disable()
+    try:
+        kgraph = KnowledgeGraph()
+        for node_ids, nodes, edge_ids, edges in marshal.loads(shard):
+            for curie, knode in zip(node_ids, nodes):
+                kgraph.add_node(curie, knode)
+            for edge_id, kedge in zip(edge_ids, edges):
+                kgraph.add_edge(edge_id, kedge)
+        merged = kgraph.to_trapi(order_categories=False)
+        return marshal.dumps((list(merged["nodes"]), list(merged["nodes"].values()),
+                              list(merged["edges"]), list(merged["edges"].values()),
+                              [int(count) for count in kgraph.publication_counts()]))
+    finally:
+        gc.enable()
+
+
+class ShardedKnowledgeGraph:
+    """
+    Merges knowledge graphs like KnowledgeGraph, with their nodes and edges sharded by hashed id across the
+    processes of the MergePool. Each element is merged in one shard from the same elements, in the same order,
+    as in process, and shards share no ids, so the merged shards are combined as they are.
+    Shards go to the workers and come back as marshalled columns of ids and elements, which costs the parent
+    process a fraction of pickling TRAPI knowledge graphs, and of merging them.
+    """
+    def __init__(self, knowledge_graph, edge_ids, publications):
+        self.knowledge_graph = knowledge_graph
+        self.edge_ids = edge_ids
+        self.publications = publications
+
+    @staticmethod
+    def shards(kgraphs, shards):
+        """ The marshalled shards of knowledge graphs, each holding the elements of every knowledge graph whose ids hash to it. """
+        sharded = [[] for _ in range(shards)]
+        for kgraph in kgraphs:
+            columns = [([], [], [], []) for _ in range(shards)]
+            for key, knode in (kgraph.get('nodes') or {}).items():
+                shard = columns[hash(key) % shards]
+                shard[0].append(key)
+                shard[1].append(knode)
+            for key, kedge in (kgraph.get('edges') or {}).items():
+                shard = columns[hash(key) % shards]
+                shard[2].append(key)
+                shard[3].append(kedge)
+            for kgraphs_of_shard, shard in zip(sharded, columns):
+                kgraphs_of_shard.append(shard)
+        return [marshal.dumps(shard) for shard in sharded]
+
+    @classmethod
+    def merge(cls, kgraphs, processes):
+        """ Merge knowledge graphs in `processes` processes. If the pool breaks, they're merged in process. """
+        try:
+            shards = cls.shards(kgraphs, processes)
+        except ValueError:
+            # An element holds a value that isn't JSON, which marshal can't encode.
+            return KnowledgeGraph.merge(kgraphs)
+        executor = MergePool.executor(processes)
+        try:
+            merged_shards = list(executor.map(merge_shard, shards))
+        except BrokenProcessPool:
+            logger.exception("The merge process pool broke, merging in process.")
+            MergePool.reset(executor)
+            return KnowledgeGraph.merge(kgraphs)
+        nodes = {}
+        edges = {}
+        edge_ids = StringTable()
+        publications = array('l')
+        for merged_shard in merged_shards:
+            node_ids, knodes, shard_edge_ids, kedges, counts = marshal.loads(merged_shard)
+            nodes.update(zip(node_ids, knodes))
+            edges.update(zip(shard_edge_ids, kedges))
+            edge_ids.strings.extend(shard_edge_ids)
+            publications.extend(counts)
+        edge_ids.ids = dict(zip(edge_ids.strings, range(len(edge_ids.strings))))
+        for knode in nodes.values():
+            if 'category' in knode:
+                knode['category'] = category_order.leaves_first(knode['category'])
+        return cls({"nodes": nodes, "edges": edges}, edge_ids, publications)
+
+    def __len__(self):
+        return len(self.edge_ids)
+
+    def to_trapi(self):
+        """ The merged TRAPI knowledge graph. """
+        return self.knowledge_graph
+
+    def publication_counts(self):
+        """ The number of publications of each edge, as KnowledgeGraph.publication_counts. """
+        return self.publications
+
+
+def csr(rows):
+    """
+    Rows of indices in compressed sparse row form, (indptr, indices), the indices of row i being
+    indices[indptr[i]:indptr[i + 1]]. NumPy arrays if NumPy is installed.
+    """
+    indptr = array('l', [0])
+    indices = array('l')
+    for row in rows:
+        indices.extend(row)
+        indptr.append(len(indices))
+    if np is not None:
+        return np.asarray(indptr), np.asarray(indices)
+    return indptr, indices
+
+
+def segment_sum(values, indptr, indices):
+    """ For each row of a csr, the sum of the values its indices pick. """
+    if np is not None:
+        values = np.asarray(values)
+        lengths = np.diff(indptr)
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        return np.bincount(rows, weights=values[indices], minlength=len(lengths)).astype(values.dtype)
+    return [sum(values[index] for index in indices[indptr[row]:indptr[row + 1]]) for row in range(len(indptr) - 1)]
+
+
+def calc_score_based_on_publications(merged_kg, kgraph=None, edge_scores=None):
+    """
+    Score each result by the publications of the edges it binds. Edge scores are an array indexed by edge id
+    and the edge bindings of the results a csr of those indices, so every result is scored by one segmented sum.
+    :param kgraph: The message's knowledge graph as a KnowledgeGraph, ShardedKnowledgeGraph or SpilledKnowledgeGraph,
+        if it was merged into one.
+    :param edge_scores: With a kgraph, a function of it scoring each of its edges in place of
+        its publication_counts.
+    """
     bindings = merged_kg.get('results', [])
-    edge_scores = {}
-    for e in edges:
-        edge = edges[e]
-        attributes = edge.get('attributes', [])
-        attribute_name = 'publications'
-        current_edge_score = 0
-        for attr in attributes:
-            if (attribute_name == attr.get('original_attribute_name') or attribute_name == attr.get('name')) and len(attr['value']) > 0:
-                attr['value'] = [attr['value']] if isinstance(attr['value'], str) else attr['value']
-                current_edge_score += len(attr['value'])
-        edge_scores[e] = current_edge_score
-
-    for binding in bindings:
-        edge_bindings = binding.get('edge_bindings', {})
-        kg_ids = []
-        for edge_id in edge_bindings:
-            kg_ids += reduce(lambda a, b: a + [b['id']], edge_bindings[edge_id], [])
-        score = 0
-        for kg_id in kg_ids:
-            score += edge_scores.get(kg_id , 0)
+    if isinstance(kgraph, SpilledKnowledgeGraph):
+        # only the edges the results bind are read back.
+        edge_index, scores = kgraph.publication_counts(
+            bound['id']
+            for binding in bindings
+            for bound_list in (binding.get('edge_bindings') or {}).values()
+            for bound in bound_list
+        )
+    elif kgraph is not None:
+        edge_index = kgraph.edge_ids.ids
+        scores = edge_scores(kgraph) if edge_scores else kgraph.publication_counts()
+    else:
+        edges = merged_kg.get('knowledge_graph', {}).get('edges', {})
+        edge_index = {}
+        scores = array('l')
+        for e in edges:
+            edge = edges[e]
+            attributes = edge.get('attributes', [])
+            attribute_name = 'publications'
+            current_edge_score = 0
+            for attr in attributes:
+                if (attribute_name == attr.get('original_attribute_name') or attribute_name == attr.get('name')) and len(attr['value']) > 0:
+                    attr['value'] = [attr['value']] if isinstance(attr['value'], str) else attr['value']
+                    current_edge_score += len(attr['value'])
+            edge_index[e] = len(scores)
+            scores.append(current_edge_score)
+
+    indptr, indices = csr(
+        [
+            edge_index[bound['id']]
+            for bound_list in (binding.get('edge_bindings') or {}).values()
+            for bound in bound_list
+            if bound['id'] in edge_index
+        ]
+        for binding in bindings
+    )
+    result_scores = segment_sum(scores, indptr, indices)
+    if np is not None:
+        result_scores = result_scores.tolist()
+    for binding, score in zip(bindings, result_scores):
         binding['score'] = score
 
     return merged_kg
 
 
+def top_results(message, limit):
+    """
+    Keep the `limit` best scored results of a scored message, best first.
+    A bounded heap picks them without sorting the whole result set; ties keep their original order.
+    When results are dropped, so are the knowledge graph nodes and edges only they bound.
+    :param message: message scored by calc_score_based_on_publications
+    :param limit: number of results to keep
+    :return: message
+    """
+    results = message.get('results', [])
+    message['results'] = heapq.nlargest(limit, results, key=lambda result: result.get('score', 0))
+    if len(message['results']) < len(results) and message.get('knowledge_graph'):
+        prune_knowledge_graph(message)
+    return message
+
+
+def bound_ids(results):
+    """ The ids of the knowledge graph nodes and edges bound by results, (node ids, edge ids). """
+    node_ids = set()
+    edge_ids = set()
+    for result in results:
+        for bindings_map, ids in ((result.get('node_bindings'), node_ids), (result.get('edge_bindings'), edge_ids)):
+            for bindings in (bindings_map or {}).values():
+                ids.update(bound['id'] for bound in bindings)
+    return node_ids, edge_ids
+
+
+def prune_knowledge_graph(message):
+    """ Keep only the knowledge graph nodes and edges bound by the message's results, and the nodes of those edges. """
+    node_ids, edge_ids = bound_ids(message.get('results', []))
+    knowledge_graph = message['knowledge_graph']
+    edges = {edge_id: edge for edge_id, edge in (knowledge_graph.get('edges') or {}).items() if edge_id in edge_ids}
+    for edge in edges.values():
+        node_ids.update((edge.get('subject'), edge.get('object')))
+    knowledge_graph['nodes'] = {
+        node_id: node for node_id, node in (knowledge_graph.get('nodes') or {}).items() if node_id in node_ids
+    }
+    knowledge_graph['edges'] = edges
+    return message
+
+
+def result_join_key(result, on):
+    """ The bound ids of each concept in `on`. """
+    return tuple(
+        frozenset(bound['id'] for bound in result['node_bindings'].get(concept, []))
+        for concept in on
+    )
+
+
+def join_results(left, right, on):
+    """
+    Hash join two lists of results on the node bindings of shared concepts.
+    Results agreeing on the bound ids of every concept in `on` are combined into one result.
+    :param left: results
+    :param right: results
+    :param on: query graph node ids bound in both lists of results
+    :return: joined results
+    """
+    # skip placeholder results without bindings.
+    left = [result for result in left if result.get('node_bindings')]
+    right = [result for result in right if result.get('node_bindings')]
+    if not on:
+        # Disconnected paths, nothing to join on.
+        return left + right
+
+    # build the hash table over the smaller side and probe it with the larger one.
+    build, probe = (left, right) if len(left) <= len(right) else (right, left)
+    table = defaultdict(list)
+    for result in build:
+        table[result_join_key(result, on)].append(result)
+
+    joined = []
+    for result in probe:
+        for match in table.get(result_join_key(result, on), []):
+            joined.append({
+                'node_bindings': {**match['node_bindings'], **result['node_bindings']},
+                'edge_bindings': {**match['edge_bindings'], **result['edge_bindings']},
+                'score': 0
+            })
+    return joined
+
+
 def merge_query_graph(q_graphs):
     """
     Merges query graphs
@@ -423,22 +1129,114 @@ def merge_query_graph(q_graphs):
     return response
 
 
-def merge_messages(messages):
-    """Merge messages."""
-
+def merge_message_parts(messages):
+    """ The merged query graph, the knowledge graphs to merge and the connected results of messages. """
     # Build knowledge graph edge IDs so that we can merge duplicates
     for m in messages:
         build_unique_kg_edge_ids(m)
     # filter out messages that have query graph and knowledge graph
     qgraphs = [m.get('query_graph') for m in messages if m.get('query_graph')]
     kgraphs = [m.get("knowledge_graph") for m in messages if m.get('knowledge_graph')]
+    return merge_query_graph(qgraphs), kgraphs, connect_knowledge_maps(messages)
 
-    results_deduplicated = connect_knowledge_maps(messages)
 
-    merged =  {
-        "query_graph": merge_query_graph(qgraphs),
-        "knowledge_graph": merge_kgraphs(kgraphs),
-        "results": results_deduplicated
+def scored_message(query_graph, knowledge_graph, results, kgraph=None, limit=None):
+    """ A merged message, with its results scored and only the `limit` best kept if given. """
+    merged = {
+        "query_graph": query_graph,
+        "knowledge_graph": knowledge_graph,
+        "results": results
     }
-    merged = calc_score_based_on_publications(merged)
-    return merged
\ No newline at end of file
+    merged = calc_score_based_on_publications(merged, kgraph)
+    if limit is not None:
+        merged = top_results(merged, limit)
+    return merged
+
+
+def merge_messages(messages, limit=None, spill_threshold=None, spill_directory=None, processes=1, parallel_threshold=None):
+    """
+    Merge messages, keeping only the `limit` best scored results if given.
+    Knowledge graphs of spill_threshold bytes or more are merged on disk in spill_directory, then read back
+    into the merged message; stream_merged_messages doesn't read them back into memory. Smaller ones of
+    parallel_threshold bytes or more are merged in `processes` processes.
+    """
+    query_graph, kgraphs, results = merge_message_parts(messages)
+    knowledge_graph, kgraph = merged_kgraph(kgraphs, spill_threshold, spill_directory, processes, parallel_threshold)
+    return scored_message(query_graph, knowledge_graph, results, kgraph, limit)
+
+
+def stream_merged_messages(messages, limit=None, spill_threshold=None, spill_directory=None, processes=1,
+                           parallel_threshold=None):
+    """
+    Merge messages like merge_messages, as chunks of the merged message's JSON with reasoner provenance
+    expanded. A knowledge graph merged on disk is read back an element at a time as it's encoded.
+    Messages are merged and scored, and everything but the knowledge graph read back is encoded, by the time
+    the first chunk is made, so errors doing that are raised before any JSON is sent. An error reading the
+    knowledge graph back can only happen after the response has started: it is logged, and the message is
+    ended with no results and an "Error" status and errors list, as StandardAPIResource.handle_exception
+    reports them, so the streamed JSON stays well-formed.
+    """
+    query_graph, kgraphs, results = merge_message_parts(messages)
+    if spill_threshold is None or kgraphs_bytes(kgraphs) < spill_threshold:
+        knowledge_graph, kgraph = merged_kgraph(kgraphs, processes=processes, parallel_threshold=parallel_threshold)
+        yield json.dumps(expand_message(scored_message(query_graph, knowledge_graph, results, kgraph, limit)))
+        return
+    with SpilledKnowledgeGraph.merge(kgraphs, spill_directory) as kgraph:
+        merged = scored_message(query_graph, None, results, kgraph, limit)
+        # the knowledge graph is pruned as it's read back, as top_results would have.
+        keep = bound_ids(merged['results']) if len(merged['results']) < len(results) else None
+        results_json = json.dumps(merged["results"])
+        yield f'{{"query_graph": {json.dumps(query_graph)}, "knowledge_graph": '
+        try:
+            yield from kgraph.iter_json(keep)
+        except Exception as e:
+            logger.exception("Failed to read back the knowledge graph merged on disk.")
+            errors = [{"message": str(e), "details": ''}]
+            yield f', "results": [], "status": "Error", "errors": {json.dumps(errors)}}}'
+            return
+        yield f', "results": {results_json}}}'
+
+
+def benchmark(sizes=(100000, 400000, 1600000), processes=None, sources=4):
+    """
+    Compare merging knowledge graphs in process with merging them in a MergePool. Knowledge graphs of `sources`
+    sources, overlapping on about half their nodes and edges, are merged for each number of nodes and edges.
+    The parent's CPU time is the part of a parallel merge that doesn't shrink with more processes.
+    """
+    import random
+    import time
+    processes = processes or os.cpu_count() or 1
+    for size in sizes:
+        rnd = random.Random(size)
+        count = size // 2
+        kgraphs = []
+        for source in range(sources):
+            nodes = {}
+            for n in (rnd.randrange(count) for _ in range(count * 2 // sources)):
+                nodes[f'NCBIGene:{n}'] = {
+                    'name': f'gene {n}', 'categories': ['biolink:Gene', 'biolink:NamedThing'],
+                    'attributes': [{'attribute_type_id': 'biolink:same_as', 'value': [f'HGNC:{n}', f'ENSEMBL:{n}']},
+                                   {'attribute_type_id': 'biolink:source', 'value': f'kp{source}'}],
+                    PROVENANCE_KEY: 1 << source}
+            edges = {}
+            for e in (rnd.randrange(count) for _ in range(count * 2 // sources)):
+                edges[f'e{e}'] = {
+                    'subject': f'NCBIGene:{e}', 'object': f'NCBIGene:{e * 7 % count}', 'predicate': 'biolink:related_to',
+                    'attributes': [{'name': 'publications', 'value': [f'PMID:{e}', f'PMID:{e + 1}']},
+                                   {'attribute_type_id': 'biolink:knowledge_source', 'value': f'infores:kp{source}'}],
+                    PROVENANCE_KEY: 1 << source}
+            kgraphs.append({'nodes': nodes, 'edges': edges})
+        elements = sum(len(kgraph['nodes']) + len(kgraph['edges']) for kgraph in kgraphs)
+        MergePool.executor(processes)
+        start = time.perf_counter()
+        KnowledgeGraph.merge(kgraphs).to_trapi()
+        in_process = time.perf_counter() - start
+        start, start_cpu = time.perf_counter(), time.process_time()
+        ShardedKnowledgeGraph.merge(kgraphs, processes).to_trapi()
+        parallel, parent_cpu = time.perf_counter() - start, time.process_time() - start_cpu
+        print(f"{elements} nodes and edges: in process {in_process:.2f}s, {processes} processes {parallel:.2f}s "
+              f"of which {parent_cpu:.2f}s CPU in the parent")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,140 @@
+import threading
+
+PROVENANCE_KEY = '_reasoners'
+REASONER_ATTRIBUTE = 'reasoner'
+REASONER_ATTRIBUTE_TYPE = 'EDAM:data_0006'
+
+
+class SchemaRegistry:
+    """
+    Assign each schema (reasoner) name a bit, so the provenance of a knowledge graph element
+    is a single integer while queries execute and merging provenance is a bitwise or.
+    Names reach the registry from queries and API clients, so only the names of configured schemas
+    get a bit of their own, up to max_names of them. Any other name shares the OTHER bit.
+    """
+    OTHER = 'other'
+
+    def __init__(self, max_names=64):
+        self.max_names = max_names
+        self.names = [self.OTHER]
+        self.bits = {self.OTHER: 1}
+        self.allowed = set()
+        self.lock = threading.Lock()
+
+    def allow(self, names):
+        """
+        Let configured schema names be registered. A name also covers the graphs of a backend,
+        named `name:graph`.
+        """
+        with self.lock:
+            self.allowed.update(names)
+
+    def bit(self, name):
+        """ The bit of a schema name, registering an allowed name the first time it is seen. """
+        bit = self.bits.get(name)
+        if bit is None:
+            if name not in self.allowed and str(name).split(':', 1)[0] not in self.allowed:
+                return self.bits[self.OTHER]
+            with self.lock:
+                bit = self.bits.get(name)
+                if bit is None:
+                    if len(self.names) >= self.max_names:
+                        return self.bits[self.OTHER]
+                    bit = 1 << len(self.names)
+                    self.names.append(name)
+                    self.bits[name] = bit
+        return bit
+
+    def mask(self, names):
+        """ The mask of a list of schema names. """
+        mask = 0
+        for name in names:
+            mask |= self.bit(name)
+        return mask
+
+    def names_of(self, mask):
+        """ The schema names set in a mask, in registration order. """
+        names = []
+        index = 0
+        while mask:
+            if mask & 1:
+                names.append(self.names[index])
+            mask >>= 1
+            index += 1
+        return names
+
+
+registry = SchemaRegistry()
+
+
+def mark(element, mask):
+    """ Record that an element was returned by the schemas in `mask`. """
+    element[PROVENANCE_KEY] = element.get(PROVENANCE_KEY, 0) | mask
+
+
+def expand(element, names=()):
+    """
+    Replace the provenance mask of an element by a TRAPI reasoner attribute,
+    folding in reasoner values the element already had.
+    Elements that were never marked are left alone.
+    :param names: Reasoner names added without registering them.
+    """
+    if PROVENANCE_KEY not in element:
+        return element
+    names = list(dict.fromkeys(registry.names_of(element.pop(PROVENANCE_KEY)) + list(names)))
+    attributes = element.get('attributes') or []
+    has_reasoner_attribute = False
+    for attribute in attributes:
+        if attribute.get('name') == REASONER_ATTRIBUTE:
+            has_reasoner_attribute = True
+            value = attribute.get('value', [])
+            value = value if isinstance(value, list) else [value]
+            attribute['value'] = value + [name for name in names if name not in value]
+            attribute['type'] = REASONER_ATTRIBUTE_TYPE
+    if not has_reasoner_attribute:
+        attributes.append({
+            'name': REASONER_ATTRIBUTE,
+            'value': names,
+            'type': REASONER_ATTRIBUTE_TYPE
+        })
+    element['attributes'] = attributes
+    return element
+
+
+def expanded(element):
+    """ A copy of an element with its provenance expanded. The element itself is left as it is. """
+    if PROVENANCE_KEY not in element:
+        return element
+    element = dict(element)
+    # expand changes the reasoner attribute and the list of attributes, so those are copied.
+    element['attributes'] = [
+        dict(attribute) if isinstance(attribute, dict) and attribute.get('name') == REASONER_ATTRIBUTE else attribute
+        for attribute in element.get('attributes') or []
+    ]
+    return expand(element)
+
+
+def expanded_knowledge_graph(knowledge_graph):
+    """ A copy of a knowledge graph with the provenance of its elements expanded, sharing the elements without any. """
+    return {
+        **knowledge_graph,
+        'nodes': {identifier: expanded(node) for identifier, node in (knowledge_graph.get('nodes') or {}).items()},
+        'edges': {identifier: expanded(edge) for identifier, edge in (knowledge_graph.get('edges') or {}).items()}
+    }
+
+
+def expand_message(message, names=()):
+    """ Expand the provenance of every knowledge graph element of a message before it is serialized. """
+    knowledge_graph = message.get('knowledge_graph') or {}
+    for elements in (knowledge_graph.get('nodes') or {}, knowledge_graph.get('edges') or {}):
+        for element in elements.values():
+            expand(element, names)
+    return message
+
+
+def expand_response(response):
+    """ Expand the provenance of the message of a response, {"message": message}, if it has one. """
+    message = response.get('message') if isinstance(response, dict) else None
+    if isinstance(message, dict):
+        expand_message(message)
+    return response
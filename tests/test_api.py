@@ -1,3 +1,4 @@
+import gzip
 import json
 from unittest.mock import patch
 
@@ -243,6 +244,17 @@ def test_merge_messages (GraphInterfaceMock, client):
 
     assert ordered(response.json) == ordered(expected)
 
+@patch("PLATER.services.util.graph_adapter.GraphInterface._GraphInterface")
+def test_merge_messages_error (GraphInterfaceMock, client):
+    """ Messages that fail to merge give an error response rather than a started stream. """
+    response = client.post(
+        f'/tranql/merge_messages',
+        data=json.dumps([{"knowledge_graph": {"nodes": {}, "edges": {}}}]),
+        content_type='application/json'
+    )
+    assert response.status_code == 500
+    assert response.json == {"status": "Error", "errors": [{"message": "'message'", "details": ""}]}
+
 """
 [schema]
 """
@@ -253,6 +265,36 @@ def test_schema(GraphIntefaceMock, client, requests_mock):
     assert 'schema' in response
     assert 'knowledge_graph' in response['schema']
 
+@patch("PLATER.services.util.graph_adapter.GraphInterface._GraphInterface")
+def test_schema_etag(GraphIntefaceMock, client, requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    response = client.get('/tranql/schema')
+    etag = response.headers['ETag']
+    assert response.status_code == 200
+
+    unchanged = client.get('/tranql/schema', headers={'If-None-Match': etag})
+    assert unchanged.status_code == 304
+    assert unchanged.data == b''
+
+    compressed = client.get('/tranql/schema', headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert compressed.headers['ETag'] != etag
+    assert json.loads(gzip.decompress(compressed.data)) == response.json
+
+@patch("PLATER.services.util.graph_adapter.GraphInterface._GraphInterface")
+def test_schema_paths(GraphIntefaceMock, client, requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    response = client.get('/tranql/schema/paths', query_string={'source': 'biolink:ChemicalEntity', 'max_hops': 1}).json
+    assert 'biolink_Gene' in response['reachable']
+    assert set(response['reachable'].values()) == {1}
+
+    response = client.get('/tranql/schema/paths', query_string={'source': 'chemical_entity', 'target': 'gene', 'max_hops': 2}).json
+    assert ['biolink_Chemical_entity', 'biolink_Gene'] in [path['concepts'] for path in response['paths']]
+    assert all(len(path['concepts']) <= 3 for path in response['paths'])
+    assert 'biolink_Gene' in response['next']
+
+    assert client.get('/tranql/schema/paths', query_string={'max_hops': 2}).status_code == 400
+
 def test_model_concepts(client, requests_mock):
     response = client.post('/tranql/model/concepts')
     assert isinstance(response.json,list)
@@ -1,20 +1,25 @@
 import copy
+import json
 import os
 import time
 from functools import reduce
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 
+import pytest
 import requests
 import requests_mock
 import yaml
 
 from tests.mocks import MockHelper
 from tests.mocks import MockMap
-from tests.util import assert_lists_equal, set_mock, ordered
+from tests.util import assert_lists_equal, set_mock, ordered, patch_graph_interface
 from tranql.main import TranQL, TranQLIncompleteParser
-from tranql.tranql_ast import SetStatement, SelectStatement, custom_functions
+from tranql.tranql_ast import SetStatement, SelectStatement, Edge, custom_functions
 from tranql.tranql_schema import SchemaFactory
-from tranql.utils.merge_utils import connect_knowledge_maps, find_all_paths
+from tranql.util import Concept
+from tranql.utils import provenance
+from tranql.utils.merge_utils import connect_knowledge_maps, overlay_score, top_results, find_all_paths, join_results, merge_messages, merge_kgraphs, KnowledgeGraph, calc_score_based_on_publications
+from tranql.utils import merge_utils
 
 
 #set_verbose ()
@@ -323,6 +328,56 @@ def test_parse_query_with_repeated_concept (GraphInterfaceMock, requests_mock):
              ]
             ]])
 
+@patch("PLATER.services.util.graph_adapter.GraphInterface._GraphInterface")
+def test_parse_branching_select (GraphInterfaceMock, requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Verify comma separated paths parse into one select statement. """
+    assert_parse_tree (
+        code = """
+        SELECT gene->disease, gene->chemical_entity
+          FROM "/schema"
+        """,
+        expected = [
+            [["select", "gene", "->", "disease", ",", "gene", "->", "chemical_entity", "\n"],
+             "          ",
+             ["from", ["/schema"]],
+             [""],
+             [""]]
+        ])
+
+@patch("PLATER.services.util.graph_adapter.GraphInterface._GraphInterface")
+def test_parse_limit (GraphInterfaceMock, requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    """ Verify the limit clause parses and is passed to services unless answers are ordered by score. """
+    assert_parse_tree (
+        code = """
+        SELECT gene->disease
+          FROM "/graph/gamma/quick"
+         WHERE gene='HGNC:1'
+         LIMIT 10 ORDER BY score
+        """,
+        expected = [
+            [["select", "gene", "->", "disease", "\n"],
+             "          ",
+             ["from", ["/graph/gamma/quick"]],
+             ["where", ["gene", "=", "HGNC:1"]],
+             ["limit", 10, "order", "by", "score"],
+             "\n",
+             [""]]
+        ])
+    tranql = TranQL ()
+    tranql.resolve_names = False
+    select = tranql.parse ("""
+        SELECT gene->disease
+          FROM "/graph/gamma/quick"
+         WHERE gene='HGNC:1'
+         LIMIT 10
+    """).statements[0]
+    assert select.limit == 10 and select.order_by is None
+    assert select.get_TRAPI_options (tranql) == { "limit": ["=", 10] }
+    select.order_by = "score"
+    assert select.get_TRAPI_options (tranql) == {}
+
 ######################################################################################
 # TranQLIncompleteParser tests. For /tranql/parse_incomplete autocompletion endpoint #
 ######################################################################################
@@ -394,6 +449,46 @@ def test_parse_incomplete_select_clause():
         ]]
     )
 
+def test_parse_incomplete_branching_select_clause():
+    _test_parse_incomplete(
+        """select gene->disease, gene->chemical_substance, chemical_substance<-""",
+        [[
+            [
+                "select",
+                "gene", "->", "disease",
+                ",",
+                "gene", "->", "chemical_substance",
+                ",",
+                "chemical_substance", "<-"
+            ]
+        ]]
+    )
+    _test_parse_incomplete(
+        """select gene->disease, """,
+        [[
+            [
+                "select",
+                "gene", "->", "disease",
+                ","
+            ]
+        ]]
+    )
+    _test_parse_incomplete(
+        """select gene->disease, gene->chemical_substance from '/sch""",
+        [[
+            [
+                "select",
+                "gene", "->", "disease",
+                ",",
+                "gene", "->", "chemical_substance"
+            ],
+            [
+                "from",
+                [["'", "/sch"]]
+            ]
+        ]]
+    )
+
 #####################
 # From clause tests #
 #####################
@@ -804,6 +899,316 @@ def test_ast_decorate_element (GraphInterfaceMock, requests_mock):
             break
     assert has_reasoner_attr
     # assert_lists_equal(edge["source_database"],["unknown"])
+def test_provenance_registry ():
+    """ Only configured schema names get a bit of their own, up to the registry's cap. """
+    registry = provenance.SchemaRegistry (max_names=3)
+    registry.allow (["kp1", "redis"])
+    assert registry.bit ("kp1") == 2
+    assert registry.bit ("redis:test") == 4
+    # names a client made up, and allowed names past the cap, share the other bit.
+    assert registry.bit ("made-up") == 1
+    registry.allow (["kp2"])
+    assert registry.bit ("kp2") == 1
+    assert registry.names == ["other", "kp1", "redis:test"]
+    assert registry.names_of (registry.mask (["kp1", "kp2", "made-up"])) == ["other", "kp1"]
+
+def test_merge_reasoner_provenance ():
+    provenance.registry.allow (["robokop", "rtx"])
+    messages = []
+    for reasoner in ("robokop", "rtx"):
+        message = {
+            "knowledge_graph": {
+                "nodes": { "CHEBI:1": { "name": "a" } },
+                "edges": { "e0": { "subject": "CHEBI:1", "object": "MONDO:1", "predicate": "biolink:treats" } }
+            }
+        }
+        SelectStatement.mark_result (message, { "schema": reasoner })
+        messages.append (message)
+    # a reasoner attribute supplied by the service is kept
+    messages[1]["knowledge_graph"]["nodes"]["CHEBI:1"]["attributes"] = [
+        { "name": "reasoner", "value": "robokop", "type": "EDAM:data_0006" }
+    ]
+    merged = { "knowledge_graph": merge_kgraphs ([ m["knowledge_graph"] for m in messages ]) }
+    provenance.expand_message (merged)
+    node = merged["knowledge_graph"]["nodes"]["CHEBI:1"]
+    edge = merged["knowledge_graph"]["edges"]["e0"]
+    assert node["attributes"] == [{ "name": "reasoner", "value": ["robokop", "rtx"], "type": "EDAM:data_0006" }]
+    assert len(edge["attributes"]) == 1
+    assert sorted(edge["attributes"][0]["value"]) == ["robokop", "rtx"]
+    assert provenance.PROVENANCE_KEY not in node
+
+def test_knowledge_graph_merge ():
+    """ Knowledge graphs merge into interned nodes and edges, shared attributes stored once. """
+    publications = { "name": "publications", "value": "PMID:1" }
+    kgraphs = [
+        {
+            "nodes": {
+                "CHEBI:1": { "name": "a", "category": "biolink:ChemicalSubstance", "attributes": [ { "name": "x", "value": { "b": 1, "a": [1, 2] } } ] },
+                "MONDO:1": { "category": ["biolink:Disease"] }
+            },
+            "edges": { "e0": { "subject": "CHEBI:1", "object": "MONDO:1", "predicate": "biolink:treats", "attributes": [ publications ] } }
+        },
+        {
+            "nodes": {
+                "CHEBI:1": { "name": "b", "category": ["biolink:ChemicalSubstance", "biolink:Drug"], "attributes": [ { "name": "x", "value": { "a": [1, 2], "b": 1 } } ] }
+            },
+            "edges": {
+                "e0": { "subject": "CHEBI:1", "object": "MONDO:1", "predicate": "biolink:treats", "attributes": [ dict(publications), None ] },
+                "e1": { "subject": "MONDO:1", "object": "CHEBI:1", "predicate": "biolink:related_to", "attributes": [ { "name": "publications", "value": ["PMID:2", "PMID:3"] }, { "name": "x", "value": True } ] }
+            }
+        }
+    ]
+    kgraph = KnowledgeGraph.merge (kgraphs)
+    assert len(kgraph.curies) == 2 and len(kgraph.predicates) == 2 and len(kgraph) == 2
+    # { "b": 1, "a": [1, 2] } is stored once, and True is not the same value as 1.
+    assert len(kgraph.attribute_store) == 4
+    merged = kgraph.to_trapi ()
+    node = merged["nodes"]["CHEBI:1"]
+    assert node["name"] == "a"
+    assert sorted(node["category"]) == ["biolink:ChemicalSubstance", "biolink:Drug"]
+    assert node["attributes"] == [ { "name": "x", "value": { "b": 1, "a": [1, 2] } } ]
+    assert "attributes" not in merged["nodes"]["MONDO:1"]
+    assert merged["edges"]["e0"] == {
+        "attributes": [ { "name": "publications", "value": ["PMID:1"] } ],
+        "predicate": "biolink:treats", "subject": "CHEBI:1", "object": "MONDO:1"
+    }
+    assert list(kgraph.publication_counts ()) == [1, 2]
+    assert merge_kgraphs (kgraphs) == merged
+    with pytest.raises(ValueError):
+        kgraph.add ({ "edges": { "e0": { "subject": "CHEBI:1", "object": "MONDO:1", "predicate": "biolink:causes" } } })
+
+@pytest.mark.parametrize("vectorized", [True, False])
+def test_calc_score_based_on_publications (vectorized, monkeypatch):
+    """ Results are scored by the publications of their edges, with or without NumPy. """
+    if not vectorized:
+        monkeypatch.setattr (merge_utils, "np", None)
+    elif merge_utils.np is None:
+        pytest.skip ("numpy is not installed")
+    def message ():
+        return {
+            "knowledge_graph": {
+                "nodes": {},
+                "edges": {
+                    "e0": { "subject": "A", "object": "B", "predicate": "biolink:treats", "attributes": [ { "name": "publications", "value": "PMID:1" } ] },
+                    "e1": { "subject": "B", "object": "C", "predicate": "biolink:treats", "attributes": [ { "original_attribute_name": "publications", "value": ["PMID:2", "PMID:3"] } ] },
+                    "e2": { "subject": "C", "object": "D", "predicate": "biolink:treats" }
+                }
+            },
+            "results": [
+                { "node_bindings": {}, "edge_bindings": { "x": [ { "id": "e0" } ], "y": [ { "id": "e1" } ] } },
+                { "node_bindings": {}, "edge_bindings": { "x": [ { "id": "e1" }, { "id": "e2" }, { "id": "missing" } ] } },
+                { "node_bindings": {}, "edge_bindings": {} }
+            ]
+        }
+    scored = calc_score_based_on_publications (message ())
+    assert [ result["score"] for result in scored["results"] ] == [3, 2, 0]
+    assert scored["knowledge_graph"]["edges"]["e0"]["attributes"][0]["value"] == ["PMID:1"]
+    merged = message ()
+    kgraph = KnowledgeGraph.merge ([ merged["knowledge_graph"] ])
+    scored = calc_score_based_on_publications (merged, kgraph)
+    assert [ result["score"] for result in scored["results"] ] == [3, 2, 0]
+    # other edge scores reuse the same result arrays
+    scored = calc_score_based_on_publications (merged, kgraph, lambda kgraph: [ 0.5 ] * len(kgraph))
+    assert [ result["score"] for result in scored["results"] ] == [1.0, 1.0, 0]
+    assert all (type(result["score"]) in (int, float) for result in scored["results"])
+
+def test_category_order ():
+    """ Categories are ordered leaves first, each category and combination looked up in the biolink model once. """
+    class Toolkit:
+        ancestors = {
+            "biolink:SmallMolecule": ["biolink:ChemicalEntity", "biolink:NamedThing"],
+            "biolink:Drug": ["biolink:ChemicalEntity", "biolink:NamedThing"],
+            "biolink:ChemicalEntity": ["biolink:NamedThing"]
+        }
+        calls = []
+        def get_ancestors (self, category, reflexive=False, formatted=True):
+            self.calls.append (category)
+            return self.ancestors.get (category, [])
+    toolkit = Toolkit ()
+    order = merge_utils.CategoryOrder (toolkit, size=2)
+    categories = ["biolink:NamedThing", "biolink:SmallMolecule", "biolink:ChemicalEntity", "biolink:Drug"]
+    assert order.leaves_first (categories) == ["biolink:Drug", "biolink:SmallMolecule", "biolink:ChemicalEntity", "biolink:NamedThing"]
+    assert order.leaves (categories) == ["biolink:Drug", "biolink:SmallMolecule"]
+    assert order.leaves_first (list(reversed(categories))) == order.leaves_first (categories)
+    assert len(toolkit.calls) == 4
+    order.leaves_first (["biolink:Drug"])
+    order.leaves_first (["biolink:ChemicalEntity"])
+    assert len(order.orders) == 2
+    assert len(toolkit.calls) == 4
+
+def test_parallel_merge ():
+    """ Merging shards of knowledge graphs in a pool of processes gives the knowledge graph and scores merging in process does. """
+    def kgraph (i):
+        return {
+            "nodes": {
+                f"CHEBI:{n}": { "name": f"{i}-{n}", "category": ["biolink:NamedThing", "biolink:Gene"], "attributes": [ { "name": "x", "value": i % 2 } ],
+                                "_reasoners": 1 << (i % 3) }
+                for n in range(i, i + 20)
+            },
+            "edges": {
+                f"e{n}": { "subject": f"CHEBI:{n}", "object": f"CHEBI:{n + 1}", "predicate": "biolink:related_to",
+                           "attributes": [ { "name": "publications", "value": [f"PMID:{i}"] } ] }
+                for n in range(i, i + 20)
+            }
+        }
+    kgraphs = [ kgraph (i) for i in range(0, 40, 10) ]
+    expected = merge_utils.KnowledgeGraph.merge (kgraphs)
+    merged = merge_utils.ShardedKnowledgeGraph.merge (kgraphs, 2)
+    assert merged.to_trapi () == expected.to_trapi ()
+    assert merged.to_trapi ()["nodes"]["CHEBI:15"]["category"] == ["biolink:Gene", "biolink:NamedThing"]
+    assert { edge_id: merged.publication_counts ()[row] for edge_id, row in merged.edge_ids.ids.items () } == \
+        { edge_id: expected.publication_counts ()[row] for edge_id, row in expected.edge_ids.ids.items () }
+    # the pool is started once and reused.
+    assert merge_utils.MergePool.executor (2) is merge_utils.MergePool.executor (2)
+
+    knowledge_graph, sharded = merge_utils.merged_kgraph (kgraphs, processes=2, parallel_threshold=0)
+    assert isinstance (sharded, merge_utils.ShardedKnowledgeGraph) and knowledge_graph == expected.to_trapi ()
+    assert isinstance (merge_utils.merged_kgraph (kgraphs, processes=2, parallel_threshold=10 ** 9)[1], merge_utils.KnowledgeGraph)
+    message = lambda: { "knowledge_graph": kgraph (0), "results": [
+        { "node_bindings": { "n0": [ { "id": "CHEBI:1" } ] }, "edge_bindings": { "e": [ { "id": "e1" } ] } }
+    ] }
+    assert merge_messages ([ message (), message () ], processes=2, parallel_threshold=0) == merge_messages ([ message (), message () ])
+    with pytest.raises(ValueError):
+        merge_utils.ShardedKnowledgeGraph.merge (kgraphs + [ { "edges": { "e1": { "subject": "MONDO:1", "object": "CHEBI:1", "predicate": "biolink:treats" } } } ], 2)
+
+def test_spilled_merge (tmp_path):
+    """ Merging on disk gives the same knowledge graph as merging in memory, and cleans up after itself. """
+    kgraphs = [
+        {
+            "nodes": {
+                "CHEBI:1": { "name": "a", "category": "biolink:ChemicalSubstance", "attributes": [ { "name": "x", "value": { "b": 1, "a": 2 } } ], "_reasoners": 1 },
+                "MONDO:1": { "categories": ["biolink:Disease"] }
+            },
+            "edges": { "e0": { "subject": "CHEBI:1", "object": "MONDO:1", "predicate": "biolink:treats", "attributes": [ { "name": "publications", "value": "PMID:1" } ] } }
+        },
+        {
+            "nodes": {
+                "CHEBI:1": { "name": "b", "category": ["biolink:Drug"], "attributes": [ { "name": "x", "value": { "a": 2, "b": 1 } }, None ], "_reasoners": 2 },
+                **{ f"CHEBI:{n}": { "name": str(n) } for n in range(2, 50) }
+            },
+            "edges": {
+                "e0": { "subject": "CHEBI:1", "object": "MONDO:1", "predicate": "biolink:treats", "attributes": [ { "name": "publications", "value": ["PMID:1"] } ] },
+                "e1": { "subject": "MONDO:1", "object": "CHEBI:1", "predicate": "biolink:related_to" }
+            }
+        }
+    ]
+    with merge_utils.SpilledKnowledgeGraph.merge (kgraphs, directory=str(tmp_path), batch_size=7) as kgraph:
+        merged = kgraph.to_trapi ()
+        assert list(tmp_path.iterdir ())
+    assert not list(tmp_path.iterdir ())
+    expected = merge_kgraphs (kgraphs)
+    assert merged == expected
+    assert json.dumps (merged) == json.dumps (expected)
+    assert merge_utils.merged_kgraph (kgraphs, spill_threshold=1, spill_directory=str(tmp_path)) == (expected, None)
+    with pytest.raises(ValueError):
+        merge_utils.SpilledKnowledgeGraph.merge (kgraphs + [ { "edges": { "e1": { "subject": "MONDO:1", "object": "CHEBI:1", "predicate": "biolink:treats" } } } ],
+                                                 directory=str(tmp_path))
+    assert not list(tmp_path.iterdir ())
+
+def test_stream_merged_messages (tmp_path):
+    """ Streaming a merge gives the merged message, its knowledge graph pruned to the kept results when merged on disk. """
+    provenance.registry.allow (["kp1"])
+    mask = provenance.registry.bit ("kp1")
+    def messages ():
+        return [
+            {
+                "query_graph": { "nodes": { "n0": {}, "n1": {} }, "edges": { "e": { "subject": "n0", "object": "n1" } } },
+                "knowledge_graph": {
+                    "nodes": { f"CHEBI:{n}": { "name": str(n), "categories": ["biolink:ChemicalEntity"], "_reasoners": mask } for n in range(i, i + 6) },
+                    "edges": {
+                        f"e{n}": { "subject": f"CHEBI:{n}", "object": f"CHEBI:{n + 1}", "predicate": "biolink:related_to",
+                                   "attributes": [ { "name": "publications", "value": [ f"PMID:{p}" for p in range(n) ] } ] }
+                        for n in range(i, i + 5)
+                    }
+                },
+                "results": [
+                    { "node_bindings": { "n0": [ { "id": f"CHEBI:{n}" } ], "n1": [ { "id": f"CHEBI:{n + 1}" } ] },
+                      "edge_bindings": { "e": [ { "id": f"e{n}" } ] } }
+                    for n in range(i, i + 5)
+                ]
+            }
+            for i in (0, 3)
+        ]
+    for limit in (None, 2):
+        expected = merge_messages (messages (), limit)
+        provenance.expand_message (expected)
+        for spill_threshold in (None, 0):
+            streamed = merge_utils.stream_merged_messages (messages (), limit, spill_threshold, str(tmp_path))
+            assert json.loads (''.join (streamed)) == expected
+    assert len(expected["results"]) == 2 and len(expected["knowledge_graph"]["edges"]) == 2
+    assert expected["knowledge_graph"]["nodes"]["CHEBI:7"]["attributes"][0]["value"] == ["kp1"]
+    # Failing part way through reading the graph back still ends the streamed JSON, reporting the error.
+    def edges (self):
+        raise RuntimeError ("disk read failed")
+        yield
+    with patch.object (merge_utils.SpilledKnowledgeGraph, "edges", edges):
+        failed = json.loads (''.join (merge_utils.stream_merged_messages (messages (), None, 0, str(tmp_path))))
+    assert len(failed["knowledge_graph"]["nodes"]) == 9 and failed["knowledge_graph"]["edges"] == {}
+    assert failed["results"] == [] and failed["status"] == "Error"
+    assert failed["errors"] == [ { "message": "disk read failed", "details": "" } ]
+    assert not list(tmp_path.iterdir ())
+
+def test_spilled_merge_memory (tmp_path):
+    """ A knowledge graph merged on disk is read back in bounded memory, where to_trapi holds all of it. """
+    import tracemalloc
+    kgraphs = [
+        {
+            "nodes": { f"CHEBI:{n}": { "name": f"{n}" * 50, "categories": ["biolink:ChemicalEntity"] } for n in range(i, i + 4000) },
+            "edges": { f"e{n}": { "subject": f"CHEBI:{n}", "object": f"CHEBI:{n + 1}", "predicate": "biolink:related_to",
+                                  "attributes": [ { "name": "publications", "value": [ f"PMID:{n}" ] * 20 } ] }
+                       for n in range(i, i + 3999) }
+        }
+        for i in (0, 2000)
+    ]
+    def peak (merge):
+        tracemalloc.start ()
+        try:
+            size = merge ()
+            return size, tracemalloc.get_traced_memory ()[1]
+        finally:
+            tracemalloc.stop ()
+    def streamed ():
+        with merge_utils.SpilledKnowledgeGraph.merge (kgraphs, str(tmp_path), batch_size=100) as kgraph:
+            return sum (len(chunk) for chunk in kgraph.iter_json ())
+    def materialized ():
+        with merge_utils.SpilledKnowledgeGraph.merge (kgraphs, str(tmp_path), batch_size=100) as kgraph:
+            return len(json.dumps (kgraph.to_trapi ()))
+    size, streamed_peak = peak (streamed)
+    materialized_size, materialized_peak = peak (materialized)
+    assert size == materialized_size
+    # Merging holds a batch of elements at a time, and reading back one element.
+    assert streamed_peak < size / 2
+    assert streamed_peak < materialized_peak / 10
+
+def test_select_execute_expands_provenance (requests_mock):
+    """ Answers keep provenance masks while they are merged, but leave a select statement with reasoner attributes. """
+    set_mock(requests_mock, "workflow-5")
+    tranql = TranQL (options={
+        'recreate_schema': True
+    })
+    select = tranql.parse ("""
+        SELECT chemical_entity->disease
+          FROM "/graph/gamma/quick"
+    """).statements[0]
+    provenance.registry.allow (["robokop", "rtx"])
+    def answer (statement, interpreter):
+        message = { "knowledge_graph": { "nodes": { "CHEBI:1": {} }, "edges": {} }, "results": [] }
+        SelectStatement.mark_result (message, { "schema": "robokop" })
+        assert provenance.PROVENANCE_KEY in message["knowledge_graph"]["nodes"]["CHEBI:1"]
+        return { "message": message }
+    with patch.object (SelectStatement, "answer", answer):
+        response = select.execute (tranql)
+    node = response["message"]["knowledge_graph"]["nodes"]["CHEBI:1"]
+    assert provenance.PROVENANCE_KEY not in node
+    assert node["attributes"] == [{ "name": "reasoner", "value": ["robokop"], "type": "EDAM:data_0006" }]
+    assert tranql.context.mem["result"] is response
+
+    message = { "knowledge_graph": { "nodes": { "CHEBI:1": {} }, "edges": {} } }
+    SelectStatement.decorate_result (message, { "schema": "rtx" })
+    assert message["knowledge_graph"]["nodes"]["CHEBI:1"] == {
+        "id": "CHEBI:1", "attributes": [{ "name": "reasoner", "value": ["rtx"], "type": "EDAM:data_0006" }]
+    }
+
 def test_ast_resolve_name (requests_mock):
     set_mock(requests_mock, "resolve_name")
     """ Validate that
@@ -1168,6 +1573,186 @@ def test_ast_plan_statements (requests_mock):
         (statements[0].service == "/graph/rtx" and statements[1].service == "/graph/gamma/quick")
     )
 
+def test_ast_sort_plan (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    tranql = TranQL (options={
+        'recreate_schema': True
+    })
+    select = tranql.parse ("""
+        SELECT disease->gene
+          FROM '/schema'
+    """).statements[0]
+    disease, gene, chemical, pathway, cell, anatomy = [
+        Concept (name=name, type_name=name)
+        for name in ["disease", "gene", "chemical", "pathway", "cell", "anatomy"]
+    ]
+    gene.set_curies (["HGNC:1"])
+    arrow = Edge (direction="->")
+    # chemical->disease is only reachable through the disease arm of the hub gene
+    chemical_disease = ["rtx", "/graph/rtx", [[chemical, arrow, disease]]]
+    disease_gene_gamma = ["robokop", "/graph/gamma/quick", [[disease, arrow, gene]]]
+    disease_gene_rtx = ["rtx", "/graph/rtx", [[disease, arrow, gene]]]
+    gene_pathway = ["robokop", "/graph/gamma/quick", [[gene, arrow, pathway]]]
+    cell_anatomy = ["robokop", "/graph/gamma/quick", [[cell, arrow, anatomy]]]
+
+    plan = [chemical_disease, disease_gene_gamma, cell_anatomy, gene_pathway, disease_gene_rtx]
+    sorted_plan = select.sort_plan (plan)
+    assert sorted_plan == [
+        # bound hub first, keeping segments for the same path together
+        disease_gene_gamma, disease_gene_rtx, gene_pathway,
+        chemical_disease,
+        # disconnected components come last instead of looping forever
+        cell_anatomy
+    ]
+
+    gene.set_curies ([])
+    assert select.sort_plan (plan) == plan
+
+def test_ast_plan_handoff_non_adjacent (requests_mock):
+    """ Handoff binds a concept from whichever earlier segment bound it, not only the previous one. """
+    set_mock(requests_mock, "workflow-5")
+    tranql = TranQL (options={
+        'recreate_schema': True
+    })
+    select = tranql.parse ("""
+        SELECT disease->gene
+          FROM '/schema'
+    """).statements[0]
+    # the planner is patched to split chemical->disease->gene->pathway across reasoners
+    disease, gene, chemical, pathway = [
+        Concept (name=name, type_name=name)
+        for name in ["disease", "gene", "chemical", "pathway"]
+    ]
+    gene.set_curies (["HGNC:1"])
+    arrow = Edge (direction="->")
+    plan = [
+        ["rtx", "/graph/rtx", [[chemical, arrow, disease]]],
+        ["robokop", "/graph/gamma/quick", [[disease, arrow, gene]]],
+        ["robokop", "/graph/gamma/quick", [[gene, arrow, pathway]]],
+    ]
+    answers = {
+        ("disease", "gene"): [
+            { "node_bindings": { "disease": [{"id": "MONDO:1"}], "gene": [{"id": "HGNC:1"}] }, "edge_bindings": {} },
+            { "node_bindings": { "disease": [{"id": "MONDO:2"}], "gene": [{"id": "HGNC:1"}] }, "edge_bindings": {} }
+        ],
+        ("gene", "pathway"): [
+            { "node_bindings": { "gene": [{"id": "HGNC:1"}], "pathway": [{"id": "REACT:1"}] }, "edge_bindings": {} }
+        ],
+        ("chemical", "disease"): [
+            { "node_bindings": { "chemical": [{"id": "CHEBI:1"}], "disease": [{"id": "MONDO:2"}] }, "edge_bindings": {} }
+        ],
+    }
+    executed = []
+    def execute (statement, interpreter, context={}):
+        order = tuple(statement.query.order)
+        executed.append ((order, { name: list(statement.query[name].curies) for name in order }))
+        return { "message": { "knowledge_graph": { "nodes": {}, "edges": {} }, "results": answers[order] } }
+
+    with patch.object (select.planner, "plan", lambda query: plan), patch.object (SelectStatement, "answer", execute):
+        select.execute_plan (tranql)
+    assert [ order for order, curies in executed ] == [ ("disease", "gene"), ("gene", "pathway"), ("chemical", "disease") ]
+    # chemical->disease follows gene->pathway, but its diseases are those disease->gene bound.
+    assert executed[2][1]["disease"] == ["MONDO:1", "MONDO:2"]
+    assert executed[1][1]["gene"] == ["HGNC:1"]
+
+def test_ast_branching_query (requests_mock):
+    set_mock(requests_mock, "workflow-5")
+    tranql = TranQL (options={
+        'recreate_schema': True
+    })
+    select = tranql.parse ("""
+        SELECT gene->disease, gene->chemical_entity, chemical_entity<-pathway
+          FROM '/schema'
+         WHERE gene = 'HGNC:1'
+    """).statements[0]
+    assert [ path.order for path in select.query.paths () ] == [
+        ["gene", "disease"], ["gene", "chemical_entity"], ["chemical_entity", "pathway"]
+    ]
+    # paths bind copies of the shared concept
+    assert select.query.paths ()[1]["gene"] is not select.query["gene"]
+    assert select.query.paths ()[1]["gene"].curies == ["HGNC:1"]
+
+    question = select.generate_questions (tranql)['message']['query_graph']
+    assert set(question['nodes'].keys()) == { "gene", "disease", "chemical_entity", "pathway" }
+    assert question['edges'] == {
+        "e1_gene_disease": { "subject": "gene", "object": "disease" },
+        "e3_gene_chemical_entity": { "subject": "gene", "object": "chemical_entity" },
+        "e5_pathway_chemical_entity": { "subject": "pathway", "object": "chemical_entity" },
+    }
+
+    answers = {
+        ("gene", "disease"): [
+            { "node_bindings": { "gene": [{"id": "HGNC:1"}], "disease": [{"id": "MONDO:1"}] },
+              "edge_bindings": { "e1_gene_disease": [{"id": "kg_gene_disease"}] } }
+        ],
+        ("gene", "chemical_entity"): [
+            { "node_bindings": { "gene": [{"id": "HGNC:1"}], "chemical_entity": [{"id": "CHEBI:1"}] },
+              "edge_bindings": { "e1_gene_chemical_entity": [{"id": "kg_gene_chemical_1"}] } },
+            { "node_bindings": { "gene": [{"id": "HGNC:1"}], "chemical_entity": [{"id": "CHEBI:2"}] },
+              "edge_bindings": { "e1_gene_chemical_entity": [{"id": "kg_gene_chemical_2"}] } },
+        ],
+        ("chemical_entity", "pathway"): [
+            { "node_bindings": { "chemical_entity": [{"id": "CHEBI:2"}], "pathway": [{"id": "REACT:1"}] },
+              "edge_bindings": { "e1_pathway_chemical_entity": [{"id": "kg_pathway_chemical"}] } }
+        ],
+    }
+    executed = []
+    def execute (statement, interpreter, context={}):
+        order = tuple(statement.query.order)
+        executed.append ((order, { name: statement.query[name].curies for name in order }))
+        # like a service request, reset the errors then record one
+        interpreter.context.set ('requestErrors', [])
+        interpreter.context.mem['requestErrors'].append (f"error from {'->'.join(order)}")
+        return { "message": { "knowledge_graph": { "nodes": {}, "edges": {} }, "results": answers[order] } }
+
+    tranql.context.set ('requestErrors', [])
+    with patch.object (SelectStatement, "answer", execute):
+        response = select.execute_branches (tranql)
+
+    # each path keeps its own errors, gathered once the paths are done.
+    assert sorted(tranql.context.mem['requestErrors']) == [
+        "error from chemical_entity->pathway", "error from gene->chemical_entity", "error from gene->disease"
+    ]
+    # both arms of the bound hub run first, the pathway arm is handed the chemicals found.
+    assert [ order for order, curies in executed[:2] ] == [("gene", "disease"), ("gene", "chemical_entity")]
+    assert executed[2][0] == ("chemical_entity", "pathway")
+    assert set(executed[2][1]["chemical_entity"]) == { "CHEBI:1", "CHEBI:2" }
+
+    results = response['message']['results']
+    assert len(results) == 1
+    assert results[0]['node_bindings'] == {
+        "gene": [{"id": "HGNC:1"}],
+        "disease": [{"id": "MONDO:1"}],
+        "chemical_entity": [{"id": "CHEBI:2"}],
+        "pathway": [{"id": "REACT:1"}],
+    }
+    # each path's edge bindings are keyed by the merged query graph's edge ids, none are lost.
+    assert response['message']['query_graph'] == question
+    for result in results:
+        assert set(result['edge_bindings']) <= set(question['edges'])
+    assert results[0]['edge_bindings'] == {
+        "e1_gene_disease": [{"id": "kg_gene_disease"}],
+        "e3_gene_chemical_entity": [{"id": "kg_gene_chemical_2"}],
+        "e5_pathway_chemical_entity": [{"id": "kg_pathway_chemical"}],
+    }
+
+def test_ast_handoff_curies ():
+    concept = Concept (name="gene", type_name="biolink:Gene", exclude_patterns=["^UniProtKB"])
+    messages = [
+        { "results": [
+            { "node_bindings": { "gene": [{"id": "HGNC:1"}, {"id": "UniProtKB:P1"}], "disease": [{"id": "MONDO:1"}] } },
+            { "node_bindings": { "gene": [{"id": "HGNC:2"}] } },
+        ] },
+        { "results": [
+            { "node_bindings": { "gene": [{"id": "HGNC:1"}] } },
+            { "node_bindings": [], "edge_bindings": [] },
+        ] },
+        {},
+    ]
+    assert SelectStatement.handoff_curies (messages, concept) == ["HGNC:1", "HGNC:2"]
+    concept.include_patterns = ["HGNC:2"]
+    assert SelectStatement.handoff_curies (messages, concept) == ["HGNC:2"]
+
 @patch("PLATER.services.util.graph_adapter.GraphInterface._GraphInterface")
 def test_ast_bidirectional_query (GraphInterfaceMock, requests_mock):
     set_mock(requests_mock, "workflow-5")
@@ -1421,6 +2006,547 @@ def test_registry_adapter_automat():
         assert response['automat_kp1']['schema'] == expected_response
 
 
+def test_schema_partial_load():
+    """ Sources that fail or time out are reported in loadErrors while the others still load. """
+    from tranql.tranql_schema import Schema
+    mock_schema_yaml = {
+        'schema': {
+            'kp1': { 'url': '/graph/kp1', 'schema': '/graph/kp1/predicates' },
+            'kp2': { 'url': '/graph/kp2', 'schema': '/graph/kp2/predicates', 'timeout': 1 },
+            'kp3': { 'url': '/graph/kp3', 'schema': '/graph/kp3/predicates' },
+            'automat': { 'registry': 'automat', 'registry_url': '/graph/automat', 'url': '/graph/automat' }
+        }
+    }
+    with requests_mock.mock() as mock_server, patch('yaml.safe_load', lambda x: copy.deepcopy(mock_schema_yaml)):
+        mock_server.get('http://localhost:8099/graph/kp1/predicates', json={'gene': {'disease': ['related_to']}})
+        mock_server.get('http://localhost:8099/graph/kp2/predicates', exc=requests.exceptions.ConnectTimeout)
+        mock_server.get('http://localhost:8099/graph/kp3/predicates', json={'disease': {'gene': ['related_to']}})
+        mock_server.get('http://localhost:8099/graph/automat/registry', json=['a', 'b'])
+        mock_server.get('http://localhost:8099/graph/automat/a/predicates', json={'gene': {'pathway': ['related_to']}})
+        mock_server.get('http://localhost:8099/graph/automat/b/predicates', exc=requests.exceptions.ConnectionError)
+        schema = Schema('http://localhost:8099', use_registry=True, tranql_config={'SCHEMA_MAX_PARALLEL_REQUESTS': 2})
+    # configured order is kept, registry entries come last.
+    assert list(schema.schema.keys()) == ['kp1', 'kp3', 'automat_a']
+    assert schema.schema['kp3']['schema'] == {'disease': {'gene': ['related_to']}}
+    assert sorted(schema.loadErrors) == sorted([
+        'Request timed out while fetching schema at "http://localhost:8099/graph/kp2/predicates"',
+        'Request could not connect while fetching schema at "http://localhost:8099/graph/automat/b/predicates"'
+    ])
+
+def test_schema_snapshot(tmp_path):
+    """ A resolved schema is snapshotted, served from the snapshot and used when a source is unreachable. """
+    from tranql.tranql_schema import Schema
+    mock_schema_yaml = {
+        'schema': {
+            'kp1': { 'url': '/graph/kp1', 'schema': '/graph/kp1/predicates' },
+            'kp2': { 'url': '/graph/kp2', 'schema': '/graph/kp2/predicates' }
+        }
+    }
+    tranql_config = { 'SCHEMA_SNAPSHOT_PATH': str(tmp_path / 'schema.json') }
+    args = ('http://localhost:8099', False, tranql_config, True)
+    with requests_mock.mock() as mock_server, patch('yaml.safe_load', lambda x: copy.deepcopy(mock_schema_yaml)):
+        mock_server.get('http://localhost:8099/graph/kp1/predicates', json={'gene': {'disease': ['related_to']}})
+        mock_server.get('http://localhost:8099/graph/kp2/predicates', json={'disease': {'gene': ['causes']}})
+        schema = SchemaFactory.build_schema(*args)
+
+        snapshot = SchemaFactory.load_snapshot(*args)
+        assert snapshot.schema == schema.schema
+        assert sorted(snapshot.schema_graph.get_edges(data=True)) == sorted(schema.schema_graph.get_edges(data=True))
+        assert snapshot.get_node('gene')[1]['attr_dict'] == {'reasoner': ['kp1', 'kp2']}
+        # snapshots made with other settings or too old are not served
+        assert SchemaFactory.load_snapshot('http://other:8099', False, tranql_config, True) is None
+        assert SchemaFactory.load_snapshot(*args[:2], {**tranql_config, 'SCHEMA_SNAPSHOT_MAX_AGE': -1}, True) is None
+
+        mock_server.get('http://localhost:8099/graph/kp2/predicates', exc=requests.exceptions.ConnectionError)
+        schema = SchemaFactory.build_schema(*args)
+    assert len(schema.loadErrors) == 1
+    assert schema.schema['kp2']['schema'] == {'disease': {'gene': ['causes']}}
+    assert schema.schema_graph.get_edge('disease', 'gene', 'causes') is not None
+
+def test_schema_publisher(tmp_path):
+    """ One process publishes snapshot revisions, the others take over once it's gone. """
+    from tranql.tranql_schema import Schema, SchemaPublisher
+    path = str(tmp_path / 'schema.json')
+    publisher, other = SchemaPublisher(path), SchemaPublisher(path)
+    assert publisher.acquire() and publisher.acquire()
+    assert not other.acquire()
+
+    mock_schema_yaml = { 'schema': { 'kp1': { 'url': '/graph/kp1', 'schema': { 'gene': { 'disease': ['related_to'] } } } } }
+    with patch('yaml.safe_load', lambda x: copy.deepcopy(mock_schema_yaml)):
+        schema = Schema('http://localhost:8099', False, {}, skip_redis=True)
+    assert Schema.snapshot_revision(path) == 0
+    assert schema.save_snapshot(path, {}) == 1
+    # nothing changed, so there's nothing new to publish
+    assert schema.save_snapshot(path, {}) == 1
+    assert Schema.snapshot_revision(path) == 1
+    schema.add_layer(layer={ 'gene': { 'pathway': ['part_of'] } }, name='kp2')
+    assert schema.save_snapshot(path, {}) == 2
+    assert Schema.snapshot_revision(path) == 2
+    assert Schema.load_snapshot(path, {}).revision == 2
+
+    publisher.release()
+    assert other.acquire()
+    other.release()
+
+def test_schema_adjacency():
+    """ SchemaAdjacency produces the nodes and edges NetworkxGraph did, with the reasoners of shared edges merged. """
+    from tranql.tranql_schema import Schema, SchemaAdjacency, NetworkxGraph, GraphTranslator
+    layers = {
+        'kp1': { 'gene': { 'disease': ['related_to', 'causes'] }, 'disease': { 'gene': 'related_to' } },
+        'kp2': { 'gene': { 'disease': ['causes'], 'pathway': ['part_of'] } }
+    }
+    messages = {}
+    for graph_class in (NetworkxGraph, SchemaAdjacency):
+        schema = Schema.__new__(Schema)
+        schema.schema_graph = graph_class()
+        for name, layer in layers.items():
+            schema.add_layer(layer=layer, name=name)
+        messages[graph_class] = GraphTranslator(schema.schema_graph).graph_to_message()['knowledge_graph']
+        graph = schema.schema_graph
+        assert graph.get_edge('gene', 'disease') == ('gene', 'related_to', 'disease', {'reasoner': ['kp1']})
+        assert graph.get_edge('gene', 'anatomical_entity') is None
+    expected, actual = messages[NetworkxGraph], messages[SchemaAdjacency]
+    assert actual['nodes'] == expected['nodes'] == [
+        ['gene', {'reasoner': ['kp1', 'kp2']}],
+        ['disease', {'reasoner': ['kp1', 'kp2']}],
+        ['pathway', {'reasoner': ['kp2']}]
+    ]
+    assert [edge[:3] for edge in actual['edges']] == [edge[:3] for edge in expected['edges']]
+    # networkx kept the last reasoner of an edge supported by both
+    assert ('gene', 'disease', 'causes', {'reasoner': ['kp2']}) in expected['edges']
+    assert ('gene', 'disease', 'causes', {'reasoner': ['kp1', 'kp2']}) in actual['edges']
+
+def test_schema_paths():
+    """ The reachability index finds multi-hop routes through the schema. """
+    from tranql.exception import InvalidTransitionException
+    from tranql.tranql_schema import Schema, SchemaAdjacency
+    schema = Schema.__new__(Schema)
+    schema.schema_graph = SchemaAdjacency()
+    schema.add_layer(layer={
+        'chemical_substance': { 'gene': ['directly_interacts_with'], 'disease': ['treats'] },
+        'gene': { 'disease': ['gene_associated_with_condition', 'related_to'], 'pathway': ['part_of'] },
+        'pathway': { 'disease': ['related_to'] }
+    }, name='kp')
+    graph = schema.schema_graph
+    assert graph.reachable('chemical_substance', 1) == { 'gene': 1, 'disease': 1 }
+    assert graph.reachable('chemical_substance', 3) == { 'gene': 1, 'disease': 1, 'pathway': 2 }
+    assert graph.reachable('disease', 3) == {}
+
+    paths = schema.find_paths('ChemicalSubstance', 'disease', max_hops=3)
+    assert [path['concepts'] for path in paths] == [
+        ['chemical_substance', 'disease'],
+        ['chemical_substance', 'gene', 'disease'],
+        ['chemical_substance', 'gene', 'pathway', 'disease']
+    ]
+    assert paths[1]['predicates'] == [['directly_interacts_with'], ['gene_associated_with_condition', 'related_to']]
+    assert len(schema.find_paths('chemical_substance', 'disease', max_hops=2)) == 2
+    assert schema.find_paths('chemical_substance', 'disease', max_hops=3, limit=1)[0]['concepts'] == ['chemical_substance', 'disease']
+    assert schema.find_paths('disease', 'gene', max_hops=3) == []
+    assert graph.next_types('chemical_substance', 'pathway', 2) == ['gene']
+
+    # Adding an edge rebuilds the index.
+    graph.add_edge('disease', 'related_to', 'pathway', {'reasoner': ['kp']})
+    assert graph.reachable('disease', 2) == { 'pathway': 1, 'disease': 2 }
+    with pytest.raises(InvalidTransitionException) as exception:
+        schema.validate_edge('chemical_substance', 'pathway')
+    assert 'chemical_substance->gene->pathway' in exception.value.details
+
+def test_redis_backend_manager():
+    """ Queries against a redis graph share one graph interface and one event loop. """
+    import asyncio
+    from tranql.tranql_schema import RedisBackendManager
+    loops = []
+    class graph_interface_mock:
+        async def answer_trapi_question(self, query_graph, options={}, timeout=0):
+            loops.append(asyncio.get_running_loop())
+            return {'query_graph': query_graph, 'knowledge_graph': {'nodes': {}, 'edges': {}}, 'results': []}
+
+    schema_params = {'host': 'redis-test', 'port': 6379}
+    params = RedisBackendManager.connection_params(schema_params, password='secret', graph_name='graph_a')
+    assert schema_params == {'host': 'redis-test', 'port': 6379}
+    assert params == {'host': 'redis-test', 'port': 6379, 'auth': ('', 'secret'), 'db_name': 'graph_a', 'db_type': 'redis'}
+
+    select = SelectStatement(TranQL())
+    question = {'message': {'query_graph': {'nodes': {}, 'edges': {}}}, 'options': {'limit': ['=', 5]}}
+    with patch_graph_interface(graph_interface_mock()) as graph_interface:
+        for _ in range(3):
+            assert select.query_redis(params, question)['message']['results'] == []
+        assert len(set(loops)) == 1 and not loops[0].is_closed()
+        assert RedisBackendManager.get_interface(dict(params)) is RedisBackendManager.get_interface(params)
+        assert graph_interface.call_count == 1
+
+        # Another graph on the same host gets its own interface.
+        graph_interface.side_effect = lambda **params: graph_interface_mock()
+        other_params = RedisBackendManager.connection_params(schema_params, password='secret', graph_name='graph_b')
+        assert RedisBackendManager.get_interface(other_params) is not RedisBackendManager.get_interface(params)
+        assert [call.kwargs['db_name'] for call in graph_interface.call_args_list] == ['graph_a', 'graph_b']
+
+def test_redis_paging():
+    """ Large redis answers are fetched in concurrent skip/limit pages after a first full page, and merged in order. """
+    from redis.exceptions import ResponseError
+    from tranql.tranql_schema import RedisBackendManager
+    requested = []
+    class graph_interface_mock:
+        def __init__(self, size, timed_out_skip=None):
+            self.size = size
+            self.timed_out_skip = timed_out_skip
+        async def answer_trapi_question(self, query_graph, options={}, timeout=0):
+            requested.append((options['skip'], options['limit']))
+            if options['skip'] == self.timed_out_skip:
+                raise ResponseError('Query timed out')
+            ids = range(options['skip'], min(options['skip'] + options['limit'], self.size))
+            return {
+                'query_graph': query_graph,
+                'knowledge_graph': {'nodes': {f'n:{i}': {} for i in ids}, 'edges': {}},
+                'results': [{'node_bindings': {'n0': [{'id': f'n:{i}'}]}} for i in ids]
+            }
+    select = SelectStatement(TranQL())
+    question = {'message': {'query_graph': {'nodes': {}, 'edges': {}}}}
+    def query(size, options={}, timed_out_skip=None, errors=None):
+        requested.clear()
+        with patch.object(RedisBackendManager, 'get_interface', lambda params: graph_interface_mock(size, timed_out_skip)):
+            return select.query_redis({}, {**question, 'options': options}, page_size=10,
+                                      max_parallel_pages=2, errors=errors)['message']
+    def ids(answer):
+        return [result['node_bindings']['n0'][0]['id'] for result in answer['results']]
+
+    answer = query(25)
+    assert ids(answer) == [f'n:{i}' for i in range(25)]
+    assert len(answer['knowledge_graph']['nodes']) == 25
+    # The first page is fetched alone, the rest only because it came back full.
+    assert requested[0] == (0, 10)
+    assert sorted(requested) == [(0, 10), (10, 10), (20, 10)]
+    answer = query(5)
+    assert ids(answer) == [f'n:{i}' for i in range(5)]
+    assert requested == [(0, 10)]
+
+    # The question's own skip and limit bound the pages.
+    query(100, {'skip': ['=', 5], 'limit': ['=', 15]})
+    assert sorted(requested) == [(5, 10), (15, 5)]
+
+    errors = []
+    answer = query(25, timed_out_skip=10, errors=errors)
+    assert len(ids(answer)) == 15 and 'n:10' not in ids(answer)
+    assert len(errors) == 1
+    with pytest.raises(ResponseError):
+        query(25, timed_out_skip=10)
+
+def test_redis_answer_cache():
+    """ Repeated redis questions are answered from the cache until a new graph is loaded. """
+    from tranql.tranql_schema import RedisBackendManager, RedisAnswerCache
+    calls = []
+    class graph_interface_mock:
+        async def answer_trapi_question(self, query_graph, options={}, timeout=0):
+            calls.append(options)
+            return {'query_graph': query_graph, 'knowledge_graph': {'nodes': {'n:1': {}}, 'edges': {}}, 'results': []}
+    select = SelectStatement(TranQL())
+    cache = RedisAnswerCache(size=2)
+    version = ['1']
+    def query(limit=10):
+        question = {'message': {'query_graph': {'nodes': {'n0': {'ids': ['n:1']}}, 'edges': {}}}, 'options': {'limit': ['=', limit]}}
+        with patch.object(RedisBackendManager, 'get_interface', lambda params: graph_interface_mock()), \
+             patch.object(RedisBackendManager, 'graph_version', lambda params, key: version[0]):
+            return select.query_redis({'host': 'redis-test', 'db_name': 'test'}, question, cache=cache)['message']
+
+    answer = query()
+    answer['knowledge_graph']['nodes']['n:1']['attributes'] = ['decorated']
+    assert query() == {'query_graph': {'nodes': {'n0': {'ids': ['n:1']}}, 'edges': {}},
+                       'knowledge_graph': {'nodes': {'n:1': {}}, 'edges': {}}, 'results': []}
+    assert len(calls) == 1
+    query(limit=20)
+    assert len(calls) == 2
+    # A new graph is loaded.
+    version[0] = '2'
+    query()
+    assert len(calls) == 3
+    assert len(cache.answers) == 2
+    # Without a version marker there's no telling when the graph changes, so nothing is cached.
+    version[0] = None
+    query()
+    query()
+    assert len(calls) == 5
+    assert SelectStatement.redis_answer_cache({}) is None
+
+def test_autocomplete_index():
+    """ The autocomplete index answers prefix, exact and fuzzy searches without redis. """
+    from tranql.tranql_schema import RedisAdapter
+    from tranql.utils.autocomplete import BKTree, levenshtein
+    cypher_results = {
+        'biolink.Disease': [
+            ['MONDO:0004979', 'asthma', ['bronchial asthma'], ['biolink:Disease']],
+            ['MONDO:0004784', 'allergic asthma', [], ['biolink:Disease']],
+            ['MONDO:0005002', 'chronic obstructive pulmonary disease', ['COPD'], ['biolink:Disease']],
+        ],
+        'biolink.PhenotypicFeature': [
+            ['HP:0002099', 'Asthma', None, ['biolink:PhenotypicFeature']],
+            ['MONDO:0004979', 'asthma', ['bronchial asthma'], ['biolink:Disease']],
+        ],
+        'study': [['MONDO:0004979'], ['MONDO:0005002']]
+    }
+    class graph_interface_mock:
+        async def run_cypher(self, cypher):
+            label = next((label for label in cypher_results if f'`{label}`' in cypher), 'study')
+            return {'results': [{'columns': [], 'data': [{'row': row} for row in cypher_results[label]]}], 'errors': []}
+    with patch.dict(RedisAdapter.registry_adapters, {'redis_test': graph_interface_mock()}), \
+         patch.dict(RedisAdapter.autocomplete_indexes):
+        adapter = RedisAdapter()
+        index = adapter.build_autocomplete_index('redis_test', ['biolink.Disease', 'biolink.PhenotypicFeature'])
+        assert len(index) == 4
+
+        def search(query, **options):
+            return [hit['node']['id'] for hit in adapter.search('redis_test', query, [], options={'prefix_search': True, **options})]
+
+        # Names score above synonyms, then shorter names first.
+        assert search('asth') == ['MONDO:0004979', 'HP:0002099', 'MONDO:0004784']
+        assert search('ALLERGIC as') == ['MONDO:0004784']
+        assert search('copd') == ['MONDO:0005002']
+        assert search('asth', prefix_search=False) == []
+        assert search('asthma', prefix_search=False, query_limit=1) == ['MONDO:0004979']
+        assert search('astma', prefix_search=False, levenshtein_distance=1) == ['MONDO:0004979', 'HP:0002099', 'MONDO:0004784']
+        assert search('asthna alle', levenshtein_distance=1) == ['MONDO:0004784']
+        assert search('asth', study_linked=True) == ['MONDO:0004979']
+        phenotypes = adapter.search('redis_test', 'asth', ['biolink.PhenotypicFeature'], options={'prefix_search': True})
+        assert [hit['node']['id'] for hit in phenotypes] == ['MONDO:0004979', 'HP:0002099']
+        assert search('') == []
+
+    words = ['asthma', 'astma', 'asthmatic', 'allergic', 'chronic', 'disease', 'diseases', 'copd', 'cold']
+    tree = BKTree(words)
+    for word in ['asthma', 'colds', 'diesase', 'x']:
+        for distance in range(3):
+            assert sorted(tree.search(word, distance)) == sorted(
+                (candidate, levenshtein(word, candidate)) for candidate in words if levenshtein(word, candidate) <= distance)
+
+def test_autocomplete_search_cache():
+    """ Longer prefixes are answered from the complete results of shorter ones. """
+    from tranql.tranql_schema import RedisAdapter
+    from tranql.utils.autocomplete import SearchCache, prefix_match
+    corpus = [{'id': f'MONDO:{i}', 'name': name, 'synonyms': synonyms} for i, (name, synonyms) in enumerate([
+        ('asthma', ['bronchial asthma']), ('allergic asthma', []), ('astigmatism', []), ('ataxia', ['ataxy'])
+    ])]
+    searches = []
+    class graph_interface_mock:
+        def search(self, query, indexes, fields, options):
+            searches.append(query)
+            hits = [{'node': node, 'score': 1} for node in corpus if prefix_match(query, [node['name']] + node['synonyms'])]
+            return {'hits': hits[:options['query_limit']], 'search_terms': query.split()}
+    def search(query, limit=10, indexes=['biolink.Disease']):
+        options = {'prefix_search': True, 'levenshtein_distance': 0, 'query_limit': limit}
+        return [hit['node']['name'] for hit in RedisAdapter().search('redis_test', query, indexes, options=options)]
+
+    with patch.dict(RedisAdapter.registry_adapters, {'redis_test': graph_interface_mock()}), \
+         patch.object(RedisAdapter, 'search_cache', SearchCache(size=8, ttl=60)):
+        assert search('as') == ['asthma', 'allergic asthma', 'astigmatism']
+        assert search('ast') == ['asthma', 'allergic asthma', 'astigmatism']
+        assert search('asth') == ['asthma', 'allergic asthma']
+        assert search('asthma all') == ['allergic asthma']
+        assert searches == ['as']
+        # Other options are another search.
+        assert search('asth', indexes=['biolink.PhenotypicFeature']) == ['asthma', 'allergic asthma']
+        assert searches == ['as', 'asth']
+
+        # Results cut short by the limit can't answer longer queries.
+        assert search('a', limit=2) == ['asthma', 'allergic asthma']
+        assert search('at', limit=2) == ['ataxia']
+        assert searches == ['as', 'asth', 'a', 'at']
+        # Split between two indexes, three hits could be one index's full share.
+        search('a', limit=6, indexes=['biolink.Disease', 'biolink.Gene'])
+        search('at', limit=6, indexes=['biolink.Disease', 'biolink.Gene'])
+        assert searches[-2:] == ['a', 'at']
+
+    cache = SearchCache(size=2, ttl=60)
+    cache.put('s', 'a', [], True)
+    cache.put('s', 'b', [], True)
+    cache.lookup('s', 'a')
+    cache.put('s', 'c', [], True)
+    assert cache.lookup('s', 'b') is None and cache.lookup('s', 'a') == ('a', [])
+    cache.ttl = 0
+    time.sleep(0.01)
+    assert cache.lookup('s', 'a') is None
+
+def redis_graph_query(queries, node_ids):
+    """ A stand in for Graph.query recording queries, where the edges of a batch between node_ids are loaded. """
+    def query(query, params=None):
+        queries.append((query, params))
+        result = MagicMock()
+        result.result_set = [[sum(1 for row in (params or {}).get('batch', [])
+                                  if row.get('subject') in node_ids and row.get('object') in node_ids)]]
+        return result
+    return query
+
+def test_redis_graph_bulk_load():
+    """ Knowledge graphs are merged in batched UNWIND queries, one per label or edge type, named as redis backends name them. """
+    pytest.importorskip('redisgraph')
+    from tranql.redis_graph import RedisGraph
+    queries = []
+    with patch('tranql.redis_graph.redis.Redis'), patch('tranql.redis_graph.Graph') as graph:
+        graph.return_value.query.side_effect = redis_graph_query(queries, {'MONDO:1', 'MONDO:2', 'MONDO:3', 'CHEBI:1'})
+        rg = RedisGraph(graph='test', batch_size=2)
+        node_count, edge_count = rg.load_knowledge_graph({
+            'nodes': {
+                'MONDO:1': {'name': 'asthma', 'categories': ['biolink:Disease'], 'attributes': [{'name': 'umls', 'value': ['C1', 'C2']}],
+                            '_reasoners': 1},
+                'MONDO:2': {'name': 'copd', 'categories': ['biolink:Disease'], 'attributes': [{'name': 'bad', 'value': {'a': 1}}]},
+                'MONDO:3': {'name': 'flu', 'categories': ['biolink:Disease']},
+                'CHEBI:1': {'name': 'salbutamol', 'categories': ['biolink:ChemicalEntity']}
+            },
+            'edges': {
+                'e0': {'subject': 'CHEBI:1', 'object': 'MONDO:1', 'predicate': 'biolink:treats'},
+                'e1': {'subject': 'CHEBI:1', 'object': 'MONDO:2', 'predicate': 'biolink:treats'}
+            }
+        })
+        rg.r.incr.assert_called_with('test:version')
+    assert (node_count, edge_count) == (4, 2)
+    node_queries = [(query, params) for query, params in queries if params and 'MERGE (n' in query]
+    assert [len(params['batch']) for query, params in node_queries] == [2, 1, 1]
+    assert node_queries[0][1]['batch'][0] == {'id': 'MONDO:1', 'properties': {'name': 'asthma', 'umls': ['C1', 'C2'], 'id': 'MONDO:1'}}
+    assert node_queries[0][1]['batch'][1]['properties'] == {'name': 'copd', 'id': 'MONDO:2'}
+    assert 'CREATE INDEX ON :`biolink.Disease`(id)' in [query for query, params in queries]
+    edge_queries = [(query, params) for query, params in queries if params and 'MERGE (a)' in query]
+    assert len(edge_queries) == 1 and len(edge_queries[0][1]['batch']) == 2
+    assert 'MATCH (a:`biolink.ChemicalEntity` {id: edge.subject}), (b:`biolink.Disease` {id: edge.object})' in edge_queries[0][0]
+    assert 'MERGE (a)-[r:`biolink.treats` {id: edge.id}]->(b)' in edge_queries[0][0]
+    assert [row['id'] for row in edge_queries[0][1]['batch']] == ['e0', 'e1']
+
+def test_redis_graph_load_onto_earlier_nodes():
+    """ Edges to nodes of an earlier load match them by id, edges to missing nodes are skipped and not counted. """
+    pytest.importorskip('redisgraph')
+    from tranql.redis_graph import RedisGraph
+    queries = []
+    with patch('tranql.redis_graph.redis.Redis'), patch('tranql.redis_graph.Graph') as graph:
+        # MONDO:1 was created by an earlier load, MONDO:9 doesn't exist.
+        graph.return_value.query.side_effect = redis_graph_query(queries, {'MONDO:1', 'CHEBI:1'})
+        rg = RedisGraph(graph='test')
+        node_count, edge_count = rg.load_knowledge_graph({
+            'nodes': {'CHEBI:1': {'name': 'salbutamol', 'categories': ['biolink:ChemicalEntity']}},
+            'edges': {
+                'e0': {'subject': 'CHEBI:1', 'object': 'MONDO:1', 'predicate': 'biolink:treats'},
+                'e1': {'subject': 'CHEBI:1', 'object': 'MONDO:9', 'predicate': 'biolink:treats'}
+            }
+        })
+    assert (node_count, edge_count) == (1, 1)
+    edge_queries = [(query, params) for query, params in queries if params and 'MERGE (a)' in query]
+    assert len(edge_queries) == 1 and [row['id'] for row in edge_queries[0][1]['batch']] == ['e0', 'e1']
+    assert 'MATCH (a:`biolink.ChemicalEntity` {id: edge.subject}), (b {id: edge.object})' in edge_queries[0][0]
+
+def test_create_graph_sinks(tmp_path, monkeypatch):
+    """ CREATE GRAPH writes a knowledge graph to a file or bulk loads it into redis, where it's configured to. """
+    import json
+    from tranql.exception import ServiceInvocationError
+    from tranql.tranql_ast import CreateGraphStatement
+    from tranql.tranql_schema import Schema
+    knowledge_graph = {
+        'nodes': {'MONDO:1': {'name': 'asthma', 'categories': ['biolink:Disease'], '_reasoners': 1}},
+        'edges': {}
+    }
+    tranql = TranQL()
+    tranql.context.set('g', {'message': {'knowledge_graph': knowledge_graph, 'results': []}})
+    def create(service):
+        return CreateGraphStatement(graph='$g', service=service, name='out').execute(tranql)
+
+    # Both sinks are off by default.
+    with pytest.raises(ServiceInvocationError):
+        create('file:graph.json')
+    with pytest.raises(ServiceInvocationError):
+        create('redis:tranql_output')
+
+    monkeypatch.setenv('CREATE_GRAPH_FILE_DIRECTORY', str(tmp_path))
+    response = create('file:graph.json')
+    assert response == {'graph': 'file:graph.json', 'nodes': 1, 'edges': 0}
+    written = json.loads((tmp_path / 'graph.json').read_text())
+    assert '_reasoners' not in written['nodes']['MONDO:1']
+    assert written['nodes']['MONDO:1']['attributes'][0]['name'] == 'reasoner'
+    assert tranql.context.resolve_arg('$out') == response
+    # the graph in the context keeps its provenance mask for later statements.
+    assert tranql.context.resolve_arg('$g')['message']['knowledge_graph']['nodes']['MONDO:1'] == \
+        {'name': 'asthma', 'categories': ['biolink:Disease'], '_reasoners': 1}
+    for target in ('../graph.json', 'out/../../graph.json', str(tmp_path.parent / 'graph.json'), ''):
+        with pytest.raises(ServiceInvocationError):
+            create(f'file:{target}')
+    assert not (tmp_path.parent / 'graph.json').exists()
+
+    pytest.importorskip('redisgraph')
+    tranql.schema = Schema.__new__(Schema)
+    tranql.schema.config = {'schema': {'redis': {'redis': True, 'redis_connection_params': {'host': 'redis-test', 'port': 6380}}}}
+    monkeypatch.setenv('CREATE_GRAPH_REDIS_PREFIX', 'tranql_')
+    with patch('tranql.redis_graph.RedisGraph') as redis_graph:
+        redis_graph.return_value.load_knowledge_graph.return_value = (1, 0)
+        with pytest.raises(ServiceInvocationError):
+            create('redis:workflow_output')
+        response = create('redis:tranql_output')
+    assert response == {'graph': 'redis:tranql_output', 'nodes': 1, 'edges': 0}
+    assert redis_graph.call_args[1]['graph'] == 'tranql_output'
+    assert redis_graph.call_args[1]['host'] == 'redis-test'
+    loaded = redis_graph.return_value.load_knowledge_graph.call_args[0][0]
+    assert loaded['nodes']['MONDO:1']['attributes'][0]['name'] == 'reasoner'
+    assert knowledge_graph['nodes']['MONDO:1']['_reasoners'] == 1
+
+def test_schema_incremental_refresh():
+    """ Refreshing a schema only refetches sources that are due, and only reprocesses those that changed. """
+    from tranql.tranql_schema import Schema
+    mock_schema_yaml = {
+        'schema': {
+            'kp1': { 'url': '/graph/kp1', 'schema': '/graph/kp1/predicates', 'refresh_interval': 3600 },
+            'kp2': { 'url': '/graph/kp2', 'schema': '/graph/kp2/predicates' },
+            'kp3': { 'url': '/graph/kp3', 'schema': '/graph/kp3/predicates' }
+        }
+    }
+    kp1_url = 'http://localhost:8099/graph/kp1/predicates'
+    kp2_url = 'http://localhost:8099/graph/kp2/predicates'
+    kp3_url = 'http://localhost:8099/graph/kp3/predicates'
+    with requests_mock.mock() as mock_server, patch('yaml.safe_load', lambda x: copy.deepcopy(mock_schema_yaml)):
+        mock_server.get(kp1_url, json={'gene': {'disease': ['related_to']}})
+        mock_server.get(kp2_url, [
+            { 'json': {'disease': {'gene': ['causes']}}, 'headers': {'ETag': '"v1"'} },
+            { 'status_code': 304 }
+        ])
+        mock_server.get(kp3_url, json={'gene': {'pathway': ['related_to']}})
+        schema = Schema('http://localhost:8099', False, {})
+        refreshed = Schema('http://localhost:8099', False, {}, previous=schema)
+        fetched = [ request.url for request in mock_server.request_history ]
+        # kp1 isn't due, kp2 answers not modified and kp3 has the same content.
+        assert fetched.count(kp1_url) == 1
+        kp2_requests = [ request for request in mock_server.request_history if request.url == kp2_url ]
+        assert kp2_requests[-1].headers['If-None-Match'] == '"v1"'
+        assert refreshed.schema == schema.schema
+        assert not refreshed.sources['kp2']['changed'] and not refreshed.sources['kp3']['changed']
+        assert refreshed.schema_graph is schema.schema_graph
+
+        mock_server.get(kp3_url, json={'gene': {'pathway': ['affects']}})
+        changed = Schema('http://localhost:8099', False, {}, previous=refreshed)
+    assert changed.sources['kp3']['changed']
+    assert changed.schema['kp3']['schema'] == {'gene': {'pathway': ['affects']}}
+    assert changed.schema_graph is not schema.schema_graph
+    assert changed.schema_graph.get_edge('gene', 'pathway', 'affects') is not None
+
+def test_schema_redis_refresh():
+    """ A redis backend whose schema hasn't changed keeps the schema graph and its autocomplete index. """
+    from tranql.tranql_schema import Schema, RedisAdapter
+    mock_schema_yaml = {
+        'schema': {
+            'redis': { 'url': 'redis:', 'redis': True, 'redis_connection_params': {'host': 'local', 'port': 6379} }
+        }
+    }
+    redis_schemas = [
+        {'gene': {'disease': ['related_to']}},
+        {'gene': {'disease': ['related_to']}},
+        {'gene': {'disease': ['related_to', 'affects']}}
+    ]
+    with patch('yaml.safe_load', lambda x: copy.deepcopy(mock_schema_yaml)), \
+         patch.object(RedisAdapter, 'set_adapter'), \
+         patch.object(RedisAdapter, 'get_schema', side_effect=redis_schemas), \
+         patch.object(RedisAdapter, 'refresh_autocomplete_index') as refresh_index:
+        schema = Schema('http://localhost:8099', False, {})
+        refreshed = Schema('http://localhost:8099', False, {}, previous=schema)
+        assert not refreshed.sources['redis']['changed']
+        assert refreshed.schema_graph is schema.schema_graph
+        assert refresh_index.call_count == 1
+
+        changed = Schema('http://localhost:8099', False, {}, previous=refreshed)
+    assert changed.sources['redis']['changed']
+    assert changed.schema_graph is not schema.schema_graph
+    assert changed.schema_graph.get_edge('gene', 'disease', 'affects') is not None
+    assert refresh_index.call_count == 2
+
 def test_schema_should_not_change_once_initilalized():
     """
     Scenario: In a registry aware schema,
@@ -1641,6 +2767,80 @@ def test_connect_graph_should_return_same_knowledge_map_for_single_response ():
     assert merged_k_map[0]['node_bindings'] == k_map[0]['node_bindings']
     assert merged_k_map[0]['edge_bindings'] == k_map[0]['edge_bindings']
 
+def test_join_results_on_shared_concept():
+    left = [
+        {'node_bindings': {'hub': [{'id': 'H:1'}], 'a': [{'id': 'A:1'}]}, 'edge_bindings': {'e_a': [{'id': 'ea1'}]}},
+        {'node_bindings': {'hub': [{'id': 'H:2'}], 'a': [{'id': 'A:2'}]}, 'edge_bindings': {'e_a': [{'id': 'ea2'}]}},
+    ]
+    right = [
+        {'node_bindings': {'hub': [{'id': 'H:1'}], 'b': [{'id': 'B:1'}]}, 'edge_bindings': {'e_b': [{'id': 'eb1'}]}},
+        {'node_bindings': {'hub': [{'id': 'H:1'}], 'b': [{'id': 'B:2'}]}, 'edge_bindings': {'e_b': [{'id': 'eb2'}]}},
+        {'node_bindings': {'hub': [{'id': 'H:3'}], 'b': [{'id': 'B:3'}]}, 'edge_bindings': {'e_b': [{'id': 'eb3'}]}},
+        {"node_bindings": [], "edge_bindings": []},
+    ]
+    joined = join_results(left, right, ['hub'])
+    assert ordered([r['node_bindings'] for r in joined]) == ordered([
+        {'hub': [{'id': 'H:1'}], 'a': [{'id': 'A:1'}], 'b': [{'id': 'B:1'}]},
+        {'hub': [{'id': 'H:1'}], 'a': [{'id': 'A:1'}], 'b': [{'id': 'B:2'}]},
+    ])
+    assert all(set(r['edge_bindings'].keys()) == {'e_a', 'e_b'} for r in joined)
+    # nothing shared, results are concatenated
+    assert len(join_results(left, right, [])) == 5
+
+def test_merge_messages_limit():
+    publications = {'A:1': 1, 'A:2': 3, 'A:3': 0, 'A:4': 3}
+    message = {
+        'query_graph': {
+            'nodes': {'n0': {'id': 'n0'}, 'n1': {'id': 'n1'}},
+            'edges': {'e0': {'subject': 'n0', 'object': 'n1'}}
+        },
+        'knowledge_graph': {
+            'nodes': {},
+            'edges': {
+                f'edge_{curie}': {
+                    'subject': curie, 'object': 'X:1', 'predicate': 'biolink:related_to',
+                    'attributes': [{'name': 'publications', 'value': [f'PMID:{i}' for i in range(count)]}]
+                } for curie, count in publications.items()
+            }
+        },
+        'results': [
+            {
+                'node_bindings': {'n0': [{'id': curie}], 'n1': [{'id': 'X:1'}]},
+                'edge_bindings': {'e0': [{'id': f'edge_{curie}'}]}
+            } for curie in publications
+        ]
+    }
+    merged = merge_messages([copy.deepcopy(message)], limit=2)
+    # only the best scored results are kept, best first.
+    assert sorted(r['node_bindings']['n0'][0]['id'] for r in merged['results']) == ['A:2', 'A:4']
+    assert [r['score'] for r in merged['results']] == [3, 3]
+    # the knowledge graph only holds what the kept results bind.
+    bound = {r['edge_bindings']['e0'][0]['id'] for r in merged['results']}
+    assert set(merged['knowledge_graph']['edges']) == bound
+    assert len(merge_messages([copy.deepcopy(message)])['results']) == 4
+    assert len(merge_messages([copy.deepcopy(message)])['knowledge_graph']['edges']) == 4
+
+def test_top_results_prunes_knowledge_graph():
+    message = {
+        'knowledge_graph': {
+            'nodes': {'A:1': {}, 'A:2': {}, 'X:1': {}, 'X:2': {}, 'Y:1': {}},
+            'edges': {
+                'e1': {'subject': 'A:1', 'object': 'X:1'},
+                'e2': {'subject': 'A:2', 'object': 'X:2'},
+                'e3': {'subject': 'Y:1', 'object': 'A:1'},
+            }
+        },
+        'results': [
+            {'node_bindings': {'n0': [{'id': 'A:1'}]}, 'edge_bindings': {'e0': [{'id': 'e1'}, {'id': 'e3'}]}, 'score': 2},
+            {'node_bindings': {'n0': [{'id': 'A:2'}], 'n1': [{'id': 'X:2'}]}, 'edge_bindings': {'e0': [{'id': 'e2'}]}, 'score': 1},
+        ]
+    }
+    assert top_results(copy.deepcopy(message), 2)['knowledge_graph'] == message['knowledge_graph']
+    pruned = top_results(message, 1)
+    assert set(pruned['knowledge_graph']['edges']) == {'e1', 'e3'}
+    # nodes of kept edges stay even when no node binding names them.
+    assert set(pruned['knowledge_graph']['nodes']) == {'A:1', 'X:1', 'Y:1'}
+
 def test_merge_two_responses_connected_one_after_the_other():
     q_G_1 = {
         'nodes': {"n0": {'id': 'n0'}, "n1":{'id': 'n1'}},
@@ -1714,6 +2914,29 @@ def test_connected_q_graph_disconnected_kg_map():
         assert len(answer['node_bindings']) == 2
         assert len(answer['edge_bindings']) == 1
 
+def test_overlay_score ():
+    """ Answers get the score of the last score key whose ids they all bind. """
+    def answer (nodes, edges):
+        return {
+            'node_bindings': {f"n{i}": [{'id': node}] for i, node in enumerate(nodes)},
+            'edge_bindings': {f"e{i}": [{'id': edge}] for i, edge in enumerate(edges)},
+            'score': 0
+        }
+    answers = [
+        answer(['a', 'b', 'c'], ['ab', 'bc']),
+        answer(['a', 'b'], ['ab']),
+        answer(['d', 'b', 'c'], ['db', 'bc']),
+        answer(['x'], [])
+    ]
+    overlay_score(answers, {
+        frozenset(['b', 'c', 'bc']): 1,
+        frozenset(['a', 'b', 'ab']): 2,
+        frozenset(['a', 'b', 'c', 'ab', 'bc']): 3,
+        frozenset(['x', 'missing']): 4,
+        frozenset(['x']): 0
+    })
+    assert [a['score'] for a in answers] == [3, 2, 1, 0]
+
 def test_partials_disconnected_and_connected():
     """
     a:A--- b:B ---- c:C ----- d:D ---- e:E  (RESP 1 & 2)
@@ -2116,7 +3339,7 @@ def test_redis_graph_cypher_options(GraphInterfaceMock):
             tranql_config={}
         )
         tranql.schema = schema_factory.get_instance()
-        with patch('PLATER.services.util.graph_adapter.GraphInterface.instance', graph_Inteface_mock(limit=20, skip=100, options_set=True)):
+        with patch_graph_interface(graph_Inteface_mock(limit=20, skip=100, options_set=True)):
             ast = tranql.parse(
                 """
                 SELECT g1:gene->g2:gene
@@ -2127,7 +3350,7 @@ def test_redis_graph_cypher_options(GraphInterfaceMock):
             select_statement = ast.statements[0]
             select_statement.execute(interpreter=tranql)
 
-        with patch('PLATER.services.util.graph_adapter.GraphInterface.instance', graph_Inteface_mock(limit=20, skip=100, options_set=False)):
+        with patch_graph_interface(graph_Inteface_mock(limit=20, skip=100, options_set=False)):
             ast = tranql.parse(
                 """
                 SELECT g1:gene->g2:gene
@@ -2172,7 +3395,7 @@ def test_redis_graph_query_redis_schema_empty_response():
             return {}
     # we override the schema
     gi_mock = graph_Inteface_mock()
-    with patch('PLATER.services.util.graph_adapter.GraphInterface.instance',gi_mock ):
+    with patch_graph_interface(gi_mock):
         tranql = TranQL()
         with patch('yaml.safe_load', lambda x: copy.deepcopy(mock_schema_yaml)):
             # clean up schema singleton
@@ -2250,7 +3473,7 @@ def test_query_timeout(GraphInterfaceMock):
 
     gi_mock = graph_Inteface_mock(limit=20, skip=100, options_set=True)
 
-    with patch('PLATER.services.util.graph_adapter.GraphInterface.instance', gi_mock):
+    with patch_graph_interface(gi_mock):
         with patch('yaml.safe_load', lambda x: copy.deepcopy(mock_schema_yaml)):
             # clean up schema singleton and setup tranql
             update_interval = 1
@@ -1,3 +1,7 @@
+import os
+from contextlib import contextmanager
+from unittest.mock import patch
+
 import requests
 import requests_mock as r_mock
 from tests.mocks import MockMap
@@ -31,3 +35,12 @@ def ordered(obj):
         return sorted(ordered(x) for x in obj)
     else:
         return obj
+
+
+@contextmanager
+def patch_graph_interface(graph_interface):
+    """ Connect to every redis graph through graph_interface, without reusing interfaces made before. """
+    from tranql.tranql_schema import RedisBackendManager
+    with patch.multiple(RedisBackendManager, _interfaces={}, _pid=os.getpid()), \
+         patch('PLATER.services.util.graph_adapter.GraphInterface._GraphInterface', return_value=graph_interface) as mock:
+        yield mock